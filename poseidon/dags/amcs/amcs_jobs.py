@@ -1,5 +1,6 @@
 """AMCS _jobs file."""
 import pandas as pd
+import numpy as np
 import logging
 import os
 import datetime
@@ -9,6 +10,8 @@ from shlex import quote
 
 import subprocess
 from trident.util import general
+from trident.util import address_norm
+from trident.util import snapshot_diff
 from trident.util.sf_client import Salesforce
 from airflow.hooks.base_hook import BaseHook
 from airflow.models import Variable
@@ -22,6 +25,28 @@ temp_file2 = conf['temp_data_dir'] + '/cleaned_amcs_sites.csv'
 temp_file3 = conf['temp_data_dir'] + '/grouped_amcs_sites.csv'
 final_file = conf['temp_data_dir'] + '/final_amcs_sites.csv'
 
+# Export service prefixes and their report column prefixes
+route_services = {
+    'Refuse': 'Refuse',
+    'Recycle': 'Recycle',
+    'Green': 'Greens'
+}
+
+# Export weekdays and their day of week codes
+weekdays = [
+    ('Monday', 1),
+    ('Tuesday', 2),
+    ('Wednesday', 3),
+    ('Thursday', 4),
+    ('Friday', 5)
+]
+
+# Day of week values in the report, as names or numbers
+weekday_codes = {
+    'Mon': 1, 'Tue': 2, 'Wed': 3, 'Thu': 4, 'Fri': 5,
+    1: 1, 2: 2, 3: 3, 4: 4, 5: 5
+}
+
 # If the server IP ever changes, the smbclient command might fail with NT_STATUS_UNSUCCESSFUL errors
 
 def write_to_shared_drive():
@@ -88,15 +113,14 @@ def get_updates_only():
             pass
 
 
-        get_diff(previous_file=previous_run_temp_file1, current_file=temp_file1, output_file=temp_file2)
+        changes = get_diff(previous_file=previous_run_temp_file1, current_file=temp_file1)
 
-        # collect all the rows that belong to any site in the diff
-        latest_df = pd.read_csv(temp_file1, encoding='ISO-8859-1', low_memory=False, error_bad_lines=False)
-        diff_df = pd.read_csv(temp_file2, encoding='ISO-8859-1', low_memory=False, error_bad_lines=False)
-        changed_site_ids = diff_df['Site ID']
+        # collect all the rows that belong to any new or changed site
+        # Site ID is read as text, like the keys of the diff
+        latest_df = pd.read_csv(temp_file1, encoding='ISO-8859-1', low_memory=False, error_bad_lines=False, dtype={'Site ID': str})
+        changed_site_ids = changes.keys(['insert', 'update'])['Site ID']
 
-        unique_changed_site_ids = changed_site_ids.drop_duplicates()
-        changed_sites = pd.merge(latest_df, unique_changed_site_ids, on='Site ID')
+        changed_sites = latest_df[latest_df['Site ID'].isin(changed_site_ids)]
 
         general.pos_write_csv(
                 changed_sites,
@@ -164,7 +188,7 @@ def add_all_columns():
 
     final['CurrentAccount'] = df['Site ID']
     final['CustomerName'] = 'CURRENT RESIDENT'
-    address = df.apply(lambda x: format_address(x), axis = 1)
+    address = format_address(df)
     final['CustomerAddressline1'] = address
     final['CustomerUnit'] = df['Apt./Suite Number']
     final['CustomerCity'] = 'San Diego'
@@ -202,18 +226,16 @@ def add_all_columns():
     final['AssessFranchiseFees'] = 'NO'
     final['AssessFinanceCharges'] = 'NO'
     final['RefuseQty'] = df['RefuseQty']
-    final['RefuseADA'] = df['ADA'].apply(lambda x: 'YES' if x == 1 else 'NO')
+    ada = pd.Series(np.where(df['ADA'] == 1, 'YES', 'NO'), index=df.index)
+    final['RefuseADA'] = ada
     final['RefuseEquipment'] = ''
     final['RefuseServiceCode'] = 'REFUSE'
     final['RefuseServiceFrequency'] = '1'
     final['RefuseWeekCode'] = 'W'
     final['RefuseRate'] = '0'
 
-    final['RefuseMonday'] = df.apply(lambda x: '' if (x['Refuse Day Of Week'] != 'Mon' and x['Refuse Day Of Week'] != 1 and x['Refuse Day Of Week From GIS'] != 1) else x['Refuse Route'], axis = 1)
-    final['RefuseTuesday'] = df.apply(lambda x: '' if (x['Refuse Day Of Week'] != 'Tue' and x['Refuse Day Of Week'] != 2 and x['Refuse Day Of Week From GIS'] != 2) else x['Refuse Route'], axis = 1)
-    final['RefuseWednesday'] = df.apply(lambda x: '' if (x['Refuse Day Of Week'] != 'Wed' and x['Refuse Day Of Week'] != 3 and x['Refuse Day Of Week From GIS'] != 3) else x['Refuse Route'], axis = 1)
-    final['RefuseThursday'] = df.apply(lambda x: '' if (x['Refuse Day Of Week'] != 'Thu' and x['Refuse Day Of Week'] != 4 and x['Refuse Day Of Week From GIS'] != 4) else x['Refuse Route'], axis = 1)
-    final['RefuseFriday'] = df.apply(lambda x: '' if (x['Refuse Day Of Week'] != 'Fri' and x['Refuse Day Of Week'] != 5 and x['Refuse Day Of Week From GIS'] != 5) else x['Refuse Route'], axis = 1)
+    for column, routes in route_columns(df, 'Refuse').items():
+        final[column] = routes
 
     final['RefuseSharedIndicator'] = df['Refuse Shared Indicator']
 
@@ -222,18 +244,15 @@ def add_all_columns():
 
     final['RecycleQty'] = df['RecycleQty']
 
-    final['RecycleADA'] = df['ADA'].apply(lambda x: 'YES' if x == 1 else 'NO')
+    final['RecycleADA'] = ada
     final['RecycleEquipment'] = ''
     final['RecycleServiceCode'] = 'RECYCLE'
     final['RecycleServiceFrequency '] = '1'
     final['RecycleWeekCode'] = df['Recycle Week']
     final['RecycleRate'] = '0'
 
-    final['RecycleMonday'] = df.apply(lambda x: '' if (x['Recycle Day Of Week'] != 'Mon' and x['Recycle Day Of Week'] != 1 and x['Recycle Day Of Week From GIS'] != 1) else x['Recycle Route'], axis = 1)
-    final['RecycleTuesday'] = df.apply(lambda x: '' if (x['Recycle Day Of Week'] != 'Tue' and x['Recycle Day Of Week'] != 2 and x['Recycle Day Of Week From GIS'] != 2) else x['Recycle Route'], axis = 1)
-    final['RecycleWednesday'] = df.apply(lambda x: '' if (x['Recycle Day Of Week'] != 'Wed' and x['Recycle Day Of Week'] != 3 and x['Recycle Day Of Week From GIS'] != 3) else x['Recycle Route'], axis = 1)
-    final['RecycleThursday'] = df.apply(lambda x: '' if (x['Recycle Day Of Week'] != 'Thu' and x['Recycle Day Of Week'] != 4 and x['Recycle Day Of Week From GIS'] != 4) else x['Recycle Route'], axis = 1)
-    final['RecycleFriday'] = df.apply(lambda x: '' if (x['Recycle Day Of Week'] != 'Fri' and x['Recycle Day Of Week'] != 5 and x['Recycle Day Of Week From GIS'] != 5) else x['Recycle Route'], axis = 1)
+    for column, routes in route_columns(df, 'Recycle').items():
+        final[column] = routes
 
     final['RecycleSharedIndicator'] = df['Recycle Shared Indicator']
 
@@ -241,18 +260,15 @@ def add_all_columns():
     final['RecycleEndDate'] = ''
     final['RecycleQty'] = df['RecycleQty']
 
-    final['GreenADA'] = df['ADA'].apply(lambda x: 'YES' if x == 1 else 'NO')
+    final['GreenADA'] = ada
     final['GreenEquipment'] = ''
     final['GreenServiceCode'] = 'GREENS'
     final['GreenServiceFrequency'] = '1'
     final['GreenWeekCode'] = df['Greens Week']
     final['GreenRate'] = '0'
 
-    final['GreenMonday'] = df.apply(lambda x: '' if (x['Greens Day Of Week'] != 'Mon' and x['Greens Day Of Week'] != 1 and x['Greens Day Of Week From GIS'] != 1) else x['Greens Route'], axis = 1)
-    final['GreenTuesday'] = df.apply(lambda x: '' if (x['Greens Day Of Week'] != 'Tue' and x['Greens Day Of Week'] != 2 and x['Greens Day Of Week From GIS'] != 2) else x['Greens Route'], axis = 1)
-    final['GreenWednesday'] = df.apply(lambda x: '' if (x['Greens Day Of Week'] != 'Wed' and x['Greens Day Of Week'] != 3 and x['Greens Day Of Week From GIS'] != 3) else x['Greens Route'], axis = 1)
-    final['GreenThursday'] = df.apply(lambda x: '' if (x['Greens Day Of Week'] != 'Thu' and x['Greens Day Of Week'] != 4 and x['Greens Day Of Week From GIS'] != 4) else x['Greens Route'], axis = 1)
-    final['GreenFriday'] = df.apply(lambda x: '' if (x['Greens Day Of Week'] != 'Fri' and x['Greens Day Of Week'] != 5 and x['Greens Day Of Week From GIS'] != 5) else x['Greens Route'], axis = 1)
+    for column, routes in route_columns(df, 'Green').items():
+        final[column] = routes
 
     final['GreenSharedIndicator'] = df['Greens Shared Indicator']
 
@@ -272,57 +288,48 @@ def add_all_columns():
     return "Populated all columns for AMCS sites file."
 
 
-def format_address(row):
-
-    return (str(row['Street Number']) 
-        + ('' if pd.isnull(row['Fraction']) else ' ' + str(row['Fraction']))
-        + ('' if pd.isnull(row['Street Direction']) else ' ' + str(row['Street Direction']))
-        + ('' if pd.isnull(row['Street Name']) else ' ' + row['Street Name'])
-        + ('' if pd.isnull(row['Street Suffix']) else ' ' + str(row['Street Suffix']))
-        + ('' if pd.isnull(row['Post Direction']) else ' ' + str(row['Post Direction']))
-    )
+def route_columns(df, service):
+    """Build the weekday route columns of one service
 
+    A site gets its route under every weekday that matches
+    its day of week, as a name or a number, or the day of
+    week from GIS. Other weekdays are blank.
+    """
 
-    
-def get_diff(previous_file, current_file, output_file):
-    """Use diff command to find changes"""
+    report = route_services[service]
+    day = df[f'{report} Day Of Week'].map(weekday_codes)
+    gis_day = df[f'{report} Day Of Week From GIS']
+    routes = df[f'{report} Route']
 
-    # put the header in the output file
-    command = f"head -n +1 {current_file} > {output_file}"
-    command = command.format(quote(command))
-    return_code = subprocess.call(command, shell=True)
+    columns = {}
+    for weekday, code in weekdays:
+        on_day = (day == code) | (gis_day == code)
+        columns[f'{service}{weekday}'] = routes.where(on_day, '')
 
-    if return_code != 0:
-        raise Exception('Could not add headers to output file')
+    return columns
 
-    # skip the header and sort the previous file
-    previous_file_sorted = f'{previous_file}.sorted'
 
-    command = f"tail -n +2 {previous_file} | sort > {previous_file_sorted}"
-    command = command.format(quote(command))
-    return_code = subprocess.call(command, shell=True)
-    
-    if return_code != 0:
-        raise Exception(f'Could not sort {previous_file}')
+def format_address(df):
+    """Join the address parts of every site, skipping blank parts"""
 
-    # skip the header and sort the current file
-    current_file_sorted = f'{current_file}.sorted'
-    
-    command = f"tail -n +2 {current_file} | sort > {current_file_sorted}"
-    command = command.format(quote(command))
-    return_code = subprocess.call(command, shell=True)
-    
-    if return_code != 0:
-        raise Exception(f'Could sort {current_file}')
+    parts = df[['Street Number',
+        'Fraction',
+        'Street Direction',
+        'Street Name',
+        'Street Suffix',
+        'Post Direction']].copy()
+    parts['Street Number'] = parts['Street Number'].astype(str)
 
-    # diff the files and save the changes and new additions in the output file
-    command = f"diff {previous_file_sorted} {current_file_sorted}" \
-    +" | grep '> ' | awk '{{print substr($0,3)}}'" \
-    +f" >> {output_file}"
-    command = command.format(quote(command))
-    return_code = subprocess.call(command, shell=True)
-    
-    if return_code != 0:
-        raise Exception('Count not write changes to output file')
+    return address_norm.join_parts(parts, skip_null=True)
 
 
+    
+def get_diff(previous_file, current_file):
+    """Find sites inserted, updated and deleted since the previous run"""
+
+    return snapshot_diff.diff_snapshots(previous_file,
+        current_file,
+        key=['Site ID'],
+        name='amcs_sites',
+        encoding='ISO-8859-1',
+        error_bad_lines=False)
@@ -5,11 +5,14 @@ from datetime import datetime, timedelta
 import logging
 import cx_Oracle
 from trident.util import general
+from trident.util import incremental
 from airflow.hooks.base_hook import BaseHook
 
 conf = general.config
 fiscal_yr =  general.get_FY_year()
 prod_file = f"{conf['prod_data_dir']}/cip_{fiscal_yr}_datasd_v1.csv"
+
+watermark = incremental.Watermark('cip', 'SP_UPDATE_DT')
             
 
 def get_cip_data(**kwargs):
@@ -34,16 +37,18 @@ def get_cip_data(**kwargs):
 		conn_config['dsn'],
 		encoding="UTF-8")
 
-	logging.info("Read data to Panda DataFrame")
-	
-	df = pd.read_sql_query(cip_query, cip_conn)
-
-	rows = df.shape[0]
+	# Merge projects updated since the last run into prod
+	try:
+		rows = incremental.extract_incremental(db,
+			cip_query,
+			prod_file,
+			watermark,
+			key=['project_number'],
+			arraysize=5000,
+			date_format="%Y-%m-%d %H:%M:%S")
+	finally:
+		db.close()
 
-	# Write csv
-	logging.info(f'Writing {rows} rows to prod')
-	general.pos_write_csv(
-		df, prod_file, date_format="%Y-%m-%d %H:%M:%S")
+	logging.info(f'Merged {rows} rows into prod')
 
 	return "Successfully wrote prod file"
-
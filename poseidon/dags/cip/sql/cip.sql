@@ -35,4 +35,5 @@ FROM (
 	WHERE c.SP_PUBLIC = 'Y'
 )
 
-WHERE SP_UPDATE_DT = MAX_DATE
\ No newline at end of file
+WHERE SP_UPDATE_DT = MAX_DATE
+AND MAX_DATE >= TO_DATE('$since', 'YYYY-MM-DD HH24:MI:SS')
\ No newline at end of file
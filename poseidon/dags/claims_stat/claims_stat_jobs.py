@@ -115,12 +115,20 @@ def clean_geocode_claims():
         ##how many addresses do we need to geocodde
         logging.info(f"Need to geocode {to_geocode.shape[0]}")
 
-        #Apply geocoding function
-        geocoder_results=to_geocode.apply(lambda x: geospatial.census_address_geocoder(address_line=x['ADRESS1'], zip= x['ZIP_CODE'], bounds='yes'),axis=1)
+        ##Match to city address points, web geocode the rest
+        coords = geospatial.local_geocode(to_geocode['ADRESS1'],
+            to_geocode['ZIP_CODE'])
+        missing = coords['lat'].isnull()
+
+        if missing.any():
+            logging.info(f"Sending {missing.sum()} addresses to web geocoders")
+            geocoder_results=to_geocode[missing].apply(lambda x: geospatial.census_address_geocoder(address_line=x['ADRESS1'], zip= x['ZIP_CODE'], bounds='yes'),axis=1)
+            web_coords = geocoder_results.apply(pd.Series)
+            coords.loc[missing, 'lat'] = web_coords[0]
+            coords.loc[missing, 'lon'] = web_coords[1]
 
-        coords = geocoder_results.apply(pd.Series)
         logging.info(coords.head())
-        fresh_geocodes = to_geocode.assign(lat=coords[0],lng=coords[1])
+        fresh_geocodes = to_geocode.assign(lat=coords['lat'],lng=coords['lon'])
 
         # Before appending to address book, merge back to new_geocodes to include
         # every unique claim number and assign addresses
@@ -6,10 +6,16 @@ import logging
 import pymssql
 from airflow.hooks.mssql_hook import MsSqlHook
 from trident.util import general
+from trident.util import incremental
 
 conf = general.config
 cur_yr = general.get_year()
 prod_file = f"{conf['prod_data_dir']}/fd_incidents_{cur_yr}_datasd_v1.csv"
+
+# Incidents can reach the archive a few days after the response
+watermark = incremental.Watermark('fd_incidents',
+	'date_response',
+	lookback=timedelta(days=3))
             
 def get_fd_data( **kwargs):
 	"""Get fire department data from Data Base."""
@@ -18,15 +24,20 @@ def get_fd_data( **kwargs):
 	
 	
 	fd_query = general.file_to_string('./sql/fd.sql', __file__)
-	fd_conn = MsSqlHook(mssql_conn_id='FIRE_DEPARTMENT')
+	fd_conn = MsSqlHook(mssql_conn_id='FIRE_DEPARTMENT').get_conn()
 
-	logging.info("Read data to panda DataFrame")
-	
-	df = fd_conn.get_pandas_df(fd_query)
-	# Write csv
+	# Merge incidents since the last run into prod
 	logging.info('Writing ' + prod_file)
-	general.pos_write_csv(
-		df, prod_file, date_format="%Y-%m-%d %H:%M:%S")
+	try:
+		rows = incremental.extract_incremental(fd_conn,
+			fd_query,
+			prod_file,
+			watermark,
+			key=['incident_number', 'date_response'],
+			sort_by='date_response',
+			ascending=False,
+			date_format="%Y-%m-%d %H:%M:%S")
+	finally:
+		fd_conn.close()
 		
-	return "Successfully wrote prod file at " + prod_file
-
+	return f"Successfully merged {rows} records into prod file at " + prod_file
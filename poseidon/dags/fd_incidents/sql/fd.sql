@@ -19,5 +19,6 @@ where
       p.Jurisdiction = 'San Diego'
       --AND p.call_category != 'OTHER'
       AND p.response_year = YEAR(GETDATE())
+      AND p.Response_Date >= CONVERT(datetime, '$since', 120)
 
 ORDER BY p.Response_Date DESC
\ No newline at end of file
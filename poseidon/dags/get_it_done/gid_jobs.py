@@ -470,7 +470,9 @@ def join_requests_polygons(tempfile='',
     outfile=''):
     """Spatially joins council districts data to GID data."""
     geojson = f"{conf['prod_data_dir']}/{geofile}_datasd.geojson"
-    df = f"{conf['temp_data_dir']}/{tempfile}.csv"
+    df = f"{conf['temp_data_dir']}/{tempfile}"
+    if not df.endswith('.csv'):
+        df = general.pos_read_temp(df)
     join = spatial_join_pt(df,
                              geojson,
                              lat='lat',
@@ -484,21 +486,19 @@ def join_requests_polygons(tempfile='',
 
     join = join.drop(drop_cols, axis=1)
 
-    general.pos_write_csv(
+    general.pos_write_temp(
         join,
-        f"{conf['temp_data_dir']}/{outfile}.csv",
-        date_format='%Y-%m-%dT%H:%M:%S%z')
+        f"{conf['temp_data_dir']}/{outfile}")
 
     return f"Successfully joined {geofile} to GID data"
 
 def create_prod_files():
     """ Map category columns and divide by year """
 
-    df = pd.read_csv(f"{conf['temp_data_dir']}/gid_parks.csv", 
-        low_memory=False,
-        parse_dates=['date_time_opened',
-        'date_time_closed']
-        )
+    df = general.pos_read_temp(f"{conf['temp_data_dir']}/gid_parks.feather")
+
+    for date_col in ['date_time_opened','date_time_closed']:
+        df[date_col] = pd.to_datetime(df[date_col], errors='ignore')
 
     # Must drop status column here to rename
     # mobile_web_status to status
@@ -608,41 +608,40 @@ def create_prod_files():
     
     logging.info(f"Full dataset contains {final_reports.shape[0]} records")
     
-    #Write services file to temp
-    general.pos_write_csv(
-        final_reports,
-        services_file,
-        date_format='%Y-%m-%dT%H:%M:%S%z')
-    
-    # Write full file to prod
-    general.pos_write_csv(
-        final_reports,
-        full_file,
-        date_format='%Y-%m-%d')
-
-    logging.info("Creating new compressed csv for Snowflake")
-    csv_subset = final_reports.drop(['public_description'],axis=1)
-    general.sf_write_csv(csv_subset,'get_it_done')
-
     min_report = final_reports['date_requested'].min().year
     max_report = final_reports['date_requested'].max().year
 
-    final_reports = final_reports.drop(['specify_the_issue'],axis=1)
+    # Temp services file, full prod file and Snowflake file
+    # are written in one pass along with each year subset
+    outputs = [
+        general.pos_csv_spec(services_file,
+            date_format='%Y-%m-%dT%H:%M:%S%z'),
+        general.pos_csv_spec(full_file,
+            date_format='%Y-%m-%d'),
+        general.sf_csv_spec('get_it_done',
+            columns=[x for x in final_reports.columns
+                if x != 'public_description'])
+    ]
+
+    year_cols = [x for x in final_reports.columns
+        if x != 'specify_the_issue']
 
     for year in range(min_report,max_report+1):
         this_yr = str(year)
         next_yr = str(year+1)
         logging.info(f'Subsetting records for {year}')
         file_path = prod_file_base+this_yr+'_'+prod_file_end
-        file_subset = final_reports[
-            (final_reports['date_requested'] >= this_yr+'-01-01 00:00:00') &
-            (final_reports['date_requested'] < next_yr+'-01-01 00:00:00')]
-
-        logging.info(f'Writing {file_subset.shape[0]} records to prod')
-        general.pos_write_csv(
-            file_subset,
-            file_path,
-            date_format='%Y-%m-%dT%H:%M:%S%z')
+        year_rows = ((final_reports['date_requested'] >= this_yr+'-01-01 00:00:00') &
+            (final_reports['date_requested'] < next_yr+'-01-01 00:00:00'))
+
+        logging.info(f'Writing {year_rows.sum()} records to prod')
+        outputs.append(general.pos_csv_spec(file_path,
+            rows=year_rows.values,
+            columns=year_cols,
+            date_format='%Y-%m-%dT%H:%M:%S%z'))
+
+    logging.info("Writing temp, prod, Snowflake and year files")
+    general.pos_write_csvs(final_reports, outputs)
 
     return "Successfully created prod files"
 
@@ -31,7 +31,7 @@ def spatial_join_subdag():
   join_council_districts = PythonOperator(
     task_id='join_council_districts',
     python_callable=join_requests_polygons,
-    op_kwargs={'tempfile':'gid_ref',
+    op_kwargs={'tempfile':'gid_ref.csv',
     'geofile':'council_districts',
     'drop_cols':['objectid',
         'area',
@@ -39,28 +39,28 @@ def spatial_join_subdag():
         'name',
         'phone',
         'website'],
-    'outfile':'gid_cd'},
+    'outfile':'gid_cd.feather'},
     dag=dag_subdag)
 
   join_community_plan = PythonOperator(
     task_id='join_community_plan',
     python_callable=join_requests_polygons,
-    op_kwargs={'tempfile':'gid_cd',
+    op_kwargs={'tempfile':'gid_cd.feather',
     'geofile':'cmty_plan',
     'drop_cols':['objectid',
           'acreage'],
-    'outfile':'gid_cp'},
+    'outfile':'gid_cp.feather'},
     dag=dag_subdag)
 
   join_parks = PythonOperator(
     task_id='join_parks',
     python_callable=join_requests_polygons,
-    op_kwargs={'tempfile':'gid_cp',
+    op_kwargs={'tempfile':'gid_cp.feather',
     'geofile':'parks',
     'drop_cols':['objectid',
           'gis_acres',
           'location'],
-    'outfile':'gid_parks'},
+    'outfile':'gid_parks.feather'},
     dag=dag_subdag)
 
   join_council_districts >> join_community_plan >> join_parks
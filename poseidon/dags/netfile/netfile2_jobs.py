@@ -3,13 +3,10 @@ import os
 import pandas as pd
 import logging
 from trident.util import general
-import requests
-import json
-import math
+from trident.util.netfile_client import NetFile, map_fields
 
 conf = general.config
 forms = {'460A':'0','460B1':'12','460C':'1','460D':'5','497P1':'20','496':'19'}
-payload = {'format':'json'}
 prod_columns = ['form',
                 'schedule',
                 'schedule_description',
@@ -42,121 +39,157 @@ prod_columns = ['form',
 cur_yr = general.get_year()
 prod_file = conf['prod_data_dir'] + '/financial_support_'+str(cur_yr)+'_datasd_v1.csv'
 
+# Output columns filled from NetFile fields, by transaction type
+
+contrib_fields = {'schedule':'form_Type',
+                  'recipient_id':'filerStateId',
+                  'recipient_name':'filerName',
+                  'date_report_period_from':'filingStartDate',
+                  'date_report_period_to':'filingEndDate',
+                  'contributor_code':'entity_Cd',
+                  'contributor_last':'tran_NamL',
+                  'contributor_first':'tran_NamF',
+                  'address_city_contributor':'tran_City',
+                  'address_state_contributor':'tran_ST',
+                  'address_zip_contributor':'tran_Zip4',
+                  'contributor_emp':'tran_Emp',
+                  'contributor_occ':'tran_Occ',
+                  'date_contribution':'tran_Date',
+                  'contribution_amount':'tran_Amt1',
+                  'contribution_annual':'tran_Amt2',
+                  'contribution_desc':'tran_Dscr',
+                  'contributor_id':'cmte_Id',
+                  'intermediary_last':'intr_NamL',
+                  'intermediary_first':'intr_NamF',
+                  'address_city_intermediary':'intr_City',
+                  'address_state_intermediary':'intr_ST',
+                  'address_zip_intermediary':'intr_Zip4',
+                  'intermediary_emp':'intr_Emp',
+                  'intermediary_occ':'intr_Occ',
+                  'filing_id':'filingId'}
+
+loan_fields = general.merge_dicts(contrib_fields,
+                 {'date_contribution':'loan_Date1',
+                  'contribution_amount':'loan_Amt1',
+                  'contribution_annual':'loan_Amt3'})
+
+expenditure_fields = {'schedule':'form_Type',
+                      'recipient_id':'cmte_Id',
+                      'recipient_name':'full_name',
+                      'date_report_period_from':'filingStartDate',
+                      'date_report_period_to':'filingEndDate',
+                      'contributor_last':'filerName',
+                      'date_contribution':'tran_Date',
+                      'contribution_amount':'tran_Amt1',
+                      'contribution_annual':'tran_Amt2',
+                      'contribution_desc':'tran_Dscr',
+                      'contributor_id':'filerStateId',
+                      'intermediary_last':'intr_NamL',
+                      'intermediary_first':'intr_NamF',
+                      'address_city_intermediary':'intr_City',
+                      'address_state_intermediary':'intr_ST',
+                      'address_zip_intermediary':'intr_Zip4',
+                      'intermediary_emp':'intr_Emp',
+                      'intermediary_occ':'intr_Occ',
+                      'filing_id':'filingId'}
+
+summary_fields = {'schedule':'schedule',
+                  'schedule_description':'description',
+                  'recipient_id':'filerStateId',
+                  'recipient_name':'filerName',
+                  'date_report_period_from':'filingStartDate',
+                  'date_report_period_to':'filingEndDate',
+                  'contribution_amount':'amount_A',
+                  'contribution_annual':'amount_B',
+                  'filing_id':'filingId'}
+
+def get_form_transactions(form, endpoint='transaction/year'):
+    """ Request all transactions for one form type """
+
+    # NetFile returns at most 1,000 records per request,
+    # so the client counts records and fetches every page
+
+    data = {'Year':cur_yr,'ShowSuperceded':'false'}
+
+    if form is not None:
+        data['TransactionType'] = forms[form]
+
+    client = NetFile()
+
+    return client.fetch_df(endpoint, data)
+
+def add_full_name(raw):
+    """ Add recipient name for independent expenditures """
+
+    # Name comes from the ballot measure, then the candidate,
+    # then the payee. It is set by records in support and
+    # carried forward to the records after them
+
+    support = raw['sup_Opp_Cd'] == 'S'
+    cand_name = raw['cand_NamF'] + ' ' + raw['cand_NamL']
+    full_name = raw['tran_NamL'].where(cand_name == ' ', cand_name.str.strip())
+    full_name = raw['bal_Name'].where(raw['bal_Name'] != '', full_name)
+
+    return raw.assign(full_name=full_name.where(support).ffill())
+
+def filter_after_max_date(raw):
+    """ Keep transactions newer than the filer's last filing """
+
+    date_checks_max = pd.read_csv(conf['temp_data_dir'] + '/date_checks_max.csv')
+
+    return general.filter_newer_than_max(raw,
+        date_checks_max,
+        'filerStateId',
+        'tran_Date',
+        max_key='recipient_id',
+        max_date_col='date_report_period_to',
+        exclude=['Pending'])
+
+def write_transactions(df, save_path, label):
+    """ Write one set of transactions to temp """
+
+    logging.info(f"Writing {label} transactions to temp")
+    general.pos_write_csv(
+        df,
+        save_path,
+        date_format="%Y-%m-%d %H:%M:%S")
+
+    return f"Created {label} transactions {df.shape[0]}"
+
 def get_transactions_a():
     """ Requesting transactions for schedule 460A """
 
     # Getting transactions for Form 460, Schedule A
     # Which contain semi-annual and pre-election reporting
 
-    save_path = conf['temp_data_dir'] + '/schedule_460a.csv'
-    req_url = "https://netfile.com:443/" \
-                + "Connect2/api/public/" \
-                + "campaign/export/cal201/" \
-                + "transaction/year"
-    logging.info("Requesting number of transactions")
+    raw = get_form_transactions('460A')
+    campaignTransactions = map_fields(raw,
+        contrib_fields,
+        prod_columns,
+        form='460',
+        schedule_description='Monetary contributions',
+        year_report=cur_yr)
+
+    result = write_transactions(campaignTransactions,
+        conf['temp_data_dir'] + '/schedule_460a.csv',
+        '460A')
+
+    # Process max dates for later use
+    logging.info("Calculate max filing dates")
+    date_checks = campaignTransactions[['recipient_id','date_report_period_to']]
+    date_checks = date_checks.drop_duplicates()
+    date_checks = date_checks.fillna('')
+    date_checks_max = date_checks.groupby(['recipient_id'])['date_report_period_to'].max()
+    date_checks_max = date_checks_max.to_frame()
+    date_checks_max.reset_index(inplace=True)
     
-    # First, we have to hit the API to get the total number
-    # of records for this form type. This is because
-    # of a 1,000 record limit that requires us to loop
-
-    countRequest = requests.post(req_url,
-                                params=payload,
-                                data = {'Aid':'CSD',
-                                        'Year':cur_yr,
-                                        'CurrentPageIndex':0,
-                                        'PageSize':'1',
-                                        'TransactionType':forms['460A'],
-                                        'ShowSuperceded':'false'})
-    if countRequest.status_code == 200:
-        formTransactions = countRequest.json()['totalMatchingCount']
-        if formTransactions < 1000:
-            requestLoops = 1
-        else:
-            requestLoops = math.ceil(formTransactions/1000)
-        transactionsList = []
-
-        # Not that we know how many loops to run, we can
-        # loop to request records
-
-        for i in range(requestLoops):
-            logging.info("Requesting transactions " + str(i))
-            page = str(i)
-            transactRequest = requests.post(req_url,
-                                            params=payload,
-                                            data={'Aid':'CSD',
-                                                  'Year':cur_yr,
-                                                  'CurrentPageIndex':page,
-                                                  'PageSize':'1000',
-                                                  'TransactionType':forms['460A'],
-                                                  'ShowSuperceded':'false'})
-            if transactRequest.status_code != 200:
-                return "Transaction request " + str(i) + " failed " + str(transactRequest.status_code)
-            else:
-                logging.info("Transaction request " + str(i) + " success")
-                transactions_json = transactRequest.json()['results']
-                
-                # For each record, we are plugging fields into 
-                # the appropriate columns for the final dataset.
-
-                for t in transactions_json:
-                    transactionsList.append(['460', #form
-                                       t['form_Type'], #schedule
-                                       'Monetary contributions', #schedule_description
-                                       t['filerStateId'], #recipient_id
-                                       t['filerName'], #recipient_name
-                                       t['filingStartDate'], #'date_report_period_from'
-                                       t['filingEndDate'], #'date_report_period_to'
-                                       t['entity_Cd'], #'contributor_code'
-                                       t['tran_NamL'], #'contributor_last'
-                                       t['tran_NamF'], #'contributor_first'
-                                       t['tran_City'], #'address_city_contributor'
-                                       t['tran_ST'], #'address_state_contributor'
-                                       t['tran_Zip4'], #'address_zip_contributor'
-                                       t['tran_Emp'], #'contributor_emp'
-                                       t['tran_Occ'], #'contributor_occ'
-                                       t['tran_Date'], #'date_contribution'
-                                       t['tran_Amt1'], #'contribution_amount'
-                                       t['tran_Amt2'], #'contribution_annual'
-                                       t['tran_Dscr'], #'contribution_desc'
-                                       t['cmte_Id'], #'contributor_id'
-                                       t['intr_NamL'], #'intermediary_last'
-                                       t['intr_NamF'], #'intermediary_first'
-                                       t['intr_City'], #'address_city_intermediary'
-                                       t['intr_ST'], #'address_state_intermediary'
-                                       t['intr_Zip4'], #'address_zip_intermediary'
-                                       t['intr_Emp'], #'intermediary_emp'
-                                       t['intr_Occ'], #'intermediary_occ'
-                                       t['filingId'],
-                                         cur_yr])
-
-        campaignTransactions = pd.DataFrame(transactionsList,columns=prod_columns)
-        logging.info("Writing 460A transactions to temp")
-        general.pos_write_csv(
-            campaignTransactions,
-            save_path,
-            date_format="%Y-%m-%d %H:%M:%S")
-
-        # Process max dates for later use
-        logging.info("Calculate max filing dates")
-        date_checks = campaignTransactions[['recipient_id','date_report_period_to']]
-        date_checks = date_checks.drop_duplicates()
-        date_checks = date_checks.fillna('')
-        date_checks_max = date_checks.groupby(['recipient_id'])['date_report_period_to'].max()
-        date_checks_max = date_checks_max.to_frame()
-        date_checks_max.reset_index(inplace=True)
-        
-        logging.info("Writing max filing dates to temp")
-        general.pos_write_csv(
-            date_checks_max,
-            conf['temp_data_dir'] + '/date_checks_max.csv',
-            date_format="%Y-%m-%d %H:%M:%S")
-
-
-
-    else:
-        return "Count request failed " + str(countRequest.status_code)
-        
-    return "Created 460A transactions " + str(formTransactions)
+    logging.info("Writing max filing dates to temp")
+    general.pos_write_csv(
+        date_checks_max,
+        conf['temp_data_dir'] + '/date_checks_max.csv',
+        date_format="%Y-%m-%d %H:%M:%S")
+
+    return result
 
 def get_transactions_b():
     """ Requesting transactions for schedule 460B1 """
@@ -164,84 +197,17 @@ def get_transactions_b():
     # Getting transactions for Form 460, Schedule B1
     # Which contain semi-annual and pre-election reporting
 
-    save_path = conf['temp_data_dir'] + '/schedule_460b1.csv'
-    req_url = "https://netfile.com:443/" \
-                + "Connect2/api/public/" \
-                + "campaign/export/cal201/" \
-                + "transaction/year"
-    logging.info("Requesting number of transactions")
-    countRequest = requests.post(req_url,
-                                params=payload,
-                                data = {'Aid':'CSD',
-                                        'Year':cur_yr,
-                                        'CurrentPageIndex':0,
-                                        'PageSize':'1',
-                                        'TransactionType':forms['460B1'],
-                                        'ShowSuperceded':'false'})
-    if countRequest.status_code == 200:
-        formTransactions = countRequest.json()['totalMatchingCount']
-        if formTransactions < 1000:
-            requestLoops = 1
-        else:
-            requestLoops = math.ceil(formTransactions/1000)
-        transactionsList = []
-        for i in range(requestLoops):
-            logging.info("Requesting transactions " + str(i))
-            page = str(i)
-            transactRequest = requests.post(req_url,
-                                            params=payload,
-                                            data={'Aid':'CSD',
-                                                  'Year':cur_yr,
-                                                  'CurrentPageIndex':page,
-                                                  'PageSize':'1000',
-                                                  'TransactionType':forms['460B1'],
-                                                  'ShowSuperceded':'false'})
-            if transactRequest.status_code != 200:
-                return "Transaction request " + str(i) + " failed " + str(transactRequest.status_code)
-            else:
-                logging.info("Transaction request " + str(i) + " success")
-                transactions_json = transactRequest.json()['results']
-                for t in transactions_json:
-                    transactionsList.append(['460', #form
-                                       t['form_Type'], #schedule
-                                       'Loans', #schedule_description
-                                       t['filerStateId'], #recipient_id
-                                       t['filerName'], #recipient_name
-                                       t['filingStartDate'], #'date_report_period_from'
-                                       t['filingEndDate'], #'date_report_period_to'
-                                       t['entity_Cd'], #'contributor_code'
-                                       t['tran_NamL'], #'contributor_last'
-                                       t['tran_NamF'], #'contributor_first'
-                                       t['tran_City'], #'address_city_contributor'
-                                       t['tran_ST'], #'address_state_contributor'
-                                       t['tran_Zip4'], #'address_zip_contributor'
-                                       t['tran_Emp'], #'contributor_emp'
-                                       t['tran_Occ'], #'contributor_occ'
-                                       t['loan_Date1'], #'date_contribution'-CHANGED
-                                       t['loan_Amt1'], #'contribution_amount'
-                                       t['loan_Amt3'], #'contribution_annual'
-                                       t['tran_Dscr'], #'contribution_desc'
-                                       t['cmte_Id'], #'contributor_id'
-                                       t['intr_NamL'], #'intermediary_last'
-                                       t['intr_NamF'], #'intermediary_first'
-                                       t['intr_City'], #'address_city_intermediary'
-                                       t['intr_ST'], #'address_state_intermediary'
-                                       t['intr_Zip4'], #'address_zip_intermediary'
-                                       t['intr_Emp'], #'intermediary_emp'
-                                       t['intr_Occ'], #'intermediary_occ'
-                                       t['filingId'],
-                                         cur_yr])
-
-        campaignTransactions = pd.DataFrame(transactionsList,columns=prod_columns)
-        logging.info("Writing 460B1 transactions to temp")
-        general.pos_write_csv(
-            campaignTransactions,
-            save_path,
-            date_format="%Y-%m-%d %H:%M:%S")
-    else:
-        return "Count request failed " + str(countRequest.status_code)
-        
-    return "Created 460B1 transactions " + str(formTransactions)
+    raw = get_form_transactions('460B1')
+    campaignTransactions = map_fields(raw,
+        loan_fields,
+        prod_columns,
+        form='460',
+        schedule_description='Loans',
+        year_report=cur_yr)
+
+    return write_transactions(campaignTransactions,
+        conf['temp_data_dir'] + '/schedule_460b1.csv',
+        '460B1')
 
 def get_transactions_c():
     """ Requesting transactions for schedule 460C """
@@ -249,84 +215,17 @@ def get_transactions_c():
     # Getting transactions for Form 460, Schedule C
     # Which contain semi-annual and pre-election reporting
 
-    save_path = conf['temp_data_dir'] + '/schedule_460c.csv'
-    req_url = "https://netfile.com:443/" \
-                + "Connect2/api/public/" \
-                + "campaign/export/cal201/" \
-                + "transaction/year"
-    logging.info("Requesting number of transactions")
-    countRequest = requests.post(req_url,
-                                params=payload,
-                                data = {'Aid':'CSD',
-                                        'Year':cur_yr,
-                                        'CurrentPageIndex':0,
-                                        'PageSize':'1',
-                                        'TransactionType':forms['460C'],
-                                        'ShowSuperceded':'false'})
-    if countRequest.status_code == 200:
-        formTransactions = countRequest.json()['totalMatchingCount']
-        if formTransactions < 1000:
-            requestLoops = 1
-        else:
-            requestLoops = math.ceil(formTransactions/1000)
-        transactionsList = []
-        for i in range(requestLoops):
-            logging.info("Requesting transactions " + str(i))
-            page = str(i)
-            transactRequest = requests.post(req_url,
-                                            params=payload,
-                                            data={'Aid':'CSD',
-                                                  'Year':cur_yr,
-                                                  'CurrentPageIndex':page,
-                                                  'PageSize':'1000',
-                                                  'TransactionType':forms['460C'],
-                                                  'ShowSuperceded':'false'})
-            if transactRequest.status_code != 200:
-                return "Transaction request " + str(i) + " failed " + str(transactRequest.status_code)
-            else:
-                logging.info("Transaction request " + str(i) + " success")
-                transactions_json = transactRequest.json()['results']
-                for t in transactions_json:
-                    transactionsList.append(['460', #form
-                                       t['form_Type'], #schedule
-                                       'Non monetary contributions', #schedule_description
-                                       t['filerStateId'], #recipient_id
-                                       t['filerName'], #recipient_name
-                                       t['filingStartDate'], #'date_report_period_from'
-                                       t['filingEndDate'], #'date_report_period_to'
-                                       t['entity_Cd'], #'contributor_code'
-                                       t['tran_NamL'], #'contributor_last'
-                                       t['tran_NamF'], #'contributor_first'
-                                       t['tran_City'], #'address_city_contributor'
-                                       t['tran_ST'], #'address_state_contributor'
-                                       t['tran_Zip4'], #'address_zip_contributor'
-                                       t['tran_Emp'], #'contributor_emp'
-                                       t['tran_Occ'], #'contributor_occ'
-                                       t['tran_Date'], #'date_contribution'
-                                       t['tran_Amt1'], #'contribution_amount'
-                                       t['tran_Amt2'], #'contribution_annual'
-                                       t['tran_Dscr'], #'contribution_desc'
-                                       t['cmte_Id'], #'contributor_id'
-                                       t['intr_NamL'], #'intermediary_last'
-                                       t['intr_NamF'], #'intermediary_first'
-                                       t['intr_City'], #'address_city_intermediary'
-                                       t['intr_ST'], #'address_state_intermediary'
-                                       t['intr_Zip4'], #'address_zip_intermediary'
-                                       t['intr_Emp'], #'intermediary_emp'
-                                       t['intr_Occ'], #'intermediary_occ'
-                                       t['filingId'],
-                                         cur_yr])
-
-        campaignTransactions = pd.DataFrame(transactionsList,columns=prod_columns)
-        logging.info("Writing 460C transactions to temp")
-        general.pos_write_csv(
-            campaignTransactions,
-            save_path,
-            date_format="%Y-%m-%d %H:%M:%S")
-    else:
-        return "Count request failed " + str(countRequest.status_code)
-        
-    return "Created 460C transactions " + str(formTransactions)
+    raw = get_form_transactions('460C')
+    campaignTransactions = map_fields(raw,
+        contrib_fields,
+        prod_columns,
+        form='460',
+        schedule_description='Non monetary contributions',
+        year_report=cur_yr)
+
+    return write_transactions(campaignTransactions,
+        conf['temp_data_dir'] + '/schedule_460c.csv',
+        '460C')
 
 def get_transactions_d():
     """ Requesting transactions for schedule 460D """
@@ -334,95 +233,21 @@ def get_transactions_d():
     # Getting transactions for Form 460, Schedule D
     # Which contain semi-annual and pre-election reporting
 
-    save_path = conf['temp_data_dir'] + '/schedule_460d.csv'
-    req_url = "https://netfile.com:443/" \
-                + "Connect2/api/public/" \
-                + "campaign/export/cal201/" \
-                + "transaction/year"
-    logging.info("Requesting number of transactions")
-    countRequest = requests.post(req_url,
-                                params=payload,
-                                data = {'Aid':'CSD',
-                                        'Year':cur_yr,
-                                        'CurrentPageIndex':0,
-                                        'PageSize':'1',
-                                        'TransactionType':forms['460D'],
-                                        'ShowSuperceded':'false'})
-    if countRequest.status_code == 200:
-        formTransactions = countRequest.json()['totalMatchingCount']
-        if formTransactions < 1000:
-            requestLoops = 1
-        else:
-            requestLoops = math.ceil(formTransactions/1000)
-        transactionsList = []
-        for i in range(requestLoops):
-            logging.info("Requesting transactions " + str(i))
-            page = str(i)
-            transactRequest = requests.post(req_url,
-                                            params=payload,
-                                            data={'Aid':'CSD',
-                                                  'Year':cur_yr,
-                                                  'CurrentPageIndex':page,
-                                                  'PageSize':'1000',
-                                                  'TransactionType':forms['460D'],
-                                                  'ShowSuperceded':'false'})
-            if transactRequest.status_code != 200:
-                return "Transaction request " + str(i) + " failed " + str(transactRequest.status_code)
-            else:
-                logging.info("Transaction request " + str(i) + " success")
-                transactions_json = transactRequest.json()['results']
-                for t in transactions_json:
-                    if t['sup_Opp_Cd'] == 'S':
-                        candName = t['cand_NamF']+' '+t['cand_NamL']
-                        balName = t['bal_Name']
-                        otherNameF = t['tran_NamF']
-                        otherNameL = t['tran_NamL']
-                        if balName != '':
-                            fullName = balName
-                        elif candName != ' ':
-                            fullName = candName.strip()
-                        else:
-                            fullName = otherNameL
-                    transactionsList.append(['460', #form
-                                       t['form_Type'], #schedule
-                                       'Independent expenditures in support', #schedule_description
-                                       t['cmte_Id'], #recipient_id
-                                       fullName, #recipient_name
-                                       t['filingStartDate'], #'date_report_period_from'
-                                       t['filingEndDate'], #'date_report_period_to'
-                                       ' ', #'contributor_code'
-                                       t['filerName'], #'contributor_last'
-                                       ' ', #'contributor_first'
-                                       ' ', #'address_city_contributor'
-                                       ' ', #'address_state_contributor'
-                                       ' ', #'address_zip_contributor'
-                                       ' ', #'contributor_emp'
-                                       ' ', #'contributor_occ'
-                                       t['tran_Date'], #'date_contribution'
-                                       t['tran_Amt1'], #'contribution_amount'
-                                       t['tran_Amt2'], #'contribution_annual'
-                                       t['tran_Dscr'], #'contribution_desc'
-                                       t['filerStateId'], #'contributor_id'
-                                       t['intr_NamL'], #'intermediary_last'
-                                       t['intr_NamF'], #'intermediary_first'
-                                       t['intr_City'], #'address_city_intermediary'
-                                       t['intr_ST'], #'address_state_intermediary'
-                                       t['intr_Zip4'], #'address_zip_intermediary'
-                                       t['intr_Emp'], #'intermediary_emp'
-                                       t['intr_Occ'], #'intermediary_occ'
-                                       t['filingId'],
-                                         cur_yr])
-
-        campaignTransactions = pd.DataFrame(transactionsList,columns=prod_columns)
-        logging.info("Writing 460D transactions to temp")
-        general.pos_write_csv(
-            campaignTransactions,
-            save_path,
-            date_format="%Y-%m-%d %H:%M:%S")
-    else:
-        return "Count request failed " + str(countRequest.status_code)
-        
-    return "Created 460D transactions " + str(formTransactions)
+    raw = get_form_transactions('460D')
+
+    if not raw.empty:
+        raw = add_full_name(raw)
+
+    campaignTransactions = map_fields(raw,
+        expenditure_fields,
+        prod_columns,
+        form='460',
+        schedule_description='Independent expenditures in support',
+        year_report=cur_yr)
+
+    return write_transactions(campaignTransactions,
+        conf['temp_data_dir'] + '/schedule_460d.csv',
+        '460D')
 
 def get_transactions_summary():
     """ Requesting transactions for schedule 460, summary page """
@@ -431,94 +256,25 @@ def get_transactions_summary():
     # Which contain semi-annual and pre-election reporting
     # Summary page includes unitemized contribs
 
-    save_path = conf['temp_data_dir'] + '/schedule_460sum.csv'
-    req_url = "https://netfile.com:443/" \
-                + "Connect2/api/public/" \
-                + "campaign/export/cal201/" \
-                + "summary/year"
-    logging.info("Requesting number of transactions")
-    countRequest = requests.post(req_url,
-                                params=payload,
-                                data = {'Aid':'CSD',
-                                        'Year':cur_yr,
-                                        'CurrentPageIndex':0,
-                                        'PageSize':'1',
-                                        'ShowSuperceded':'false'})
-    if countRequest.status_code == 200:
-        formTransactions = countRequest.json()['totalMatchingCount']
-        if formTransactions < 1000:
-            requestLoops = 1
-        else:
-            requestLoops = math.ceil(formTransactions/1000)
-        transactionsList = []
-        for i in range(requestLoops):
-            logging.info("Requesting transactions " + str(i))
-            page = str(i)
-            transactRequest = requests.post(req_url,
-                                            params=payload,
-                                            data={'Aid':'CSD',
-                                                  'Year':cur_yr,
-                                                  'CurrentPageIndex':page,
-                                                  'PageSize':'1000',
-                                                  'ShowSuperceded':'false'})
-            if transactRequest.status_code != 200:
-                return "Transaction request " + str(i) + " failed " + str(transactRequest.status_code)
-            else:
-                logging.info("Transaction request " + str(i) + " success")
-                transactions_json = transactRequest.json()['results']
-                num_transactions = 0
-                for t in transactions_json:
-                    if t['form_Type'] == 'A' or t['form_Type'] == 'C':
-                        if t['line_Item'] == '2':
-                            num_transactions += 1
-                            if t['form_Type'] == 'A':
-                                description = 'Unitemized monetary contributions less than $100'
-                                schedule = 'SMRY A'
-                            elif t['form_Type'] == 'C':
-                                description = 'Unitemized nonmonetary contributions less than $100'
-                                schedule = 'SMRY C'
-                            transactionsList.append(['460', #form
-                                           schedule, #schedule
-                                           description, #schedule_description
-                                           t['filerStateId'], #recipient_id
-                                           t['filerName'], #recipient_name
-                                           t['filingStartDate'], #'date_report_period_from'
-                                           t['filingEndDate'], #'date_report_period_to'
-                                           ' ', #'contributor_code'
-                                           ' ', #'contributor_last'
-                                           ' ', #'contributor_first'
-                                           ' ', #'address_city_contributor'
-                                           ' ', #'address_state_contributor'
-                                           ' ', #'address_zip_contributor'
-                                           ' ', #'contributor_emp'
-                                           ' ', #'contributor_occ'
-                                           ' ', #'date_contribution'
-                                           t['amount_A'], #'contribution_amount'
-                                           t['amount_B'], #'contribution_annual'
-                                           ' ', #'contribution_desc'
-                                           ' ', #'contributor_id'
-                                           ' ', #'intermediary_last'
-                                           ' ', #'intermediary_first'
-                                           ' ', #'address_city_intermediary'
-                                           ' ', #'address_state_intermediary'
-                                           ' ', #'address_zip_intermediary'
-                                           ' ', #'intermediary_emp'
-                                           ' ', #'intermediary_occ'
-                                           t['filingId'],
-                                             cur_yr])
-
-        campaignTransactions = pd.DataFrame(transactionsList,columns=prod_columns)
-
-        logging.info("Writing 460 summary transactions to temp")
-        general.pos_write_csv(
-            campaignTransactions,
-            save_path,
-            date_format="%Y-%m-%d %H:%M:%S")
-
-    else:
-        return "Count request failed " + str(countRequest.status_code)
-        
-    return "Created 460 summary transactions " + str(num_transactions)
+    raw = get_form_transactions(None, endpoint='summary/year')
+
+    if not raw.empty:
+        raw = raw[raw['form_Type'].isin(['A','C']) & (raw['line_Item'] == '2')]
+        raw = raw.assign(
+            schedule='SMRY ' + raw['form_Type'],
+            description=raw['form_Type'].map({
+                'A':'Unitemized monetary contributions less than $100',
+                'C':'Unitemized nonmonetary contributions less than $100'}))
+
+    campaignTransactions = map_fields(raw,
+        summary_fields,
+        prod_columns,
+        form='460',
+        year_report=cur_yr)
+
+    return write_transactions(campaignTransactions,
+        conf['temp_data_dir'] + '/schedule_460sum.csv',
+        '460 summary')
 
 def get_transactions_497():
     """ Requesting transactions for 497 """
@@ -527,91 +283,21 @@ def get_transactions_497():
     # Which contain transactions in between semi-annual,
     # pre-election reports
 
-    date_checks_max = pd.read_csv(conf['temp_data_dir'] + '/date_checks_max.csv')
-    save_path = conf['temp_data_dir'] + '/schedule_497.csv'
-    req_url = "https://netfile.com:443/" \
-                + "Connect2/api/public/" \
-                + "campaign/export/cal201/" \
-                + "transaction/year"
-    logging.info("Requesting number of transactions")
-    countRequest = requests.post(req_url,
-                                params=payload,
-                                data = {'Aid':'CSD',
-                                        'Year':cur_yr,
-                                        'CurrentPageIndex':0,
-                                        'PageSize':'1',
-                                        'TransactionType':forms['497P1'],
-                                        'ShowSuperceded':'false'})
-    if countRequest.status_code == 200:
-        formTransactions = countRequest.json()['totalMatchingCount']
-        if formTransactions < 1000:
-            requestLoops = 1
-        else:
-            requestLoops = math.ceil(formTransactions/1000)
-        transactionsList = []
-        for i in range(requestLoops):
-            logging.info("Requesting transactions " + str(i))
-            page = str(i)
-            transactRequest = requests.post(req_url,
-                                            params=payload,
-                                            data={'Aid':'CSD',
-                                                  'Year':cur_yr,
-                                                  'CurrentPageIndex':page,
-                                                  'PageSize':'1000',
-                                                  'TransactionType':forms['497P1'],
-                                                  'ShowSuperceded':'false'})
-            if transactRequest.status_code != 200:
-                return "Transaction request " + str(i) + " failed " + str(transactRequest.status_code)
-            else:
-                logging.info("Transaction request " + str(i) + " success")
-                transactions_json = transactRequest.json()['results']
-                num_transactions = 0
-                for t in transactions_json:
-                    transaction_date = pd.to_datetime(t['tran_Date'])
-                    for i, row in date_checks_max.iterrows():
-                        if row[0] == t['filerStateId'] and row[0] != "Pending":
-                            if transaction_date > pd.to_datetime(row[1]):
-                                num_transactions += 1
-                                transactionsList.append(['497', #form
-                                       t['form_Type'], #schedule
-                                       '24-hr contribution report', #schedule_description
-                                       t['filerStateId'], #recipient_id
-                                       t['filerName'], #recipient_name
-                                       t['filingStartDate'], #'date_report_period_from'
-                                       t['filingEndDate'], #'date_report_period_to'
-                                       t['entity_Cd'], #'contributor_code'
-                                       t['tran_NamL'], #'contributor_last'
-                                       t['tran_NamF'], #'contributor_first'
-                                       t['tran_City'], #'address_city_contributor'
-                                       t['tran_ST'], #'address_state_contributor'
-                                       t['tran_Zip4'], #'address_zip_contributor'
-                                       t['tran_Emp'], #'contributor_emp'
-                                       t['tran_Occ'], #'contributor_occ'
-                                       t['tran_Date'], #'date_contribution'
-                                       t['tran_Amt1'], #'contribution_amount'
-                                       t['tran_Amt2'], #'contribution_annual'
-                                       t['tran_Dscr'], #'contribution_desc'
-                                       t['cmte_Id'], #'contributor_id'
-                                       t['intr_NamL'], #'intermediary_last'
-                                       t['intr_NamF'], #'intermediary_first'
-                                       t['intr_City'], #'address_city_intermediary'
-                                       t['intr_ST'], #'address_state_intermediary'
-                                       t['intr_Zip4'], #'address_zip_intermediary'
-                                       t['intr_Emp'], #'intermediary_emp'
-                                       t['intr_Occ'], #'intermediary_occ'
-                                       t['filingId'],
-                                         cur_yr])
-
-        campaignTransactions = pd.DataFrame(transactionsList,columns=prod_columns)
-        logging.info("Writing 497 24-hr transactions to temp")
-        general.pos_write_csv(
-            campaignTransactions,
-            save_path,
-            date_format="%Y-%m-%d %H:%M:%S")
-    else:
-        return "Count request failed " + str(countRequest.status_code)
-        
-    return "Created 497 24-hr transactions " + str(num_transactions)
+    raw = get_form_transactions('497P1')
+
+    if not raw.empty:
+        raw = filter_after_max_date(raw)
+
+    campaignTransactions = map_fields(raw,
+        contrib_fields,
+        prod_columns,
+        form='497',
+        schedule_description='24-hr contribution report',
+        year_report=cur_yr)
+
+    return write_transactions(campaignTransactions,
+        conf['temp_data_dir'] + '/schedule_497.csv',
+        '497 24-hr')
 
 def get_transactions_496():
     """ Requesting transactions for 496 """
@@ -620,104 +306,21 @@ def get_transactions_496():
     # Which contain transactions in between semi-annual,
     # pre-election reports
 
-    date_checks_max = pd.read_csv(conf['temp_data_dir'] + '/date_checks_max.csv')
-    save_path = conf['temp_data_dir'] + '/schedule_496.csv'
-    req_url = "https://netfile.com:443/" \
-                + "Connect2/api/public/" \
-                + "campaign/export/cal201/" \
-                + "transaction/year"
-    logging.info("Requesting number of transactions")
-    countRequest = requests.post(req_url,
-                                params=payload,
-                                data = {'Aid':'CSD',
-                                        'Year':cur_yr,
-                                        'CurrentPageIndex':0,
-                                        'PageSize':'1',
-                                        'TransactionType':forms['496'],
-                                        'ShowSuperceded':'false'})
-    if countRequest.status_code == 200:
-        formTransactions = countRequest.json()['totalMatchingCount']
-        if formTransactions < 1000:
-            requestLoops = 1
-        else:
-            requestLoops = math.ceil(formTransactions/1000)
-        transactionsList = []
-        for i in range(requestLoops):
-            logging.info("Requesting transactions " + str(i))
-            page = str(i)
-            transactRequest = requests.post(req_url,
-                                            params=payload,
-                                            data={'Aid':'CSD',
-                                                  'Year':cur_yr,
-                                                  'CurrentPageIndex':page,
-                                                  'PageSize':'1000',
-                                                  'TransactionType':forms['496'],
-                                                  'ShowSuperceded':'false'})
-            if transactRequest.status_code != 200:
-                return "Transaction request " + str(i) + " failed " + str(transactRequest.status_code)
-            else:
-                logging.info("Transaction request " + str(i) + " success")
-                transactions_json = transactRequest.json()['results']
-                num_transactions = 0
-                for t in transactions_json:
-                    if t['sup_Opp_Cd'] == 'S':
-                        candName = t['cand_NamF']+' '+t['cand_NamL']
-                        balName = t['bal_Name']
-                        otherNameF = t['tran_NamF']
-                        otherNameL = t['tran_NamL']
-                        if balName != '':
-                            fullName = balName
-                        elif candName != ' ':
-                            fullName = candName.strip()
-                        else:
-                            fullName = otherNameL
-
-                    # Create row
-                    transaction_date = pd.to_datetime(t['tran_Date'])
-                    for i, row in date_checks_max.iterrows():
-                        if row[0] == t['filerStateId'] and row[0] != "Pending":
-                            if transaction_date > pd.to_datetime(row[1]):
-                                num_transactions += 1
-                                transactionsList.append(['496', #form
-                                       t['form_Type'], #schedule
-                                       'Independent expenditures in support', #schedule_description
-                                       t['cmte_Id'], #recipient_id
-                                       fullName, #recipient_name
-                                       t['filingStartDate'], #'date_report_period_from'
-                                       t['filingEndDate'], #'date_report_period_to'
-                                       ' ', #'contributor_code'
-                                       t['filerName'], #'contributor_last'
-                                       ' ', #'contributor_first'
-                                       ' ', #'address_city_contributor'
-                                       ' ', #'address_state_contributor'
-                                       ' ', #'address_zip_contributor'
-                                       ' ', #'contributor_emp'
-                                       ' ', #'contributor_occ'
-                                       t['tran_Date'], #'date_contribution'
-                                       t['tran_Amt1'], #'contribution_amount'
-                                       t['tran_Amt2'], #'contribution_annual'
-                                       t['tran_Dscr'], #'contribution_desc'
-                                       t['filerStateId'], #'contributor_id'
-                                       t['intr_NamL'], #'intermediary_last'
-                                       t['intr_NamF'], #'intermediary_first'
-                                       t['intr_City'], #'address_city_intermediary'
-                                       t['intr_ST'], #'address_state_intermediary'
-                                       t['intr_Zip4'], #'address_zip_intermediary'
-                                       t['intr_Emp'], #'intermediary_emp'
-                                       t['intr_Occ'], #'intermediary_occ'
-                                       t['filingId'],
-                                         cur_yr])
-
-        campaignTransactions = pd.DataFrame(transactionsList,columns=prod_columns)
-        logging.info("Writing 496 24-hr transactions to temp")
-        general.pos_write_csv(
-            campaignTransactions,
-            save_path,
-            date_format="%Y-%m-%d %H:%M:%S")
-    else:
-        return "Count request failed " + str(countRequest.status_code)
-        
-    return "Created 496 24-hr transactions " + str(num_transactions)
+    raw = get_form_transactions('496')
+
+    if not raw.empty:
+        raw = filter_after_max_date(add_full_name(raw))
+
+    campaignTransactions = map_fields(raw,
+        expenditure_fields,
+        prod_columns,
+        form='496',
+        schedule_description='Independent expenditures in support',
+        year_report=cur_yr)
+
+    return write_transactions(campaignTransactions,
+        conf['temp_data_dir'] + '/schedule_496.csv',
+        '496 24-hr')
 
 def combine_all_schedules():
   """ Transactions combined into one file for year-to-date """
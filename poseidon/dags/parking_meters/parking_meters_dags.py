@@ -47,6 +47,8 @@ build_prod_file = PythonOperator(
     dag=dag)
 
 #: Create aggregation files
+#: Sunday runs verify them against a full recompute
+#: Trigger with {"agg_mode": "full"} to rebuild them
 build_curr_agg = SubDagOperator(
     task_id='create_curr_agg',
     subdag=create_current_subdag(run_year),
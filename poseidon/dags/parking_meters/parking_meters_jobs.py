@@ -6,6 +6,8 @@ import glob
 import logging
 from datetime import datetime, timedelta, date
 from trident.util import general
+from trident.util.partitioned_store import PartitionedStore, year_partition
+from trident.util.partitioned_store import NULL_LABEL
 from subprocess import Popen, PIPE, check_output
 import subprocess
 from shlex import quote
@@ -15,6 +17,23 @@ from airflow.hooks.base_hook import BaseHook
 conf = general.config
 portal_fname = f"{conf['prod_data_dir']}/treas_parking_payments_"
 
+
+agg_keys = {'pole_by_month': ['pole_id', 'month'],
+            'pole_by_mo_day': ['pole_id', 'month', 'day']}
+
+agg_modes = ['incremental', 'verify', 'full']
+
+# ISO weekday of the run that verifies aggregations, Sunday
+verify_weekday = 7
+
+
+def meters_store():
+    """Return the year partitioned store of meter transactions."""
+    return PartitionedStore('treas_parking_payments',
+                            partition=year_partition('date_trans_start'),
+                            journal=True)
+
+
 def download_latest(**context):
     """
     Download parking meters data from FTP.
@@ -53,6 +72,10 @@ def download_latest(**context):
 def build_prod_file(year=2020,**context):
     """Process parking meters data."""
 
+    # Aggregation subdags have their own dag run, so pass the mode
+    context['task_instance'].xcom_push(key='agg_mode',
+                                       value=aggregation_mode(**context))
+
     date_parts = context['task_instance'].xcom_pull(task_ids='get_parking_files')
     
     filename = f"{date_parts[0]}" \
@@ -113,90 +136,50 @@ def build_prod_file(year=2020,**context):
     curr_yr = date_parts[0]
     last_yr = curr_yr - 1
 
-    curr_set = update[update['date_trans_start'] >= f"01/01/{curr_yr} 00:00:00"]
-    last_set = update[(update['date_trans_start'] < f"01/01/{curr_yr} 00:00:00") &
-                      (update['date_trans_start'] >= f"01/01/{last_yr} 00:00:00")]
-
-    if curr_set.empty:
-
-        logging.info("Transactions not available for current year")
+    update = update[update['date_trans_start'] >= f"01/01/{last_yr} 00:00:00"]
 
-        context['task_instance'].xcom_push(key='agg', value=False)
-
-        if not last_set.empty:
-
-            logging.info("Need to add records to previous year")
-
-            context['task_instance'].xcom_push(key='year', value=True)
-
-            last_prod = f"{portal_fname}{last_yr}_datasd_v2.csv"
-
-            portal = pd.read_csv(last_prod,
-                low_memory=False,
-                error_bad_lines=False,)
-            logging.info("Concatenating update + portal")
-            portal_up = pd.concat([portal, last_set])
-
-            general.pos_write_csv(
-                portal_up,
-                last_prod,
-                date_format="%Y-%m-%d %H:%M:%S")
-
-    else:
-    
-        logging.info(f"Adding {curr_set.shape[0]} records to {curr_yr}")
+    store = meters_store()
 
-        context['task_instance'].xcom_push(key='agg', value=True)
+    if store.is_empty():
+        for yr in [last_yr, curr_yr]:
+            prod_file = f"{portal_fname}{yr}_datasd_v2.csv"
+            if os.path.isfile(prod_file):
+                logging.info(f"Seeding store from {yr} file")
+                portal = pd.read_csv(prod_file,
+                    low_memory=False,
+                    error_bad_lines=False,
+                    parse_dates=['date_trans_start','date_meter_expire'])
+                store.append(portal, os.path.basename(prod_file))
 
-        curr_prod = f"{portal_fname}{curr_yr}_datasd_v2.csv"
+    # Transactions have no id, so every row of a new file is kept
+    changed = store.append(update, fpath)
 
-        logging.info(f"Appending to file for {curr_yr}")
+    for yr, portal_up in changed.items():
 
-        if os.path.isfile(curr_prod):
-            logging.info(f"Found {curr_yr} file")
-            portal = pd.read_csv(curr_prod,
-                low_memory=False,
-                error_bad_lines=False,)
-            logging.info(f"Prod file has {portal.shape[0]} records")
-            portal_up = pd.concat([portal, curr_set])
+        if yr == NULL_LABEL:
+            continue
 
-        else:
-            logging.info(f"Did not find {curr_yr} file")
-            logging.info(f"Starting a new file for {curr_yr}")
-            portal_up = curr_set
+        logging.info(f"Writing {portal_up.shape[0]} records to {yr} file")
 
-        
         general.pos_write_csv(
             portal_up,
-            curr_prod,
+            f"{portal_fname}{yr}_datasd_v2.csv",
             date_format="%Y-%m-%d %H:%M:%S")
 
-        if not last_set.empty:
-
-            logging.info("Need to add records to previous year")
-
-            context['task_instance'].xcom_push(key='year', value=True)
-
-            last_prod = f"{portal_fname}{last_yr}_datasd_v2.csv"
-
-            portal = pd.read_csv(last_prod,
-                low_memory=False,
-                error_bad_lines=False,
-                )
-            logging.info("Concatenating update + portal")
-            portal_up = pd.concat([portal, last_set])
-
-            general.pos_write_csv(
-                portal_up,
-                last_prod,
-                date_format="%Y-%m-%d %H:%M:%S")
-
-        else:
+    if curr_yr in changed:
+        logging.info(f"Added records to {curr_yr}")
+        context['task_instance'].xcom_push(key='agg', value=True)
+    else:
+        logging.info("Transactions not available for current year")
+        context['task_instance'].xcom_push(key='agg', value=False)
 
-            context['task_instance'].xcom_push(key='year', value=False)
+    if last_yr in changed:
+        logging.info("Added records to previous year")
+        context['task_instance'].xcom_push(key='year', value=True)
+    else:
+        context['task_instance'].xcom_push(key='year', value=False)
 
-     
-        return "Successfully built prod file"
+    return "Successfully built prod file"
 
 def check_year(**context):
     """
@@ -220,45 +203,116 @@ def check_agg(**context):
     else:
         return "check_for_last_year"
 
-def build_aggregation(agg_type="pole_by_month", agg_year=2020, **context):
-    """Aggregate raw production data by month/day."""
+def aggregate_transactions(df, agg_type):
+    """Sum and count transactions by pole and date parts."""
+    df = df.assign(month=df.date_trans_start.dt.month,
+                   day=df.date_trans_start.dt.day)
 
-    out_fname = f'treas_meters_{agg_year}_{agg_type}_datasd_v2.csv'
+    grouped = df.groupby(agg_keys[agg_type])
 
+    return grouped['trans_amt'].agg(sum_trans_amt='sum',
+                                    num_trans='count')
+
+def full_aggregation(agg_type, agg_year):
+    """Aggregate the full year from the portal file."""
     logging.info(f"Reading portal data {agg_year}")
     portal = pd.read_csv(f"{portal_fname}{agg_year}_datasd_v2.csv",
         low_memory=False,
         parse_dates=['date_trans_start']
         )
 
-    logging.info("Translate start_date to dt, create agg columns")
+    return aggregate_transactions(portal, agg_type)
 
-    portal['month'] = portal.date_trans_start.dt.month
-    portal['day'] = portal.date_trans_start.dt.day
+def aggregation_mode(**context):
+    """Return the build_aggregation mode of a run.
 
-    logging.info(f"Creating {agg_type} aggregation")
-    if agg_type == 'pole_by_month':
-        grouped = portal.groupby(['pole_id', 'month'],
-                                 as_index=False)
+    A triggered run can set it with {"agg_mode": "full"} in
+    its conf. Otherwise runs on verify_weekday verify, and
+    all others are incremental.
+    """
+    dag_run = context.get('dag_run')
+    run_conf = dag_run.conf if dag_run is not None and dag_run.conf else {}
+
+    if 'agg_mode' in run_conf:
+        mode = run_conf['agg_mode']
+        if mode not in agg_modes:
+            raise AirflowException(f"Unknown agg_mode {mode}, "
+                                   f"expected one of {agg_modes}")
+        return mode
+
+    if context['next_execution_date'].isoweekday() == verify_weekday:
+        return 'verify'
+
+    return 'incremental'
+
+def build_aggregation(agg_type="pole_by_month",
+                      agg_year=2020,
+                      mode=None,
+                      **context):
+    """Aggregate raw production data by month/day.
+
+    In incremental mode only transactions appended since the
+    last run are folded into the saved sums and counts. Full
+    mode recomputes from the portal file. Verify mode runs
+    incrementally and fails if the result differs from a
+    full recompute. Without a mode, the one build_prod_file
+    picked for the run is used.
+    """
 
-        aggregation = grouped['trans_amt'].agg({
-                                                'sum_trans_amt': 'sum',
-                                                'num_trans': 'count'
-                                              })
-    elif agg_type == 'pole_by_mo_day':
-        grouped = portal.groupby(['pole_id', 'month', 'day'],
-                                 as_index=False)
+    if mode is None:
+        mode = context['task_instance'].xcom_pull(dag_id='parking_meters',
+                                                  task_ids='build_prod_file',
+                                                  key='agg_mode')
+        mode = mode or 'incremental'
+    logging.info(f"Building {agg_type} for {agg_year} in {mode} mode")
 
-        aggregation = grouped['trans_amt'].agg({
-                                                'sum_trans_amt': 'sum',
-                                                'num_trans': 'count'
-                                              })
+    out_fname = f'treas_meters_{agg_year}_{agg_type}_datasd_v2.csv'
+    state_dir = general.create_path_if_not_exists(
+        f"{conf['cache_dir']}/parking_meters")
+    state_path = f"{state_dir}/treas_meters_{agg_year}_{agg_type}.pkl"
+
+    store = meters_store()
+    rows = store.partition_size(agg_year)
+    aggregation = None
+
+    if mode != 'full' and os.path.isfile(state_path):
+        state = pd.read_pickle(state_path)
+        delta = store.read_delta(agg_year, state['rows'])
+
+        if delta is None:
+            logging.info("Journal does not cover last run, recomputing")
+        elif delta.empty:
+            logging.info("No new transactions since last run")
+            aggregation = state['agg']
+        else:
+            logging.info(f"Folding {delta.shape[0]} new transactions "
+                         f"into {agg_type}")
+            update = aggregate_transactions(delta, agg_type)
+            aggregation = state['agg'].add(update, fill_value=0)
+            aggregation = aggregation.sort_index().astype('int64')
+            logging.info(f"Updated {update.shape[0]} of "
+                         f"{aggregation.shape[0]} rows")
+
+    if aggregation is None:
+        logging.info(f"Creating {agg_type} aggregation")
+        aggregation = full_aggregation(agg_type, agg_year)
+
+    elif mode == 'verify':
+        logging.info("Verifying against full recompute")
+        expected = full_aggregation(agg_type, agg_year)
+        if not expected.equals(aggregation):
+            raise AirflowException(f"Incremental {agg_type} for {agg_year} "
+                                   "does not match full recompute, "
+                                   "trigger with agg_mode full to rebuild")
+        logging.info("Incremental aggregation matches")
+
+    pd.to_pickle({'rows': rows, 'agg': aggregation}, state_path)
 
     new_file_path = f"{conf['prod_data_dir']}/{out_fname}"
 
     logging.info(f"Writing {agg_type} aggregation")
     general.pos_write_csv(
-        aggregation,
+        aggregation.reset_index(),
         new_file_path,
         date_format="%Y-%m-%d %H:%M:%S")
 
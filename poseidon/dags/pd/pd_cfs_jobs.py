@@ -7,11 +7,22 @@ import subprocess
 import glob
 from subprocess import Popen, PIPE
 from trident.util import general
+from trident.util.partitioned_store import PartitionedStore, year_partition
+from trident.util.partitioned_store import NULL_LABEL
 from shlex import quote
 from airflow.hooks.base_hook import BaseHook
 
 conf = general.config
 
+
+def cfs_store():
+    """Return the year partitioned store of calls for service."""
+    return PartitionedStore('pd_calls_for_service',
+                            partition=year_partition('date_time'),
+                            key=['incident_num'],
+                            sort_by='date_time')
+
+
 def get_cfs_data(**context):
     """Download daily raw cfs data from FTP."""
 
@@ -73,15 +84,22 @@ def process_cfs_data(**context):
     'day_of_week':str
     }
 
-    logging.info('Adding recent data to CFS production file.')
-    curr_frame = pd.read_csv(
-        f"{conf['prod_data_dir']}/pd_calls_for_service.csv",
-        parse_dates=['date_time'],
-        dtype=dtypes,
-        low_memory=False
-        )
+    logging.info('Loading CFS production store')
+    store = cfs_store()
+
+    if store.is_empty():
+        logging.info('Seeding store from CFS production file')
+        curr_frame = pd.read_csv(
+            f"{conf['prod_data_dir']}/pd_calls_for_service.csv",
+            parse_dates=['date_time'],
+            dtype=dtypes,
+            low_memory=False
+            )
+        store.merge(curr_frame)
+        col_names = curr_frame.columns.values
+    else:
+        col_names = store.read_partition(store.partitions()[-1]).columns.values
 
-    col_names = curr_frame.columns.values
     temp_frame.columns = col_names
 
     logging.info('Fixing dtypes')
@@ -92,49 +110,28 @@ def process_cfs_data(**context):
     for str_col in dtypes.keys():
         temp_frame.loc[:,str_col] = temp_frame.loc[:,str_col].astype(str)
 
-    logging.info('Appending new records to existing file')
+    logging.info('Merging new records into store')
 
-    prod_frame = curr_frame.append(temp_frame, ignore_index=True)
-    logging.info(f'New file has {prod_frame.shape[0]} records')
-    prod_frame = prod_frame.drop_duplicates(subset=['incident_num'])
-    logging.info(f'After dedupe, file has {prod_frame.shape[0]} records')
-    prod_frame = prod_frame.sort_values(by='date_time', ascending=True)
+    changed = store.merge(temp_frame)
 
-    logging.info('Exporting full data to csv')
+    # Full file seeds the store again if the cache is lost
+    logging.info('Writing full CFS file')
 
-    prod_file = f"{conf['prod_data_dir']}/pd_calls_for_service.csv"
-    
-    general.pos_write_csv(
-        prod_frame,
-        prod_file,
+    store.write_combined_csv(
+        f"{conf['prod_data_dir']}/pd_calls_for_service.csv",
+        changed,
         date_format="%Y-%m-%d %H:%M:%S")
 
-    logging.info('Splitting off CY files')
-
-    min_yr = temp_frame['date_time'].min().year
-    max_yr = temp_frame['date_time'].max().year
-
-    if min_yr != max_yr:
+    logging.info('Writing CY files')
 
-        for i in range(min_yr,max_yr+1):
-            
-            logging.info(f'Writing new file for {i}')
-            
-            yr_subset = prod_frame[(prod_frame['date_time'] >= f'01-01-{i} 00:00:00') &
-                (prod_frame['date_time'] < f'01-01-{i+1} 00:00:00')]
+    for yr, yr_subset in changed.items():
 
-            yr_file = f"{conf['prod_data_dir']}/pd_calls_for_service_{i}_datasd.csv"
-
-            general.pos_write_csv(
-                yr_subset,
-                yr_file,
-                date_format="%Y-%m-%d %H:%M:%S")
-
-    else:
+        if yr == NULL_LABEL:
+            continue
 
-        yr_file = f"{conf['prod_data_dir']}/pd_calls_for_service_{max_yr}_datasd.csv"
+        logging.info(f'Writing new file for {yr}')
 
-        yr_subset = prod_frame[(prod_frame['date_time'] >= f'01-01-{max_yr} 00:00:00')]
+        yr_file = f"{conf['prod_data_dir']}/pd_calls_for_service_{yr}_datasd.csv"
 
         general.pos_write_csv(
             yr_subset,
@@ -10,11 +10,19 @@ import subprocess
 from shlex import quote
 import logging
 from trident.util import general
+from trident.util.partitioned_store import PartitionedStore, range_partition
 from airflow.hooks.base_hook import BaseHook
 
 conf = general.config
 
 
+def ripa_store(mode):
+    """Return the stop id partitioned store of one RIPA file."""
+    return PartitionedStore(f'ripa_{mode}',
+                            partition=range_partition('stop_id', 100000),
+                            sort_by=['stop_id','pid'])
+
+
 def get_data():
     """Download RIPA data from FTP."""
 
@@ -101,28 +109,17 @@ def process_prod_files(mode='stops',**context):
         f"{conf['temp_data_dir']}/ripa_{mode}.csv",
         low_memory=False
         )
-    cols = new_df.columns.to_list()
-    logging.info(f"Reading in prod {mode} file")
+    store = ripa_store(mode)
 
-    try:
+    if store.is_empty() and os.path.isfile(outfile):
         prod_df = pd.read_csv(outfile,low_memory=False)
-        logging.info(f'Prod file found with {prod_df.shape[0]} rows')
-    
-    except Exception as e:
-        prod_df = pd.DataFrame(columns=cols)        
-        logging.info(f'No prod file found for {mode}. Creating from new data.....')
-    
+        logging.info(f'Seeding store from prod file with {prod_df.shape[0]} rows')
+        store.merge(prod_df)
+
+    logging.info("Merging new records into store")
+    changed = store.merge(new_df)
 
-    logging.info("Combining them")
-    df = pd.concat([prod_df,new_df])
-    logging.info(f"Concat has {df.shape} cols & rows")
-    df = df.drop_duplicates()
-    logging.info(f"After dedupe, result has {df.shape} cols & rows")
-    logging.info("Sorting and writing data")
-    df = df.sort_values(['stop_id','pid'])
-
-    general.pos_write_csv(
-        df,
-        outfile)
+    logging.info("Writing data")
+    store.write_combined_csv(outfile, changed)
 
     return f"Successfully created {mode} ripa prod file"
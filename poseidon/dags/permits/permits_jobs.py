@@ -4,7 +4,7 @@ import pandas as pd
 import string
 import numpy as np
 from trident.util import general
-from trident.util.geospatial import spatial_join_pt
+from trident.util.geospatial import spatial_join_pt_multi
 import logging
 from subprocess import Popen, PIPE
 from shlex import quote
@@ -403,8 +403,6 @@ def spatial_joins(pt_file='',**context):
     logging.info(f'Need to get polygons for {missing.shape[0]}')
     logging.info(f"Have polygons for {complete.shape[0]}")
 
-    logging.info("Joining BIDS")
-
     if missing.empty:
 
         logging.info("Do not need any joins. Writing file")
@@ -415,46 +413,18 @@ def spatial_joins(pt_file='',**context):
 
         missing = missing.drop(columns=['bid_name','council_district','zip'])
         
-        bids = spatial_join_pt(missing,
-            f"{conf['prod_data_dir']}/bids_datasd.geojson",
-            lat='lat_job',
-            lon='lng_job')
-
-        bids = bids.drop(['objectid',
-            'long_name',
-            'status',
-            'link'
-            ], axis=1)
-
-        bids = bids.rename(columns={'name':'bid_name'})
-
-        logging.info("Joining council districts")
-
-        cd = spatial_join_pt(bids,
-            f"{conf['prod_data_dir']}/council_districts_datasd.geojson",
+        logging.info("Joining BIDs, council districts and zips")
+
+        zips = spatial_join_pt_multi(missing,
+            [(f"{conf['prod_data_dir']}/bids_datasd.geojson",
+                {'name':'bid_name'}),
+            (f"{conf['prod_data_dir']}/council_districts_datasd.geojson",
+                {'district':'council_district'}),
+            (f"{conf['prod_data_dir']}/zip_codes_datasd.geojson",
+                {'zip':'zip'})],
             lat='lat_job',
             lon='lng_job')
 
-        cd = cd.drop(['objectid',
-            'name',
-            'phone',
-            'website',
-            'perimeter',
-            'area'
-            ],axis=1)
-
-        cd = cd.rename(columns={'district':'council_district'})
-
-        logging.info("Joining ZIPS")
-
-        zips = spatial_join_pt(cd,
-            f"{conf['prod_data_dir']}/zip_codes_datasd.geojson",
-            lat='lat_job',
-            lon='lng_job')
-
-        zips = zips.drop(['objectid',
-            'community'], axis=1)
-
         new_polygon_rows = zips[['approval_id','bid_name','council_district','zip']]
 
         final_polygons = pd.concat([ref_df,new_polygon_rows],ignore_index=True,sort=False)
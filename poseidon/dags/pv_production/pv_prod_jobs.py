@@ -1,3 +1,4 @@
+import os
 import datetime
 import pendulum
 import requests
@@ -5,7 +6,9 @@ import json
 import numpy as np
 import pandas as pd
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from trident.util import general
+from trident.util.partitioned_store import PartitionedStore, month_partition
 from airflow import AirflowException
 from airflow.models import Variable
 from airflow.hooks.base_hook import BaseHook
@@ -70,42 +73,75 @@ def API_to_csv(elem_paths, interval, execution_date):
 	general.pos_write_csv(df_5min, temp_file, index=True, date_format="%Y-%m-%d %H:%M:%S")
 
 #: Helper Function
-def get_data(start_date, end_date, elem_paths, attr, two_hours=False, resolution="raw", fp=None):
+def split_range(start_date, end_date, max_range):
+	"""Split a window into consecutive sub-ranges sharing boundaries."""
+	dates = []
+	start = start_date
+	while start < end_date:
+		end = min(start + max_range, end_date)
+		dates.append((start, end))
+		start = end
+	return dates or [(start_date, end_date)]
+
+#: Helper Function
+def get_data(start_date, end_date, elem_paths, attr, two_hours=False, resolution="raw", fp=None,
+	max_workers=8, rate=5, max_range=datetime.timedelta(days=2)):
 	baseurl = 'https://api.powerfactorscorp.com'
 	headers = {"Ocp-Apim-Subscription-Key": Variable.get("PF_API_KEY_STR")}
 	dataURL = baseurl + '/drive/v2/data'
-	# To store values for each element
-	results = {path: [] for path in elem_paths}
-	dates = [(start_date, end_date)]
+	# Long windows are requested as parallel sub-ranges
+	dates = split_range(start_date, end_date, max_range)
+	session = general.retry_session(pool_size=max_workers)
+	bucket = general.TokenBucket(rate)
 
-	num_vals = 0
 	start_tstamp = start_date.replace(tzinfo=None)
 	end_tstamp = end_date.replace(tzinfo=None)
 	sites = len(elem_paths)
-	logging.info(f"Looping through {sites} sites")
-	for index, path in enumerate(elem_paths): # Loop through each element in list
-		for start, end in dates: # Iterate through list of start and end times
-			body = {"startTime": start,
-					"endTime": end,
-					"resolution": resolution,
-					"attributes": attr,
-					"ids": path}
-			# Use POST to avoid hitting max URL length w/ many params
-			
-			logging.info(f"Sending post request for {index+1}/{sites}")
-			logging.info(headers)
-			try:
-				r = requests.post(dataURL, headers=headers, data=body).json()
-			except requests.exceptions.RequestException as e:
-				logging.info('Request failed with status code {}'.format(e))				
-				raise AirflowException('Request failed with status code {}'.format(e))
-
-			results[path] += r['assets'][0]['attributes'][0]['values'][1:] # Append readings for this time period to list of readings for this element
-
-		num_vals = len(results[path])
+
+	def fetch(request):
+		path, (start, end) = request
+		body = {"startTime": start,
+				"endTime": end,
+				"resolution": resolution,
+				"attributes": attr,
+				"ids": path}
+		# Use POST to avoid hitting max URL length w/ many params
+		bucket.acquire()
+		try:
+			r = session.post(dataURL, headers=headers, data=body, timeout=120)
+			r.raise_for_status()
+		except requests.exceptions.RequestException as e:
+			logging.info('Request failed with status code {}'.format(e))
+			raise AirflowException('Request failed with status code {}'.format(e))
+
+		# Drop the first reading, it is the start of the range
+		values = r.json()['assets'][0]['attributes'][0]['values'][1:]
+		return np.array(values, dtype=float)
+
+	requests_list = [(path, dates_range) for path in elem_paths for dates_range in dates]
+	logging.info(f"Sending {len(requests_list)} requests for {sites} sites "
+		f"in {len(dates)} ranges")
+
+	with ThreadPoolExecutor(max_workers=max_workers) as pool:
+		readings = list(pool.map(fetch, requests_list))
+
+	# Readings come back in request order, site by site
+	num_ranges = len(dates)
+	lengths = {sum(x.shape[0] for x in readings[i:i + num_ranges])
+		for i in range(0, len(readings), num_ranges)}
+	if len(lengths) > 1:
+		raise AirflowException(f"Sites returned different numbers of readings: {lengths}")
+	num_vals = lengths.pop() if lengths else 0
+
+	data = np.empty((num_vals, sites))
+	for index in range(sites):
+		row = 0
+		for values in readings[index * num_ranges:(index + 1) * num_ranges]:
+			data[row:row + values.shape[0], index] = values
+			row += values.shape[0]
 
 	tstamps = pd.date_range(start_tstamp, end_tstamp, periods=num_vals)
-	df_5min = pd.DataFrame(index=tstamps, data=results)
+	df_5min = pd.DataFrame(data, index=tstamps, columns=elem_paths)
 	
 	logging.info(f'API returned {df_5min.shape[0]} rows')
 
@@ -125,19 +161,34 @@ def update_pv_prod(**context):
 	
 	return f"Successfully wrote production files"
 
+#: Helper Function
+def pv_store(prod_file):
+	"""Return the month partitioned store behind a PV prod file."""
+	name = os.path.splitext(os.path.basename(prod_file))[0]
+	return PartitionedStore(name,
+		partition=month_partition('Timestamp'),
+		key=['Timestamp'],
+		sort_by='Timestamp')
+
 #: Helper Function
 def build_production_files(prod_file, temp_file, **context):
-	logging.info("Reading prod and temp files")
-	df_prod = pd.read_csv(prod_file,low_memory=False,index_col=0,parse_dates=True)
+	store = pv_store(prod_file)
+
+	if store.is_empty() and os.path.isfile(prod_file):
+		logging.info("Seeding store from prod file")
+		df_prod = pd.read_csv(prod_file,low_memory=False,index_col=0,parse_dates=True)
+		df_prod.index.name = 'Timestamp'
+		store.upsert(df_prod.round(decimals=3).reset_index())
+
+	logging.info("Reading temp file")
 	df_temp = pd.read_csv(temp_file,low_memory=False,index_col=0,parse_dates=True)
-	df_prod = pd.concat([df_prod,df_temp])
-	# Index is timestamp
-	# Group by timestamp to deduplicate by keeping first
-	df_prod = df_prod.groupby(df_prod.index).first()
-	df_prod = df_prod.round(decimals=3)
-	general.pos_write_csv(df_prod, prod_file, index=True, date_format="%Y-%m-%d %H:%M:%S")
-
-	results = df_prod.shape[0]
+	df_temp.index.name = 'Timestamp'
+	# Timestamp is the key
+	# Stored readings are kept, new ones only fill gaps
+	changed = store.upsert(df_temp.round(decimals=3).reset_index())
+	store.write_combined_csv(prod_file, changed, date_format="%Y-%m-%d %H:%M:%S")
+
+	results = store.index.shape[0]
 	logging.info(f'Writing to production {results} rows in {prod_file}')
 	return f"Successfully wrote prod file with {results} records"
 
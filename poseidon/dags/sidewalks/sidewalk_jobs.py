@@ -7,20 +7,18 @@ import logging
 from airflow.hooks.mssql_hook import MsSqlHook
 import pymssql
 from trident.util import general
+from trident.util import incremental
 
 
 conf = general.config
 
 cond_file = f"{conf['prod_data_dir']}/sidewalk_cond_datasd_v1.csv"
 
+watermark = incremental.Watermark('sidewalk_cond', 'cgLastModified')
 
-def get_sidewalk_data(**kwargs):
-    """Get sidewalk condition data from DB."""
-    sw_query = general.file_to_string('./sql/sidewalk_insp.sql', __file__)
-    sw_conn = MsSqlHook(mssql_conn_id='streets_cg_sql')
-
-    df = sw_conn.get_pandas_df(sw_query)
 
+def prepare_sidewalk_data(df):
+    """Rename and drop query columns for prod."""
     # Rename columns we're keeping
     df = df.rename(columns={
         'sap_id': 'seg_id',
@@ -34,10 +32,25 @@ def get_sidewalk_data(**kwargs):
         'MaxInspect',
         'MaxMod'],axis=1)
 
-    # Write csv
-    logging.info('Writing ' + str(df.shape[0]))
-    
-    general.pos_write_csv(
-       df, cond_file, date_format="%Y-%m-%d")
+    return df
+
+
+def get_sidewalk_data(**kwargs):
+    """Get sidewalk condition data from DB."""
+    sw_query = general.file_to_string('./sql/sidewalk_insp.sql', __file__)
+    sw_conn = MsSqlHook(mssql_conn_id='streets_cg_sql').get_conn()
+
+    try:
+        rows = incremental.extract_incremental(sw_conn,
+            sw_query,
+            cond_file,
+            watermark,
+            key=['seg_id', 'geojoin_id'],
+            transform=prepare_sidewalk_data,
+            date_format="%Y-%m-%d")
+    finally:
+        sw_conn.close()
+
+    logging.info('Writing ' + str(rows))
     
     return "Successfully wrote prod file"
@@ -12,4 +12,5 @@ FROM (
 	[dbo].sidemaingeneral gen
 	LEFT OUTER JOIN [dbo].sideinspections con ON gen.sidemaingeneraloid = con.sidemaingeneraloid ) sq
 
-WHERE cgLastModified = MaxMod and inspectiondate = MaxInspect
\ No newline at end of file
+WHERE cgLastModified = MaxMod and inspectiondate = MaxInspect
+AND MaxMod >= CONVERT(datetime, '$since', 120)
\ No newline at end of file
@@ -6,6 +6,7 @@ import re
 from airflow.hooks.mssql_hook import MsSqlHook
 from trident.util import general
 from trident.util import geospatial
+from trident.util import address_norm
 from airflow.models import Variable
 
 conf = general.config
@@ -15,73 +16,36 @@ temp_file = conf['temp_data_dir'] + '/special_events.csv'
 prod_v1_file = conf['prod_data_dir'] + '/special_events_list_datasd_v1.csv'
 prod_file = conf['prod_data_dir'] + '/special_events_list_datasd.csv'
 geocoded_addresses = 'events_address_book.csv'
+streets_regex = re.compile(r'\b[Ss][Tt][Rr][eE]+[Tt][Ss]\b')
 
-def spell_number(s):
-    """ Function to convert number to word """ 
-    n = int(s)
-    if n > 2 and n <= 10:
-        if n == 3:
-            return 'Third'
-        elif n == 4:
-            return 'Fourth'
-        elif n == 5:
-            return 'Fifth'
-        elif n == 6:
-            return 'Sixth'
-        elif n == 7:
-            return 'Seventh'
-        elif n == 8:
-            return 'Eighth'
-        elif n == 9:
-            return 'Ninth'
-        elif n == 10:
-            return 'Tenth'
-        else:
-            return s
-    else:
-        return s
-
-def normalize_number_streets(addr_str):
-    """ Function to fix numbered streets in downtown SD """
-    fixed_address = addr_str    
-    number_street_regex = re.compile(r'([0-9]+)(?=[sStTrR][TtHhdD])')
-    find_number = re.search(number_street_regex,addr_str)
-    if find_number:
-        new_street = spell_number(find_number[0])
-        if new_street != find_number[0]:
-            fixed_address = re.sub(r'([0-9]+)([sStTrRnN][TtHhdD])',new_street,fixed_address)
-        
-    return fixed_address
-
-def add_missing_suffix(addr_list):
-    """ Function to add suffix for intersect streets """
-
-    streets_regex = re.compile(r'\b[Ss][Tt][Rr][eE]+[Tt][Ss]\b')
-    two_streets = re.search(streets_regex,addr_list[1])
-    if two_streets:
-        addr_list[0] = f"{addr_list[0]} St"
-        return " & ".join(x.strip() for x in addr_list)
-    else:
-        return " & ".join(x.strip() for x in addr_list)
+def join_intersections(addresses):
+    """ Join intersection streets with 'and', adding missing suffixes """
 
-def normalize_address(address_string):
-    """ Function to normalize known address errors to improve geocoding """
-    
-    if '&' in address_string or ' and ' in address_string:
-        if '&' in address_string:
-            address_list = address_string.split('&')
-        else:
-            address_list = address_string.split('and')
-        added_suffix = add_missing_suffix(address_list)
-        final_address = added_suffix.replace('&','and')
-    else:
-        final_address = address_string
+    fixed = addresses.copy()
+    has_amp = addresses.str.contains('&', regex=False)
+    has_and = addresses.str.contains(' and ', regex=False) & ~has_amp
 
-    fixed_numbers = normalize_number_streets(final_address)
+    for rows, sep in ((has_amp, '&'), (has_and, 'and')):
+        split = addresses[rows].str.split(sep, n=1)
+        first = split.str[0]
+        rest = split.str[1]
+        # "5th & Market streets" means both are streets
+        two_streets = rest.str.split(sep, n=1).str[0].str.contains(streets_regex)
+        first = first.where(~two_streets, first + ' St').str.strip()
+        rest = rest.str.strip().str.replace(
+            r'\s*' + sep + r'\s*', ' & ', regex=True)
+        fixed[rows] = (first + ' & ' + rest).str.replace('&', 'and',
+                                                         regex=False)
 
-    fixed_suffix = geospatial.normalize_suffixes(fixed_numbers)
+    return fixed
 
-    return fixed_suffix
+def normalize_address(addresses):
+    """ Normalize known address errors to improve geocoding """
+
+    fixed = join_intersections(addresses)
+    fixed = address_norm.spell_numbered_streets(fixed)
+
+    return address_norm.normalize_suffixes(fixed)
 
 def get_special_events():
     """Get special events from DB."""
@@ -131,12 +95,20 @@ def process_special_events():
         logging.info(f"Need to geocode {to_geocode.shape[0]}")
 
         logging.info("Normalizing addresses for geocoding")
-        geocode_addresses = to_geocode.apply(lambda x: normalize_address(x['address_full']),axis=1)
-        to_geocode['address_normal'] = geocode_addresses
+        to_geocode['address_normal'] = normalize_address(to_geocode['address_full'])
+
+        logging.info("Matching addresses to city address points")
+        coords = geospatial.local_geocode(to_geocode['address_normal'])
+        missing = coords['lat'].isnull()
+
+        if missing.any():
+            logging.info(f"Sending {missing.sum()} addresses to web geocoders")
+            geocoder_results = to_geocode[missing].apply(lambda x: geospatial.census_address_geocoder(address_line=x['address_normal'],bounds='yes'), axis=1)
+            web_coords = geocoder_results.apply(pd.Series)
+            coords.loc[missing, 'lat'] = web_coords[0]
+            coords.loc[missing, 'lon'] = web_coords[1]
 
-        geocoder_results = to_geocode.apply(lambda x: geospatial.census_address_geocoder(address_line=x['address_normal'],bounds='yes'), axis=1)
-        coords = geocoder_results.apply(pd.Series)
-        fresh_geocodes = to_geocode.assign(lat=coords[0],lng=coords[1])
+        fresh_geocodes = to_geocode.assign(lat=coords['lat'],lng=coords['lon'])
         logging.info("Adding new geocodes to address book and data")
 
         new_add_book = pd.concat([add_book,fresh_geocodes],ignore_index=True)
@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import geopandas as gpd
 import math
@@ -11,7 +12,9 @@ from datetime import datetime, timedelta
 import logging
 from airflow.hooks.mssql_hook import MsSqlHook
 from trident.util import general
+from trident.util import sql_extract
 from trident.util.geospatial import shp2zip
+from trident.util import esri_sync
 from collections import OrderedDict
 from arcgis import GIS
 from arcgis.features import FeatureLayerCollection
@@ -22,6 +25,7 @@ conf = general.config
 temp_query = conf['temp_data_dir'] + '/cartegraph_results.csv'
 temp_file = conf['temp_data_dir'] + '/sd_paving_base.csv'
 temp_gis = conf['temp_data_dir'] + '/sd_paving_esri_base.csv'
+segs_file = conf['prod_data_dir'] + '/sd_paving_segs_datasd.geojson'
 
 prod_file = {
     'sdif': conf['prod_data_dir'] + '/sd_paving_datasd_v1.csv',
@@ -50,28 +54,26 @@ def number_str_cols(col):
     return col
 
 #: Helper function
-def get_paving_miles(row):
+def get_paving_miles(df):
     """ Calculate paving miles """
-    
-    if row['seg_width_ft'] >= 50:
-        return (row['seg_length_ft'] * 2)/5280
-    else:
-        return row['seg_length_ft']/5280
+
+    return np.where(df['seg_width_ft'] >= 50,
+        (df['seg_length_ft'] * 2)/5280,
+        df['seg_length_ft']/5280)
 
 #: Helper function
-def get_start_end_dates(row):
+def get_start_end_dates(df):
     """ Determine correct start and end dates """
 
-    if row['wo_id'] == 'UTLY' or row['wo_id'] == 'TSW':
-        return row['job_start_dt'], row['job_end_dt']
+    utly_tsw = df['wo_id'].isin(['UTLY','TSW'])
+    completed = df['job_completed_cbox'] == 1
 
-    else:
+    start = np.where(utly_tsw, df['job_start_dt'],
+        np.where(completed, df['job_end_dt'], df['start']))
+    end = np.where(utly_tsw, df['job_end_dt'],
+        np.where(completed, df['job_end_dt'], df['end']))
 
-        if row['job_completed_cbox'] == 1:
-            return row['job_end_dt'], row['job_end_dt']
-
-        else:
-            return row['start'], row['end']
+    return start, end
 
 #: DAG function
 def get_streets_paving_data():
@@ -79,13 +81,14 @@ def get_streets_paving_data():
     
     pv_query = general.file_to_string('./sql/pavement_ex.sql', __file__)
     pv_conn = MsSqlHook(mssql_conn_id='STREETS_CG_SQL')
-
-    df = pv_conn.get_pandas_df(pv_query)
-
-    results = df.shape[0]
-
-    general.pos_write_csv(
-        df, temp_query)
+    conn = pv_conn.get_conn()
+
+    try:
+        results = sql_extract.extract_to_file(conn,
+            pv_query,
+            temp_query)
+    finally:
+        conn.close()
     
     return f"Successfully wrote temp file with {results} records"
 
@@ -216,10 +219,7 @@ def create_base_data():
     df['end'] = df['wo_design_end_dt']
 
     # But here, we get an update based on a few criteria
-    new_dates = df.apply(get_start_end_dates,axis=1)
-    dates_final = new_dates.apply(pd.Series)
-    df['start'] = dates_final[0]
-    df['end'] = dates_final[1]
+    df['start'], df['end'] = get_start_end_dates(df)
 
     #*** Calculate paving miles ***
 
@@ -227,11 +227,9 @@ def create_base_data():
 
     #First, round segment length to next whole number
     df['seg_length_ft'] = df['seg_length_ft'].fillna(0.0)
-    df['seg_length_ft'] = df['seg_length_ft'].apply(lambda x: math.ceil(x))
+    df['seg_length_ft'] = np.ceil(df['seg_length_ft']).astype('int64')
 
-    
-    paving_miles = df.apply(get_paving_miles, axis=1)
-    df = df.assign(paving_miles=paving_miles)
+    df = df.assign(paving_miles=get_paving_miles(df))
 
     # Now we need to set paving miles to zero for certain activity type
     df.loc[df['job_activity'] == 'AC - Surface Treatment Partial','paving_miles'] = 0
@@ -308,19 +306,14 @@ def create_mode_data(mode='sdif', **context):
 
         logging.info("Flagging duplicates for removal")
 
-        duplicates = []
         df = df.sort_values(by=['seg_id','job_end_dt'], na_position='first', ascending=[True,False])
-        df_seg_groups = df.groupby(['seg_id'])
-        for name, group in df_seg_groups:
-            if group.shape[0] > 1:
-                selection = group.loc[group['moratorium'].notnull()]
-                if selection.shape[0] > 1:
-                    index_list = selection.index.tolist()
-                    select_remove = index_list[1:]
-                    duplicates.extend(select_remove)
+
+        # Keep the first record with a moratorium in each segment
+        selection = df.loc[df['moratorium'].notnull() & df['seg_id'].notnull()]
+        duplicates = selection.groupby('seg_id').cumcount() > 0
 
         df['to_delete'] = 0
-        df.loc[duplicates,['to_delete']] = 1
+        df.loc[duplicates[duplicates].index,['to_delete']] = 1
 
         df = df.rename(columns={'wo_id':'projectid',
             'wo_name':'title',
@@ -417,10 +410,17 @@ def create_arcgis_base():
 
     logging.info("Creating calendar and fiscal year cols")
 
-    df['date_cy'] = df['date_end'].apply(lambda x: x.strftime('%Y') if not pd.isnull(x) else '')
-    df['date_fy'] = df['date_end'].apply(lambda x: str(x.year+1) if x.month > 6 else str(x.year) if not pd.isnull(x) else '' )
-    df['date_start'] = df['date_start'].apply(lambda x: x.strftime('%m/%Y') if not pd.isnull(x) else '')
-    df['date_end'] = df['date_end'].apply(lambda x: x.strftime('%m/%Y') if not pd.isnull(x) else '')
+    no_end = df['date_end'].isnull()
+    date_fy = df['date_end'].dt.year + (df['date_end'].dt.month > 6)
+
+    df['date_cy'] = general.format_datetimes(df['date_end'], '%Y')
+    df['date_fy'] = date_fy.fillna(0).astype('int64').astype(str)
+    df.loc[no_end, 'date_fy'] = ''
+    df['date_start'] = general.format_datetimes(df['date_start'], '%m/%Y')
+    df['date_end'] = general.format_datetimes(df['date_end'], '%m/%Y')
+
+    date_cols = ['date_cy','date_start','date_end']
+    df[date_cols] = df[date_cols].fillna('')
 
     logging.info("Renaming cols to meet character limits")
     
@@ -482,7 +482,80 @@ def create_arcgis_base():
 
     return "Successfully created GIS base for ESRI"
 
-def send_arcgis(mode=['completed'], **context):
+#: Helper function
+def get_segments(epsg):
+    """ Read street segments in epsg, cached across tasks and modes """
+
+    stamp = [os.path.getmtime(segs_file), os.path.getsize(segs_file)]
+    cache_file = f"{conf['cache_dir']}/streets/sd_paving_segs_{epsg}.pkl"
+
+    if os.path.isfile(cache_file):
+        cached = pd.read_pickle(cache_file)
+        if cached['stamp'] == stamp:
+            logging.info(f"Using cached line segments in EPSG:{epsg}")
+            return cached['segs']
+
+    logging.info(f"Reading in line segments, reprojecting to EPSG:{epsg}")
+    segs = gpd.read_file(segs_file)
+    segs = segs.to_crs(f"EPSG:{epsg}")
+
+    general.create_path_if_not_exists(os.path.dirname(cache_file))
+    tmp_file = f"{cache_file}.{os.getpid()}"
+    pd.to_pickle({'stamp': stamp, 'segs': segs}, tmp_file)
+    os.replace(tmp_file, cache_file)
+
+    return segs
+
+#: Helper function
+def build_esri_layer(layer, segs):
+    """ Merge paving data with street segments for a layer """
+
+    logging.info("Merging paving data with street segments")
+
+    layer_merge = pd.merge(layer,
+        segs,
+        how='left',
+        left_on='seg_id',
+        right_on='sapid')
+
+    logging.info("Set sapid equal to segid when null")
+
+    layer_merge = layer_merge.drop(columns={'seg_id'})
+    layer_merge = layer_merge.rename(columns={'sapid':'seg_id'})
+
+    final = gpd.GeoDataFrame(layer_merge,geometry='geometry',crs=segs.crs)
+
+    final = final[['roadsegid',
+    'rd20full',
+    'xstrt1',
+    'xstrt2',
+    'llowaddr',
+    'lhighaddr',
+    'rlowaddr',
+    'rhighaddr',
+    'zip',
+    'pve_id',
+    'seg_id',
+    'project_id',
+    'title',
+    'status',
+    'type',
+    'date_start',
+    'date_end',
+    'pav_mi',
+    'mi_comp',
+    'date_cy',
+    'date_fy',
+    'oci_11',
+    'oci11_des',
+    'oci_15',
+    'oci15_des',
+    'seg_cd',
+    'geometry']]
+
+    return final
+
+def send_arcgis(mode=['completed'], full=False, **context):
     """ Update ArcGIS online feature layer """
 
     logging.info("Read in ESRI base file")
@@ -502,58 +575,29 @@ def send_arcgis(mode=['completed'], **context):
 
     if not layer.empty:
 
-        logging.info("Reading in line segments")
-
-        geojson = gpd.read_file(f"{conf['prod_data_dir']}/sd_paving_segs_datasd.geojson")
-
-        geojson = geojson.to_crs("EPSG:2230")
+        conn = BaseHook.get_connection(conn_id="ARC_ONLINE")
 
-        logging.info("Merging paving data with street segments")
+        arc_gis = GIS(f"https://{conn.host}",conn.login,conn.password)
+        # This depends on mode
+        lyr_id = esri_layer[mode].get('feature_lyr')
+        shape_file = arc_gis.content.get(lyr_id)
+        layer_sync = esri_sync.LayerSync(f'sd_paving_gis_{mode}',
+            shape_file.layers[0],
+            key=['pve_id','seg_id'])
 
-        layer_merge = pd.merge(layer,
-            geojson,
-            how='left',
-            left_on='seg_id',
-            right_on='sapid')
+        if not full and layer_sync.state is not None:
 
-        logging.info("Set sapid equal to segid when null")
+            # Send only records changed since the last update
+            wkid = esri_sync.layer_wkid(layer_sync.layer)
+            final = build_esri_layer(layer, get_segments(wkid))
+            logging.info("Sending changes to streets feature layer")
+            
+            return layer_sync.sync(final)
 
-        layer_merge = layer_merge.drop(columns={'seg_id'})
-        layer_merge = layer_merge.rename(columns={'sapid':'seg_id'})
-        
-    
         logging.info("Writing layer to shapefile")
         layer_name = f'sd_paving_gis_{mode}'
 
-        final = gpd.GeoDataFrame(layer_merge,geometry='geometry',crs="EPSG:2230")
-
-        final = final[['roadsegid',
-        'rd20full',
-        'xstrt1',
-        'xstrt2',
-        'llowaddr',
-        'lhighaddr',
-        'rlowaddr',
-        'rhighaddr',
-        'zip',
-        'pve_id',
-        'seg_id',
-        'project_id',
-        'title',
-        'status',
-        'type',
-        'date_start',
-        'date_end',
-        'pav_mi',
-        'mi_comp',
-        'date_cy',
-        'date_fy',
-        'oci_11',
-        'oci11_des',
-        'oci_15',
-        'oci15_des',
-        'seg_cd',
-        'geometry']]
+        final = build_esri_layer(layer, get_segments(2230))
 
         shp_path = f"{conf['prod_data_dir']}/{layer_name}"
 
@@ -564,16 +608,16 @@ def send_arcgis(mode=['completed'], **context):
 
         shp2zip(layer_name)
 
-        conn = BaseHook.get_connection(conn_id="ARC_ONLINE")
-
-        arc_gis = GIS(f"https://{conn.host}",conn.login,conn.password)
-        # This depends on mode
-        lyr_id = esri_layer[mode].get('feature_lyr')
-        shape_file = arc_gis.content.get(lyr_id)
         streets_flayer_collection = FeatureLayerCollection.fromitem(shape_file)
         logging.info("Overwriting streets feature layer collection")
         overwrite = streets_flayer_collection.manager.overwrite(f"{shp_path}.zip")
 
+        # Record what was published for the next delta sync
+        feature_layer = arc_gis.content.get(lyr_id).layers[0]
+        layer_sync.layer = feature_layer
+        wkid = esri_sync.layer_wkid(feature_layer)
+        layer_sync.bootstrap(build_esri_layer(layer, get_segments(wkid)))
+
         return overwrite
 
     else:
@@ -9,6 +9,7 @@ import numpy as np
 from shapely.geometry import Point
 from trident.util import general
 from trident.util import geospatial
+from trident.util import address_norm
 from trident.util.sf_client import Salesforce
 from airflow.hooks.postgres_hook import PostgresHook
 import cx_Oracle
@@ -196,9 +197,12 @@ def combine_violations():
     s3_url = f"s3://{bucket_name}/reference/{geocoded_addresses}"
     add_book = pd.read_csv(s3_url,low_memory=False)
     
-    logging.info(f"Fixing {vs.loc[(vs.ADDRESS == '') | (vs.ADDRESS == 'nan')].shape[0]} missing addresses")
+    no_address = ((vs.ADDRESS == '') | (vs.ADDRESS == 'nan')).values
+    logging.info(f"Fixing {no_address.sum()} missing addresses")
 
-    parcel_addresses = vs.apply(parcel_to_address,axis=1)
+    parcel_addresses = vs['ADDRESS'].copy()
+    parcel_addresses[no_address] = geospatial.addresses_for_apns(
+        vs.loc[no_address, 'PARCEL_APN']).fillna('').values
     parcel_add_df = pd.DataFrame(parcel_addresses)
     #parcel_addr_cols = [col for col in parcel_add_df.columns if 'addr' in col or 'stre' in col or 'suf' in col]
     logging.info(parcel_add_df.head())
@@ -207,7 +211,7 @@ def combine_violations():
     
     logging.info('Create geo id based on address for merging')
     
-    vs['geo_id'] = vs['ADDRESS'].apply(lambda x: x.lower().replace(' ',''))
+    vs['geo_id'] = address_norm.compact_key(vs['ADDRESS'])
     
     add_merge = pd.merge(vs,
         add_book,
@@ -233,10 +237,17 @@ def combine_violations():
     else:
         geocode_dedupe = add_unmatched.copy()
         geocode_dedupe = geocode_dedupe.drop_duplicates(subset=['geo_id'])
-        geocoder_results = geocode_dedupe.apply(get_violation_coords, axis=1)
-        coords = geocoder_results.apply(pd.Series)
-        geocode_dedupe['LAT'] = coords[0]
-        geocode_dedupe['LON'] = coords[1]
+        logging.info('Matching addresses to city address points')
+        coords = geospatial.local_geocode(geocode_dedupe['ADDRESS'])
+        missing = coords['lat'].isnull()
+        if missing.any():
+            logging.info(f"Sending {missing.sum()} addresses to web geocoders")
+            geocoder_results = geocode_dedupe[missing].apply(get_violation_coords, axis=1)
+            web_coords = geocoder_results.apply(pd.Series)
+            coords.loc[missing, 'lat'] = web_coords[0]
+            coords.loc[missing, 'lon'] = web_coords[1]
+        geocode_dedupe['LAT'] = coords['lat']
+        geocode_dedupe['LON'] = coords['lon']
 
         add_unmatched = add_unmatched.drop(['LAT','LON'],axis=1)
         
@@ -435,22 +446,6 @@ def _clean_sf_violations():
 
     return sfv
 
-def parcel_to_address(x):
-
-    if x['ADDRESS'] == '' or x['ADDRESS'] == 'nan':
-
-        if x['PARCEL_APN'] != '':
-
-            return geospatial.get_address_for_apn(x['PARCEL_APN'])
-
-        else:
-
-            return ''
-
-    else:
-
-        return x['ADDRESS']
-
 def get_violation_coords(x):
 
     if x['ADDRESS'] != '':
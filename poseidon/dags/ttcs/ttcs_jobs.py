@@ -13,6 +13,8 @@ from airflow.models import Variable
 
 from trident.util import general
 from trident.util import geospatial
+from trident.util import address_norm
+from trident.util import sql_extract
 
 conf = general.config
 
@@ -43,13 +45,15 @@ def get_active_businesses():
         conn_config['dsn'],
         encoding="UTF-8")
     sql = general.file_to_string('./sql/ttcs_biz.sql', __file__)
-    df = pd.read_sql_query(sql, db)
-    df_rows = df.shape[0]
+    try:
+        df_rows = sql_extract.extract_to_file(db,
+            sql,
+            temp_all,
+            arraysize=5000,
+            date_format="%Y-%m-%d %H:%M:%S")
+    finally:
+        db.close()
     logging.info(f'Query returned {df_rows} results')
-    general.pos_write_csv(
-        df,
-        temp_all,
-        date_format="%Y-%m-%d %H:%M:%S")
 
     return 'Successfully retrieved active businesses data.'
 
@@ -144,14 +148,14 @@ def geocode_data():
         'zip': ''
         })
 
-    add_match = temp_df[['street_no',
+    add_match = address_norm.join_parts(temp_df[['street_no',
     'street_pre_direction' ,
     'street_name',
     'street_suffix',
     'street_fraction',
     'city',
     'state',
-    'zip']].apply(lambda x: ''.join(x.map(str)), axis=1)
+    'zip']], sep='')
     temp_df = temp_df.assign(uid=add_match)
 
     logging.info('Merging address book with temp file')
@@ -208,10 +212,10 @@ def geocode_data():
 
         else:
 
-            geocode_address = to_geocode[['street_no',
+            geocode_address = address_norm.join_parts(to_geocode[['street_no',
             'street_pre_direction',
             'street_name',
-            'street_suffix']].apply(lambda x: ' '.join(x), axis=1)
+            'street_suffix']])
             
             zip_split = to_geocode['zip'].str.split('-',expand=True)
             
@@ -224,11 +228,14 @@ def geocode_data():
                         
             logging.info(f'Need to geocode {geocode_dedupe.shape[0]}')
         
-            geocoder_results = geocode_dedupe.apply(lambda x: geospatial.census_address_geocoder(address_line=x['address_full'],locality=x['city'],state=x['state'],zip=x['zip_short']), axis=1)
+            coords = geospatial.batch_geocode(geocode_dedupe,
+                address='address_full',
+                city='city',
+                state='state',
+                zip='zip_short')
 
             logging.info('Adding new coords to the df')
-            coords = geocoder_results.apply(pd.Series)
-            fresh_geocodes = geocode_dedupe.assign(latitude=coords[0],longitude=coords[1])
+            fresh_geocodes = geocode_dedupe.assign(latitude=coords['lat'],longitude=coords['lon'])
 
             logging.info('Merging geocodes to geocode df')
             geocoded = pd.merge(to_geocode,
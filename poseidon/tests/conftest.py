@@ -0,0 +1,5 @@
+"""Make dags and trident importable when pytest runs from any dir."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
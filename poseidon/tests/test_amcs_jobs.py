@@ -0,0 +1,25 @@
+"""Regression check of the AMCS sites file against a recorded run."""
+import os
+import shutil
+from dags.amcs import amcs_jobs
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'data', 'amcs')
+
+
+def test_add_all_columns(tmp_path, monkeypatch):
+    """add_all_columns writes the file the row by row version wrote."""
+    grouped = str(tmp_path / 'grouped_amcs_sites.csv')
+    final = str(tmp_path / 'final_amcs_sites.csv')
+    shutil.copy(os.path.join(DATA_DIR, 'grouped_amcs_sites.csv'), grouped)
+    monkeypatch.setattr(amcs_jobs, 'temp_file3', grouped)
+    monkeypatch.setattr(amcs_jobs, 'final_file', final)
+
+    amcs_jobs.add_all_columns()
+
+    with open(final, 'rb') as f:
+        written = f.read()
+    with open(os.path.join(DATA_DIR, 'final_amcs_sites.csv'), 'rb') as f:
+        expected = f.read()
+
+    assert written == expected
@@ -0,0 +1,44 @@
+"""Raw line and parsed snapshot diffs find the same changes."""
+import pytest
+from trident.util import snapshot_diff
+
+PREVIOUS = ('Site ID,Name,Zip\n'
+            '1,MAIN,92101\n'
+            '2,5TH,92103\n'
+            '2,5TH,92104\n'
+            '3,"EL CAJON, BLVD",92105\n')
+
+CURRENT = ('Site ID,Name,Zip\r\n'
+           '2,5TH,92104\r\n'
+           '2,5TH,92103\r\n'
+           '3,"EL CAJON, BLVD",92115\r\n'
+           '\r\n'
+           '4,"A\r\nB",92101\r\n')
+
+
+def diff_keys(diff):
+    return {kind: sorted(diff.keys([kind])['Site ID'])
+            for kind in snapshot_diff.CHANGES}
+
+
+@pytest.mark.parametrize('current', [CURRENT.replace('"A\r\nB"', 'AB'),
+                                     CURRENT],
+                         ids=['one_line_records', 'quoted_line_break'])
+def test_raw_matches_parsed(tmp_path, current):
+    previous_file = tmp_path / 'previous.csv'
+    current_file = tmp_path / 'current.csv'
+    previous_file.write_bytes(PREVIOUS.encode())
+    current_file.write_bytes(current.encode())
+
+    raw = snapshot_diff.diff_snapshots(str(previous_file),
+                                       str(current_file),
+                                       key=['Site ID'])
+    parsed = snapshot_diff.diff_snapshots(str(previous_file),
+                                          str(current_file),
+                                          key=['Site ID'],
+                                          raw=False)
+
+    expected = {'insert': ['4'], 'update': ['3'], 'delete': ['1']}
+    assert diff_keys(raw) == expected
+    assert diff_keys(parsed) == expected
+    assert raw.rows().equals(parsed.rows())
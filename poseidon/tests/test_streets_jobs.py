@@ -0,0 +1,60 @@
+"""Regression check of the paving files against a recorded run.
+
+data/streets holds a small Cartegraph snapshot and OCI files,
+and the files the row by row version of streets_jobs wrote
+from them.
+"""
+import os
+import shutil
+from datetime import datetime
+import pendulum
+import pytest
+from trident.util import general
+from dags.streets import streets_jobs
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'data', 'streets')
+
+OUTPUTS = ['sd_paving_base.csv',
+           'sd_paving_datasd_v1.csv',
+           'sd_paving_imcat_datasd_v1.csv',
+           'sd_paving_esri_base.csv']
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def paving_run(tmp_path, monkeypatch):
+    """Run the paving steps on the snapshot, return the output dir."""
+    out = str(tmp_path)
+    for fname in ['cartegraph_results.csv',
+                  'oci_2011_datasd.csv',
+                  'oci_2015_datasd.csv']:
+        shutil.copy(os.path.join(DATA_DIR, fname), out)
+
+    monkeypatch.setitem(general.config, 'prod_data_dir', out)
+    monkeypatch.setattr(general, 'today', lambda: datetime(2020, 6, 15))
+    monkeypatch.setattr(streets_jobs, 'temp_query',
+                        f"{out}/cartegraph_results.csv")
+    monkeypatch.setattr(streets_jobs, 'temp_file', f"{out}/{OUTPUTS[0]}")
+    monkeypatch.setattr(streets_jobs, 'temp_gis', f"{out}/{OUTPUTS[3]}")
+    monkeypatch.setitem(streets_jobs.prod_file, 'sdif', f"{out}/{OUTPUTS[1]}")
+    monkeypatch.setitem(streets_jobs.prod_file, 'imcat', f"{out}/{OUTPUTS[2]}")
+
+    context = {'next_execution_date': pendulum.datetime(2020, 6, 15, 12)}
+    streets_jobs.create_base_data()
+    streets_jobs.create_mode_data('sdif', **context)
+    streets_jobs.create_mode_data('imcat', **context)
+    streets_jobs.create_arcgis_base()
+
+    return out
+
+
+@pytest.mark.parametrize('fname', OUTPUTS)
+def test_paving_outputs(paving_run, fname):
+    """Each step writes the file the row by row version wrote."""
+    assert read_bytes(f"{paving_run}/{fname}") == \
+        read_bytes(os.path.join(DATA_DIR, fname))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from airflow.hooks.S3_hook import S3Hook
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from trident.operators.s3_file_transfer_operator import upload_file, MB
+from trident.util import general
+
+conf = general.config
+
+
+class S3BatchTransferOperator(BaseOperator):
+    """
+    Copies many local files to S3 in one task, over one client.
+    :param source_base_path: base path for local files
+    :type source_base_path: str
+    :param manifest: files to upload. Each entry is a dict with
+        'source_key', and optionally 'dest_s3_key' and 'use_gzip'
+    :type manifest: list
+    param dest_s3_bucket: s3 bucket
+    :type dest_s3_bucket: str
+    :param dest_s3_conn_id: destination s3 connection
+    :type dest_s3_conn_id: str
+    :param replace: Replace dest S3 keys if they already exist
+    :type replace: bool
+    :param skip_unchanged: Skip files S3 already has with the same checksum
+    :type skip_unchanged: bool
+    :param max_workers: Number of files uploaded at once
+    :type max_workers: int
+    :param part_size: Multipart threshold and part size in bytes
+    :type part_size: int
+    """
+
+    ui_color = '#f9c915'
+    template_fields = ('source_base_path',
+        'dest_s3_conn_id',
+        'dest_s3_bucket')
+
+    @apply_defaults
+    def __init__(self,
+                 source_base_path,
+                 manifest,
+                 dest_s3_bucket,
+                 dest_s3_conn_id='s3_default',
+                 replace=True,
+                 skip_unchanged=True,
+                 max_workers=4,
+                 part_size=16 * MB,
+                 *args,
+                 **kwargs):
+        super(S3BatchTransferOperator, self).__init__(*args, **kwargs)
+        self.source_base_path = source_base_path
+        self.manifest = manifest
+        self.dest_s3_bucket = dest_s3_bucket
+        self.dest_s3_conn_id = dest_s3_conn_id
+        self.replace = replace
+        self.skip_unchanged = skip_unchanged
+        self.max_workers = max_workers
+        self.part_size = part_size
+
+    def execute(self, context):
+
+        dest_s3 = S3Hook(aws_conn_id='S3DATA')
+        client = dest_s3.get_conn()
+
+        def upload(entry):
+            local_fpath = "%s/%s" % (self.source_base_path, entry['source_key'])
+            dest_key = entry.get('dest_s3_key') or entry['source_key']
+
+            logging.info("%s >>>>> %s/%s" %
+                         (local_fpath, self.dest_s3_bucket, dest_key))
+
+            start = time.time()
+            result = upload_file(client,
+                                 local_fpath,
+                                 self.dest_s3_bucket,
+                                 dest_key,
+                                 replace=self.replace,
+                                 use_gzip=entry.get('use_gzip', False),
+                                 skip_unchanged=self.skip_unchanged,
+                                 part_size=self.part_size)
+            result['seconds'] = round(time.time() - start, 2)
+
+            logging.info("{key}: {bytes} bytes in {seconds}s, "
+                         "skipped {skipped}".format(**result))
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(pool.map(upload, self.manifest))
+
+        sent = sum(r['bytes'] for r in results)
+        skipped = sum(1 for r in results if r['skipped'])
+        logging.info(f"Uploaded {len(results) - skipped} files, "
+                     f"{sent} bytes, skipped {skipped} unchanged")
+
+        return results
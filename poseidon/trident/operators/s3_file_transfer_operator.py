@@ -13,17 +13,159 @@
 # limitations under the License.
 
 import os, logging, requests
+import gzip
+import shutil
+import hashlib
+import tempfile
 
 from airflow.exceptions import AirflowException
 from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 from trident.util import general
-import boto3
+import botocore
+from boto3.s3.transfer import TransferConfig
 from airflow.models import Variable
 
 conf = general.config
 
+MB = 1024 * 1024
+
+
+def file_checksums(path, part_size):
+    """Return the MD5 and the expected S3 ETag of a local file.
+
+    The ETag of a multipart upload is the MD5 of the part MD5s
+    followed by the number of parts, so it depends on 'part_size'.
+    """
+    md5 = hashlib.md5()
+    part_md5s = []
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            md5.update(part)
+            part_md5s.append(hashlib.md5(part).digest())
+
+    if size < part_size:
+        etag = md5.hexdigest()
+    else:
+        etag = '{}-{}'.format(
+            hashlib.md5(b''.join(part_md5s)).hexdigest(), len(part_md5s))
+
+    return md5.hexdigest(), etag
+
+
+def is_gzipped(path):
+    """Check a file for the gzip magic number."""
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def gzip_file(path):
+    """Compress a file to a temp file and return its path."""
+    fd, gz_path = tempfile.mkstemp(suffix='.gz',
+                                   dir=os.path.dirname(path) or None)
+    with open(path, 'rb') as f_in, os.fdopen(fd, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f_out:
+            shutil.copyfileobj(f_in, f_out, 4 * MB)
+    return gz_path
+
+
+def head_object(client, bucket, key):
+    """Return the head of an S3 object, or None if it does not exist."""
+    try:
+        return client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise
+
+
+def upload_file(client,
+                local_fpath,
+                bucket,
+                key,
+                replace=True,
+                use_gzip=False,
+                skip_unchanged=True,
+                part_size=16 * MB,
+                max_concurrency=10):
+    """Upload one file to S3 and verify it.
+
+    Files over 'part_size' go up in parts, 'max_concurrency' at a
+    time. With 'use_gzip' the file is compressed first, unless it
+    already is, and stored with Content-Encoding gzip.
+
+    The MD5 is stored as object metadata. If the object already
+    has the same MD5 and 'skip_unchanged' is set, nothing is sent.
+
+    Returns a dict with the key, bytes sent and whether it was skipped.
+    """
+    upload_path = local_fpath
+    extra_args = {}
+
+    if use_gzip:
+        extra_args['ContentEncoding'] = 'gzip'
+        if not is_gzipped(local_fpath):
+            logging.info(f"Compressing {local_fpath}")
+            upload_path = gzip_file(local_fpath)
+
+    try:
+        md5, etag = file_checksums(upload_path, part_size)
+        size = os.path.getsize(upload_path)
+
+        remote = head_object(client, bucket, key)
+
+        if remote is not None:
+            if not replace:
+                raise ValueError(f"The key {key} already exists.")
+            remote_etag = remote.get('ETag', '').strip('"')
+            remote_md5 = remote.get('Metadata', {}).get('md5')
+            if skip_unchanged and (remote_md5 == md5 or remote_etag == etag):
+                logging.info(f"{key} is unchanged, skipping upload")
+                return {'key': key, 'bytes': 0, 'skipped': True}
+
+        extra_args['Metadata'] = {'md5': md5}
+        config = TransferConfig(multipart_threshold=part_size,
+                                multipart_chunksize=part_size,
+                                max_concurrency=max_concurrency)
+
+        client.upload_file(upload_path,
+                           bucket,
+                           key,
+                           ExtraArgs=extra_args,
+                           Config=config)
+
+        verify_upload(client, bucket, key, etag, size)
+
+    finally:
+        if upload_path != local_fpath:
+            os.remove(upload_path)
+
+    return {'key': key, 'bytes': size, 'skipped': False}
+
+
+def verify_upload(client, bucket, key, etag, size):
+    """Check an uploaded object against the local ETag and size."""
+    s3_data = head_object(client, bucket, key)
+
+    if s3_data is None:
+        raise AirflowException(f"{key} not found on {bucket} after upload")
+
+    remote_etag = s3_data.get('ETag', '').strip('"')
+    upload_size = s3_data['ContentLength']
+
+    assert int(upload_size) == int(size), \
+        'upload size {} does not match local size {}'.format(upload_size, size)
+
+    if remote_etag == etag:
+        logging.info(f"Upload checksum {etag} matches local file")
+    else:
+        # Objects encrypted with KMS do not have an MD5 ETag
+        logging.warning(f"ETag {remote_etag} differs from local {etag}, "
+                        f"verified size {size} only")
+
 
 class S3FileTransferOperator(BaseOperator):
     """
@@ -40,6 +182,14 @@ class S3FileTransferOperator(BaseOperator):
     :type dest_s3_key: str
     :param replace: Replace dest S3 key if it already exists
     :type replace: bool
+    :param use_gzip: Gzip the file and upload with Content-Encoding gzip
+    :type use_gzip: bool
+    :param skip_unchanged: Skip the upload if S3 has the same checksum
+    :type skip_unchanged: bool
+    :param part_size: Multipart threshold and part size in bytes
+    :type part_size: int
+    :param max_concurrency: Number of parts uploaded at once
+    :type max_concurrency: int
     """
 
     ui_color = '#f9c915'
@@ -56,6 +206,9 @@ class S3FileTransferOperator(BaseOperator):
                  dest_s3_key=None,
                  replace=True,
                  use_gzip=False,
+                 skip_unchanged=True,
+                 part_size=16 * MB,
+                 max_concurrency=10,
                  *args,
                  **kwargs):
         super(S3FileTransferOperator, self).__init__(*args, **kwargs)
@@ -65,6 +218,9 @@ class S3FileTransferOperator(BaseOperator):
         self.dest_s3_bucket = dest_s3_bucket
         self.replace = replace
         self.use_gzip = use_gzip
+        self.skip_unchanged = skip_unchanged
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
 
         # Default to same path on aws if no path passed.
         if dest_s3_key == None:
@@ -90,37 +246,17 @@ class S3FileTransferOperator(BaseOperator):
         logging.info("%s >>>>> %s/%s" %
                          (local_fpath, dest_bucket, self.dest_s3_key))
 
-        dest_s3.load_file(
-            filename=local_fpath,
-            key=self.dest_s3_key,
-            bucket_name=dest_bucket,
-            replace=self.replace)
+        upload_file(dest_s3.get_conn(),
+                    local_fpath,
+                    dest_bucket,
+                    self.dest_s3_key,
+                    replace=self.replace,
+                    use_gzip=self.use_gzip,
+                    skip_unchanged=self.skip_unchanged,
+                    part_size=self.part_size,
+                    max_concurrency=self.max_concurrency)
         logging.info("Upload completed")
 
         logging.info("URL: {}".format(url))
-        s3_file = boto3.client('s3')
-        self.verify_file_size_match(s3_file, local_fpath, url)
         
         return url
-
-    def verify_file_size_match(self, boto_client, local_path, url):
-
-        try:
-            s3_data = boto_client.head_object(Bucket=self.dest_s3_bucket, Key=self.dest_s3_key)
-            #s3_data = s3_file.head_object(Bucket=self.dest_s3_bucket, Key=self.dest_s3_key)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                logging.info(f'The object does not exist on bucket {self.dest_s3_bucket} key {self.dest_s3_key}')
-            else:
-                else_error = e.response['Error']['Code']
-                logging.info(f'HTTP HEAD code {else_error} on bucket {self.dest_s3_bucket} key {self.dest_s3_key}')
-                raise
-        
-        upload_size = s3_data["ResponseMetadata"]["HTTPHeaders"]['content-length']
-        local_size = int(os.path.getsize(local_path))
-
-        assert int(upload_size) == int(local_size), 'upload size {} does not match local size {}'.format(
-            upload_size, local_size)
-
-        logging.info("Upload size {} matches local size {}".format(upload_size,
-                                                                   local_size))
@@ -0,0 +1,241 @@
+"""Vectorized address normalization shared by geocoding jobs.
+
+Functions take and return whole Series, using pandas string
+methods and the lookup tables below instead of row-wise Python.
+String work runs once per distinct value.
+"""
+import re
+import functools
+import numpy as np
+import pandas as pd
+
+# Street suffixes, including SANDAG abbreviations, to USPS
+street_suffixes = {
+    'ALLEY': 'ALY', 'ALY': 'ALY', 'AL': 'ALY',
+    'AVENUE': 'AVE', 'AVE': 'AVE', 'AV': 'AVE',
+    'BOULEVARD': 'BLVD', 'BLVD': 'BLVD', 'BL': 'BLVD',
+    'CIRCLE': 'CIR', 'CIR': 'CIR', 'CR': 'CIR',
+    'COURT': 'CT', 'CT': 'CT',
+    'COVE': 'CV', 'CV': 'CV',
+    'DRIVE': 'DR', 'DR': 'DR',
+    'GLEN': 'GLN', 'GLN': 'GLN', 'GN': 'GLN',
+    'HIGHWAY': 'HWY', 'HWY': 'HWY', 'HY': 'HWY',
+    'LANE': 'LN', 'LN': 'LN',
+    'LOOP': 'LOOP', 'LP': 'LOOP',
+    'MALL': 'MALL', 'ML': 'MALL',
+    'PARKWAY': 'PKWY', 'PKWY': 'PKWY', 'PKY': 'PKWY', 'PY': 'PKWY',
+    'PLACE': 'PL', 'PL': 'PL',
+    'PLAZA': 'PLZ', 'PLZ': 'PLZ', 'PZ': 'PLZ',
+    'POINT': 'PT', 'PT': 'PT',
+    'ROAD': 'RD', 'RD': 'RD',
+    'ROW': 'ROW', 'RW': 'ROW',
+    'SQUARE': 'SQ', 'SQ': 'SQ',
+    'STREET': 'ST', 'ST': 'ST',
+    'TERRACE': 'TER', 'TER': 'TER', 'TR': 'TER',
+    'TRAIL': 'TRL', 'TRL': 'TRL', 'TL': 'TRL',
+    'WALK': 'WALK', 'WK': 'WALK',
+    'WAY': 'WAY', 'WY': 'WAY'
+}
+
+street_directions = {
+    'NORTH': 'N', 'N': 'N',
+    'SOUTH': 'S', 'S': 'S',
+    'EAST': 'E', 'E': 'E',
+    'WEST': 'W', 'W': 'W',
+    'NORTHEAST': 'NE', 'NE': 'NE',
+    'NORTHWEST': 'NW', 'NW': 'NW',
+    'SOUTHEAST': 'SE', 'SE': 'SE',
+    'SOUTHWEST': 'SW', 'SW': 'SW'
+}
+
+ordinal_streets = {
+    'FIRST': '1ST', 'SECOND': '2ND', 'THIRD': '3RD', 'FOURTH': '4TH',
+    'FIFTH': '5TH', 'SIXTH': '6TH', 'SEVENTH': '7TH', 'EIGHTH': '8TH',
+    'NINTH': '9TH', 'TENTH': '10TH', 'ELEVENTH': '11TH',
+    'TWELFTH': '12TH'
+}
+
+# Numbered streets spelled out, as downtown streets are named
+spelled_streets = {
+    3: 'Third', 4: 'Fourth', 5: 'Fifth', 6: 'Sixth', 7: 'Seventh',
+    8: 'Eighth', 9: 'Ninth', 10: 'Tenth'
+}
+
+# Suffix spellings to abbreviations, applied in order
+suffix_abbreviations = [
+    (re.compile(r'\b[Ss][Tt][Rr]*[eE]*[Tt]*[Ss]*\b'), 'St'),
+    (re.compile(r'\b[Aa][Vv][Ee][Nn]*[Uu]*[Ee]*\b'), 'Ave'),
+    (re.compile(r'\b[Bb][Oo]*[Uu]*[Ll][Ee]*[Vv][Aa]*[Rr]*[Dd]\b'), 'Blvd'),
+    (re.compile(r'\b[Dd][Rr][Ii]*[Vv]*[Ee]*\b'), 'Dr'),
+    (re.compile(r'\b[Ww][Yy]\b'), 'Way'),
+    (re.compile(r'\b[Rr][Oo][Aa][Dd]\b'), 'Rd'),
+    (re.compile(r'\b[Cc][Ii]*[Rr][Cc]*[Ll]*[Ee]*\b'), 'Cir'),
+    (re.compile(r'\b[Pp][Aa][Rr][Kk][Ww][Aa][Yy]\b'), 'Pky')
+]
+
+_numbered_street_regex = re.compile(r'([0-9]+)(?=[sStTrR][TtHhdD])')
+_ordinal_number_regex = re.compile(r'([0-9]+)([sStTrRnN][TtHhdD])')
+
+
+def by_unique(func):
+    """Decorate a Series function to run once per distinct value.
+
+    Address columns repeat the same values many times, so
+    normalizing the distinct values and mapping them back saves
+    most of the string work. Nulls are passed through.
+    """
+    @functools.wraps(func)
+    def wrapper(values, *args, **kwargs):
+        codes, uniques = pd.factorize(values)
+        result = func(pd.Series(uniques, dtype=object), *args, **kwargs)
+        missing = codes < 0
+        if missing.any():
+            result = result.reindex(range(len(uniques) + 1))
+            codes = np.where(missing, len(uniques), codes)
+        result = result.iloc[codes]
+        result.index = values.index
+        return result
+    return wrapper
+
+
+def _alternation(words):
+    return '|'.join(sorted(words, key=len, reverse=True))
+
+
+_address_regex = re.compile(
+    r'^(?P<number>\d+)[A-Z]?(?: \d/\d)?'
+    r' (?:(?P<predir>' + _alternation(street_directions) + r') )?'
+    r'(?P<name>.+?)'
+    r'(?: (?P<suffix>' + _alternation(street_suffixes) + r'))?'
+    r'(?: (?P<postdir>' + _alternation(street_directions) + r'))?$')
+
+_unit_regex = re.compile(
+    r'\s*(?:#|\b(?:APT|UNIT|STE|SUITE|SPC|BLDG|RM)\b)\s*[\w-]*\s*$')
+
+
+@by_unique
+def _normalize_street_names(names):
+    names = names.astype(str).str.upper()
+    names = names.str.replace(r'[^\w\s]', ' ', regex=True)
+    names = names.str.replace(r'\s+', ' ', regex=True).str.strip()
+    names = names.str.replace(r'\b0+(\d+(?:ST|ND|RD|TH))\b', r'\1',
+                              regex=True)
+    return names.replace(ordinal_streets)
+
+
+def normalize_street_names(names):
+    """Return a Series of street names in one canonical form."""
+    return _normalize_street_names(names.fillna(''))
+
+
+def parse_addresses(addresses):
+    """Split a Series of street addresses into their parts.
+
+    Returns a DataFrame with the index of addresses and number,
+    predir, name, suffix and postdir columns in canonical form.
+    Units, fractions and anything after a comma are dropped.
+    Addresses without a house number parse as blanks.
+    """
+    return _parse_addresses(addresses.fillna(''))
+
+
+@by_unique
+def _parse_addresses(addresses):
+    clean = addresses.astype(str).str.upper()
+    clean = clean.str.replace(r',.*$', '', regex=True)
+    clean = clean.str.replace(_unit_regex, '', regex=True)
+    clean = clean.str.replace(r'[^\w\s/]', ' ', regex=True)
+    clean = clean.str.replace(r'\s+', ' ', regex=True).str.strip()
+
+    parts = clean.str.extract(_address_regex).fillna('')
+
+    # "E ST" is a street named E, not a direction
+    named = (parts['predir'] != '') & (parts['suffix'] == '') \
+        & parts['name'].isin(list(street_suffixes))
+    parts.loc[named, 'suffix'] = parts.loc[named, 'name']
+    parts.loc[named, 'name'] = parts.loc[named, 'predir']
+    parts.loc[named, 'predir'] = ''
+
+    return pd.DataFrame({
+        'number': parts['number'].str.lstrip('0'),
+        'predir': parts['predir'].map(street_directions).fillna(''),
+        'name': normalize_street_names(parts['name']),
+        'suffix': parts['suffix'].map(street_suffixes).fillna(''),
+        'postdir': parts['postdir'].map(street_directions).fillna('')
+        }, index=addresses.index)
+
+
+@by_unique
+def normalize_suffixes(addresses):
+    """Abbreviate street suffixes and remove periods.
+
+    'Street', 'STREETS' and 'str' become 'St', 'Avenue' becomes
+    'Ave' and so on, through suffix_abbreviations.
+    """
+    fixed = addresses
+    for regex, abbreviation in suffix_abbreviations:
+        fixed = fixed.str.replace(regex, abbreviation, regex=True)
+    return fixed.str.replace('.', '', regex=False)
+
+
+@by_unique
+def spell_numbered_streets(addresses):
+    """Spell out numbered streets from Third to Tenth.
+
+    The first numbered street of an address picks the word, which
+    then replaces every numbered street in it, so '5th' becomes
+    'Fifth' and '12th' is left alone.
+    """
+    first = pd.to_numeric(
+        addresses.str.extract(_numbered_street_regex, expand=False),
+        errors='coerce')
+    words = first.map(spelled_streets)
+
+    fixed = addresses.copy()
+    for word in words.dropna().unique():
+        rows = (words == word).values
+        fixed[rows] = addresses[rows].str.replace(_ordinal_number_regex,
+                                                  word,
+                                                  regex=True)
+    return fixed
+
+
+def join_parts(df, sep=' ', skip_null=False):
+    """Join the columns of df into one string per row.
+
+    Values are converted with str, so nulls read 'nan' unless
+    'skip_null' is True, in which case null parts and their
+    separator are left out.
+    """
+    joined = None
+    for col in df.columns:
+        part = df[col].astype(str)
+        if joined is None:
+            joined = part.where(df[col].notnull(), '') if skip_null \
+                else part
+            continue
+        if skip_null:
+            present = df[col].notnull()
+            joined = joined.where(~present,
+                                  joined.where(joined == '',
+                                               joined + sep) + part)
+        else:
+            joined = joined + sep + part
+    return joined
+
+
+def compact_key(addresses):
+    """Return lowercase addresses without spaces, for address books."""
+    return addresses.str.lower().str.replace(' ', '', regex=False)
+
+
+def canonical_key(parts):
+    """Return one canonical address string per row of parsed parts.
+
+    'parts' is a DataFrame as returned by parse_addresses.
+    Different spellings of an address share the same key, like
+    '100 N 5th Avenue' and '0100 NORTH FIFTH AVE' as '100 N 5TH AVE'.
+    """
+    key = join_parts(parts[['number', 'predir', 'name', 'suffix',
+                            'postdir']])
+    return key.str.replace(r'\s+', ' ', regex=True).str.strip()
@@ -0,0 +1,231 @@
+"""Delta sync of GeoDataFrames to ArcGIS Online feature layers."""
+import os
+import logging
+import numpy as np
+import pandas as pd
+from trident.util import general
+
+conf = general.config
+
+
+def layer_wkid(feature_layer):
+    """Return the wkid of a feature layer's spatial reference."""
+    sr = dict(feature_layer.properties.extent['spatialReference'])
+    return sr.get('latestWkid', sr.get('wkid'))
+
+
+def esri_geometry(geom, wkid):
+    """Convert a shapely geometry to an Esri JSON geometry dict."""
+    if geom is None or geom.is_empty:
+        return None
+
+    sr = {'wkid': wkid}
+
+    if geom.geom_type == 'Point':
+        return {'x': geom.x, 'y': geom.y, 'spatialReference': sr}
+    if geom.geom_type == 'LineString':
+        return {'paths': [[list(x) for x in geom.coords]],
+                'spatialReference': sr}
+    if geom.geom_type == 'MultiLineString':
+        return {'paths': [[list(x) for x in line.coords]
+                          for line in geom.geoms],
+                'spatialReference': sr}
+    if geom.geom_type == 'Polygon':
+        polys = [geom]
+    elif geom.geom_type == 'MultiPolygon':
+        polys = list(geom.geoms)
+    else:
+        raise ValueError(f"Unsupported geometry type {geom.geom_type}")
+
+    rings = []
+    for poly in polys:
+        rings.append([list(x) for x in poly.exterior.coords])
+        rings.extend([list(x) for x in ring.coords]
+                     for ring in poly.interiors)
+    return {'rings': rings, 'spatialReference': sr}
+
+
+class LayerSync(object):
+    """Keep a hosted feature layer in step with a GeoDataFrame.
+
+    The last published state is saved in the cache dir as the
+    layer objectid and a hash of attributes and geometry for
+    every record. Each sync sends only added, changed and
+    removed records through edit_features.
+
+    'key' is the list of columns identifying a record. Records
+    repeating a key are told apart by their order.
+
+    Without a saved state the layer must be overwritten first,
+    then 'bootstrap' reads the objectids it was given. A sync
+    that does not finish drops the state, so the next run
+    overwrites the layer instead of adding records twice.
+    """
+    def __init__(self,
+                 name,
+                 feature_layer,
+                 key,
+                 batch_size=500,
+                 base_dir=None):
+
+        if base_dir is None:
+            base_dir = f"{conf['cache_dir']}/esri_sync"
+
+        self.name = name
+        self.layer = feature_layer
+        self.key = key
+        self.batch_size = batch_size
+        self.path = f"{base_dir}/{name}.pkl"
+        general.create_path_if_not_exists(base_dir)
+
+    @property
+    def state(self):
+        """DataFrame of objectid and row_hash by record key, or None."""
+        if os.path.isfile(self.path):
+            return pd.read_pickle(self.path)
+        return None
+
+    def save_state(self, state):
+        tmp_path = f"{self.path}.tmp"
+        state.to_pickle(tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """Forget the published state, forcing an overwrite."""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def record_keys(self, df):
+        """Return a unique key per record, numbering repeats."""
+        parts = df[self.key].fillna('').astype(str)
+        key = parts[self.key[0]]
+        for col in self.key[1:]:
+            key = key + '\x1f' + parts[col]
+        repeat = key.groupby(key.values).cumcount().astype(str)
+        return pd.Index(key.values + '#' + repeat.values)
+
+    def row_hashes(self, gdf):
+        """Return a hash of attributes and geometry per record."""
+        attrs = gdf.drop(columns=gdf.geometry.name)
+        attr_hash = pd.util.hash_pandas_object(attrs, index=False).values
+        wkb = pd.Series([g.wkb_hex if g is not None else ''
+                         for g in gdf.geometry.values])
+        geom_hash = pd.util.hash_pandas_object(wkb, index=False).values
+        return attr_hash ^ (geom_hash * np.uint64(31))
+
+    def bootstrap(self, gdf):
+        """Save the state of a layer just overwritten with gdf."""
+        oid_field = self.layer.properties.objectIdField
+        fields = ','.join([oid_field] + self.key)
+        features = self.layer.query(out_fields=fields,
+                                    return_geometry=False,
+                                    return_all_records=True).features
+        published = pd.DataFrame([x.attributes for x in features],
+                                 columns=[oid_field] + self.key)
+        published = published.sort_values(by=oid_field)
+
+        state = pd.DataFrame({
+            'objectid': published[oid_field].values
+        }, index=self.record_keys(published))
+
+        hashes = pd.Series(self.row_hashes(gdf),
+                           index=self.record_keys(gdf))
+        # Records without a match are sent again on the next sync
+        matched = state.index.isin(hashes.index)
+        state['row_hash'] = np.uint64(0)
+        state.loc[matched, 'row_hash'] = hashes.reindex(
+            state.index[matched]).values
+
+        logging.info(f"{self.name}: {matched.sum()} of "
+                     f"{published.shape[0]} published records matched")
+        self.save_state(state)
+
+    def to_features(self, gdf, objectids=None):
+        wkid = layer_wkid(self.layer)
+        attrs = gdf.drop(columns=gdf.geometry.name).astype(object)
+        attrs = attrs.where(attrs.notnull(), None)
+        records = attrs.to_dict('records')
+
+        features = []
+        for i, record in enumerate(records):
+            if objectids is not None:
+                record[self.layer.properties.objectIdField] = \
+                    int(objectids[i])
+            feature = {'attributes': record}
+            geometry = esri_geometry(gdf.geometry.values[i], wkid)
+            if geometry is not None:
+                feature['geometry'] = geometry
+            features.append(feature)
+
+        return features
+
+    def apply_edits(self, **edits):
+        """Send one edit_features call and return its results."""
+        results = self.layer.edit_features(**edits)
+        failed = [x for kind in ('addResults', 'updateResults',
+                                 'deleteResults')
+                  for x in results.get(kind, [])
+                  if not x.get('success')]
+        if failed:
+            raise RuntimeError(f"{self.name}: {len(failed)} edits failed, "
+                               f"first error {failed[0].get('error')}")
+        return results
+
+    def sync(self, gdf):
+        """Send the difference between gdf and the published state.
+
+        Returns counts of added, updated and deleted records.
+        """
+        state = self.state
+        if state is None:
+            raise ValueError(f"{self.name} has no published state")
+
+        gdf = gdf.reset_index(drop=True)
+        keys = self.record_keys(gdf)
+        hashes = self.row_hashes(gdf)
+
+        known = keys.isin(state.index)
+        changed = np.zeros(keys.shape[0], dtype=bool)
+        changed[known] = state['row_hash'].reindex(keys[known]).values \
+            != hashes[known]
+        added = ~known
+        deleted = state.loc[~state.index.isin(keys), 'objectid']
+
+        logging.info(f"{self.name}: {added.sum()} adds, "
+                     f"{changed.sum()} updates, {deleted.shape[0]} deletes")
+
+        step = self.batch_size
+
+        if added.any() or changed.any() or not deleted.empty:
+            # Dropped until every edit went through, so a run that
+            # fails or stops partway makes the next one overwrite
+            self.clear()
+
+        for start in range(0, deleted.shape[0], step):
+            oids = deleted.values[start:start + step]
+            self.apply_edits(deletes=','.join(str(int(x)) for x in oids))
+
+        updates = gdf[changed]
+        update_oids = state['objectid'].reindex(keys[changed]).values
+        for start in range(0, updates.shape[0], step):
+            self.apply_edits(updates=self.to_features(
+                updates.iloc[start:start + step],
+                update_oids[start:start + step]))
+
+        adds = gdf[added]
+        add_oids = []
+        for start in range(0, adds.shape[0], step):
+            results = self.apply_edits(adds=self.to_features(
+                adds.iloc[start:start + step]))
+            add_oids.extend(x['objectId'] for x in results['addResults'])
+
+        kept = state.drop(deleted.index)
+        kept.loc[keys[changed], 'row_hash'] = hashes[changed]
+        new = pd.DataFrame({'objectid': add_oids,
+                            'row_hash': hashes[added]},
+                           index=keys[added])
+        self.save_state(pd.concat([kept, new]))
+
+        return {'adds': int(added.sum()),
+                'updates': int(changed.sum()),
+                'deletes': int(deleted.shape[0])}
@@ -1,6 +1,9 @@
 """General.py."""
 import os
+import re
+import gzip
 import errno
+import numpy as np
 import pandas as pd
 import logging
 import requests
@@ -12,6 +15,11 @@ import pendulum
 import subprocess
 import csv
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from airflow.models import Variable
 from airflow.hooks.base_hook import BaseHook
@@ -98,6 +106,7 @@ def buildConfig(env):
         'default_s3_conn_id': 's3data',
         'prod_data_dir': "/data/prod",
         'temp_data_dir': "/data/temp",
+        'cache_dir': "/data/cache",
     }
     return config
 
@@ -228,16 +237,28 @@ def create_path_if_not_exists(path):
     return path
 
 
+pos_csv_defaults = {
+    'index': False,
+    'encoding': 'utf-8',
+    'doublequote': True,
+    'date_format': "%Y-%m-%d",
+    'quoting': csv.QUOTE_ALL
+}
+
+sf_csv_defaults = {
+    'index':False,
+    'header':False,
+    'quoting':csv.QUOTE_MINIMAL,
+    'compression':'gzip',
+    'doublequote':True,
+    'na_rep':"NULL",
+    'date_format':"%Y-%m-%d %H:%M:%S",
+    'escapechar':'\\'
+}
+
 def pos_write_csv(df, fname, **kwargs):
     """Write csv file, creating paths as needed, with default confs."""
-    default = {
-        'index': False,
-        'encoding': 'utf-8',
-        'doublequote': True,
-        'date_format': "%Y-%m-%d",
-        'quoting': csv.QUOTE_ALL
-    }
-    csv_args = default.copy()
+    csv_args = pos_csv_defaults.copy()
     csv_args.update(kwargs)
     try:
         os.makedirs(os.path.dirname(fname))
@@ -250,20 +271,309 @@ def pos_write_csv(df, fname, **kwargs):
 def sf_write_csv(df, fname, **kwargs):
     """ Write compressed csv for snowflake """
     fname_full = f"{config['prod_data_dir']}/{fname}_snowflake.csv.gz"
-    default = {
-        'index':False,
-        'header':False,
-        'quoting':csv.QUOTE_MINIMAL,
-        'compression':'gzip',
-        'doublequote':True,
-        'na_rep':"NULL",
-        'date_format':"%Y-%m-%d %H:%M:%S",
-        'escapechar':'\\'
-    }
-    csv_args = default.copy()
+    csv_args = sf_csv_defaults.copy()
     csv_args.update(kwargs)
     df.to_csv(fname_full, **csv_args)
 
+date_parts = {'%Y': (0, 4), '%m': (5, 7), '%d': (8, 10),
+              '%H': (11, 13), '%M': (14, 16), '%S': (17, 19)}
+
+def format_datetimes(series, fmt):
+    """Format a datetime Series like dt.strftime, but vectorized.
+
+    Formats made of %Y %m %d %H %M %S and literal text are cut
+    out of numpy ISO strings. %z and %Z are empty for naive
+    values, as with strftime. Other directives, and offsets of
+    timezone aware values, fall back to dt.strftime.
+    """
+    tokens = re.findall(r'%.|[^%]', fmt)
+    directives = [x for x in tokens if x.startswith('%') and x != '%%']
+
+    if getattr(series.dt, 'tz', None) is not None:
+        if '%z' in directives or '%Z' in directives:
+            return series.dt.strftime(fmt).values
+        series = series.dt.tz_localize(None)
+
+    if any(x not in date_parts and x not in ('%z', '%Z')
+           for x in directives):
+        return series.dt.strftime(fmt).values
+
+    # Index into the ISO string for each output character,
+    # or the literal character itself
+    chars = []
+    for token in tokens:
+        if token in date_parts:
+            chars.extend(range(*date_parts[token]))
+        elif token in ('%z', '%Z'):
+            continue
+        else:
+            chars.append(token[-1])
+
+    n = series.shape[0]
+    iso = np.datetime_as_string(series.values, unit='s').astype('<U19')
+    iso = iso.view('<U1').reshape(n, 19)
+
+    out = np.empty((n, max(len(chars), 1)), dtype='<U1')
+    for i, char in enumerate(chars):
+        out[:, i] = iso[:, char] if isinstance(char, int) else char
+
+    values = out.view(f'<U{out.shape[1]}').ravel().astype(object)
+    values[series.isnull().values] = np.nan
+    return values
+
+def pos_csv_spec(fname, rows=None, columns=None, **kwargs):
+    """Output spec for pos_write_csvs with pos_write_csv defaults.
+
+    'rows' is an optional boolean mask of rows to write and
+    'columns' an optional list of columns. Other keyword
+    arguments are passed to to_csv.
+    """
+    csv_args = pos_csv_defaults.copy()
+    csv_args.update(kwargs)
+    return {'fname': fname, 'rows': rows, 'columns': columns,
+            'args': csv_args}
+
+def sf_csv_spec(fname, rows=None, columns=None, **kwargs):
+    """Output spec for pos_write_csvs with sf_write_csv defaults."""
+    fname_full = f"{config['prod_data_dir']}/{fname}_snowflake.csv.gz"
+    csv_args = sf_csv_defaults.copy()
+    csv_args.update(kwargs)
+    return {'fname': fname_full, 'rows': rows, 'columns': columns,
+            'args': csv_args}
+
+def pos_write_csvs(df, specs, chunksize=20000, max_workers=None):
+    """Write one DataFrame to many csv files in one pass.
+
+    'specs' is a list of outputs from pos_csv_spec or sf_csv_spec.
+    Rows are written in chunks to every output, so memory stays
+    bounded by the chunk size. Each datetime column is formatted
+    once per chunk for every distinct date_format, and shared by
+    all outputs using that format.
+
+    With max_workers, outputs are written and compressed on
+    worker threads while the next chunk is formatted.
+    """
+    date_cols = [x for x in df.columns
+                 if pd.api.types.is_datetime64_any_dtype(df[x])]
+    formats = {x['args'].get('date_format') for x in specs}
+    formats.discard(None)
+
+    sinks = []
+    for spec in specs:
+        csv_args = spec['args'].copy()
+        encoding = csv_args.pop('encoding', None) or 'utf-8'
+        compression = csv_args.pop('compression', 'infer')
+        if compression == 'infer':
+            compression = 'gzip' if spec['fname'].endswith('.gz') else None
+
+        create_path_if_not_exists(os.path.dirname(spec['fname']))
+        if compression == 'gzip':
+            handle = gzip.open(spec['fname'], 'wt',
+                               encoding=encoding, newline='')
+        elif compression is None:
+            handle = open(spec['fname'], 'w',
+                          encoding=encoding, newline='')
+        else:
+            raise ValueError(f"Unsupported compression {compression}")
+
+        rows = spec['rows']
+        if rows is not None:
+            rows = np.asarray(rows, dtype=bool)
+
+        sinks.append({'handle': handle,
+                      'rows': rows,
+                      'columns': spec['columns'],
+                      'header': csv_args.pop('header', True),
+                      'args': csv_args})
+
+    def write(sink, out, first):
+        out.to_csv(sink['handle'],
+                   header=sink['header'] if first else False,
+                   **sink['args'])
+
+    pool = ThreadPoolExecutor(max_workers=max_workers) \
+        if max_workers else None
+    pending = []
+
+    try:
+        for start in range(0, max(df.shape[0], 1), chunksize):
+            chunk = df.iloc[start:start + chunksize]
+
+            formatted = {}
+            for fmt in formats:
+                formatted[fmt] = {x: format_datetimes(chunk[x], fmt)
+                                  for x in date_cols}
+
+            outs = []
+            for sink in sinks:
+                out = chunk
+                fmt_values = formatted.get(sink['args'].get('date_format'),
+                                           {})
+
+                if sink['rows'] is not None:
+                    mask = sink['rows'][start:start + chunksize]
+                    out = out[mask]
+                    fmt_values = {x: v[mask] for x, v in fmt_values.items()}
+
+                if sink['columns'] is not None:
+                    out = out[sink['columns']]
+
+                fmt_values = {x: v for x, v in fmt_values.items()
+                              if x in out.columns}
+                if fmt_values:
+                    out = out.assign(**fmt_values)
+
+                outs.append((sink, out))
+
+            # The previous chunk is written while this one is formatted
+            for future in pending:
+                future.result()
+
+            if pool is None:
+                for sink, out in outs:
+                    write(sink, out, start == 0)
+            else:
+                pending = [pool.submit(write, sink, out, start == 0)
+                           for sink, out in outs]
+
+        for future in pending:
+            future.result()
+
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for sink in sinks:
+            sink['handle'].close()
+
+def temp_format(fname):
+    """Return the typed file format for a temp file name."""
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in ('.parquet', '.feather'):
+        return ext[1:]
+    raise ValueError(f"{fname} is not a .parquet or .feather file")
+
+def pos_write_temp(df, fname, **kwargs):
+    """Write typed temp file for the next task, keeping dtypes.
+
+    Format follows the extension, .parquet or .feather.
+    The index is dropped, as with pos_write_csv. Object
+    columns holding mixed types are written as strings,
+    which is what reading them back from a csv gives.
+    """
+    fmt = temp_format(fname)
+    create_path_if_not_exists(os.path.dirname(fname))
+
+    df = df.reset_index(drop=True)
+    df.columns = [str(x) for x in df.columns]
+
+    for col in df.columns[(df.dtypes == object).values]:
+        kind = pd.api.types.infer_dtype(df[col], skipna=True)
+        if kind == 'mixed-integer-float':
+            df[col] = pd.to_numeric(df[col])
+        elif kind.startswith('mixed'):
+            logging.info(f"Writing mixed type column {col} as strings")
+            df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+
+    if fmt == 'parquet':
+        df.to_parquet(fname, index=False, **kwargs)
+    else:
+        df.to_feather(fname, **kwargs)
+
+def pos_read_temp(fname, columns=None, **kwargs):
+    """Read typed temp file written by pos_write_temp."""
+    if temp_format(fname) == 'parquet':
+        return pd.read_parquet(fname, columns=columns, **kwargs)
+    else:
+        return pd.read_feather(fname, columns=columns, **kwargs)
+
+def retry_session(retries=5,
+                  backoff_factor=1,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  pool_size=10):
+    """Return a pooled requests Session that retries with backoff.
+
+    Retries cover connection errors and the statuses in
+    'status_forcelist' for GET and POST requests.
+    """
+    methods = frozenset(['GET', 'POST', 'HEAD', 'PUT', 'DELETE'])
+    retry_args = {
+        'total': retries,
+        'backoff_factor': backoff_factor,
+        'status_forcelist': status_forcelist,
+        'raise_on_status': False
+    }
+    try:
+        retry = Retry(allowed_methods=methods, **retry_args)
+    except TypeError:
+        # urllib3 before 1.26
+        retry = Retry(method_whitelist=methods, **retry_args)
+
+    adapter = HTTPAdapter(max_retries=retry,
+                          pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class TokenBucket(object):
+    """Thread-safe token bucket for rate limiting API calls.
+
+    'rate' is the number of calls allowed per second.
+
+    'capacity' is the largest burst allowed, defaults to 'rate'.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def filter_newer_than_max(df,
+                          max_df,
+                          key,
+                          date_col,
+                          max_key=None,
+                          max_date_col=None,
+                          exclude=()):
+    """Keep rows of df dated after the last seen date for their key.
+
+    'max_df' holds the last seen date per key, in 'max_key'
+    and 'max_date_col' (default to 'key' and 'date_col').
+
+    Rows whose key is missing from max_df, or listed in 'exclude',
+    are dropped. Keys are compared as strings and dates that
+    cannot be parsed never match.
+    """
+    max_key = max_key or key
+    max_date_col = max_date_col or date_col
+
+    max_dates = pd.Series(
+        pd.to_datetime(max_df[max_date_col], errors='coerce').values,
+        index=max_df[max_key].astype(str))
+    max_dates = max_dates[~max_dates.index.isin(exclude)]
+    max_dates = max_dates.groupby(level=0).max()
+
+    last_seen = df[key].astype(str).map(max_dates)
+    dates = pd.to_datetime(df[date_col], errors='coerce')
+
+    return df[(dates > last_seen).values]
+
 def file_to_string(rel_file_path, caller=None):
     """Read a file into a string variable.  Caller is __file___."""
     if caller:
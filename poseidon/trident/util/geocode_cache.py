@@ -0,0 +1,233 @@
+"""Persistent cache for geocoder results."""
+import os
+import re
+import json
+import time
+import math
+import hashlib
+import sqlite3
+import logging
+import inspect
+import threading
+import functools
+from trident.util import general
+
+conf = general.config
+
+# Found results are good for months, misses are retried sooner
+DEFAULT_TTL = 180 * 24 * 60 * 60
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 60 * 60
+
+_punct_regex = re.compile(r'[^\w\s]')
+_space_regex = re.compile(r'\s+')
+
+# Geocoders flag request errors here so they are never cached
+_request_state = threading.local()
+
+
+def normalize_address(value):
+    """Normalize one part of an address for use in a cache key."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and math.isnan(value):
+        return ''
+    value = str(value).replace('+', ' ').upper()
+    value = _punct_regex.sub(' ', value)
+    return _space_regex.sub(' ', value).strip()
+
+
+def cache_key(provider, *parts):
+    """Return the normalized address and its content hash."""
+    normal = '|'.join([provider] + [normalize_address(x) for x in parts])
+    digest = hashlib.sha1(normal.encode('utf-8')).hexdigest()
+    return normal, digest
+
+
+def is_empty_result(value):
+    """Return True for a geocoder result that found nothing."""
+    if value is None:
+        return True
+    if isinstance(value, (tuple, list)):
+        return all(is_empty_result(x) for x in value)
+    if isinstance(value, float):
+        return math.isnan(value)
+    return False
+
+
+def mark_failed():
+    """Flag the running geocoder call as a failed request.
+
+    Called from geocoder error handlers so a timeout or
+    a bad response is not stored as a miss.
+    """
+    _request_state.failed = True
+
+
+def clear_failed():
+    """Reset the failure flag before a call to be checked."""
+    _request_state.failed = False
+
+
+def request_failed():
+    """Return True if a geocoder call failed since clear_failed."""
+    return getattr(_request_state, 'failed', False)
+
+
+class GeocodeCache(object):
+    """SQLite store of geocoder results keyed by normalized address."""
+
+    def __init__(self,
+                 path=None,
+                 ttl=DEFAULT_TTL,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL):
+
+        if path is None:
+            path = f"{conf['cache_dir']}/geocode_cache.sqlite"
+
+        general.create_path_if_not_exists(os.path.dirname(path))
+
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        conn = self._connect()
+        conn.execute("""CREATE TABLE IF NOT EXISTS geocodes (
+            key TEXT PRIMARY KEY,
+            provider TEXT,
+            address TEXT,
+            result TEXT,
+            found INTEGER,
+            created REAL)""")
+        conn.commit()
+
+    def _connect(self):
+        """Return the sqlite connection for the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """Return (True, result) for a fresh entry, else (False, None)."""
+        row = self._connect().execute(
+            'SELECT result, found, created FROM geocodes WHERE key = ?',
+            (key,)).fetchone()
+
+        if row is not None:
+            result, found, created = row
+            ttl = self.ttl if found else self.negative_ttl
+            if time.time() - created < ttl:
+                with self._lock:
+                    if found:
+                        self.hits += 1
+                    else:
+                        self.negative_hits += 1
+                return True, json.loads(result)
+
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, key, provider, address, result):
+        """Store a geocoder result, found or not."""
+        conn = self._connect()
+        conn.execute(
+            'INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?)',
+            (key,
+             provider,
+             address,
+             json.dumps(result),
+             0 if is_empty_result(result) else 1,
+             time.time()))
+        conn.commit()
+
+    def purge_expired(self):
+        """Delete entries older than their TTL."""
+        now = time.time()
+        conn = self._connect()
+        cur = conn.execute(
+            'DELETE FROM geocodes WHERE '
+            '(found = 1 AND created < ?) OR (found = 0 AND created < ?)',
+            (now - self.ttl, now - self.negative_ttl))
+        conn.commit()
+        logging.info(f'Purged {cur.rowcount} expired geocodes')
+        return cur.rowcount
+
+    def stats(self):
+        """Return hit and miss counts for this process."""
+        return {'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses}
+
+    def log_stats(self):
+        """Log hit and miss counts for this process."""
+        stats = self.stats()
+        logging.info('Geocode cache: {hits} hits, '
+                     '{negative_hits} negative hits, '
+                     '{misses} misses'.format(**stats))
+        return stats
+
+
+_cache = None
+
+
+def get_cache():
+    """Return the process-wide geocode cache."""
+    global _cache
+    if _cache is None:
+        _cache = GeocodeCache()
+    return _cache
+
+
+def cached_geocoder(provider):
+    """Decorate a geocoder so calls go through the geocode cache.
+
+    The cache key is built from every named argument of
+    the geocoder after normalization. Pass use_cache=False
+    to a decorated geocoder to force a fresh request.
+    """
+    def decorator(func):
+        sig = inspect.signature(func)
+        names = [p.name for p in sig.parameters.values()
+                 if p.kind != inspect.Parameter.VAR_KEYWORD]
+
+        @functools.wraps(func)
+        def wrapper(*args, use_cache=True, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            address, key = cache_key(
+                provider, *[bound.arguments[x] for x in names])
+
+            cache = get_cache()
+
+            if use_cache:
+                found, result = cache.get(key)
+                if found:
+                    return tuple(result) if isinstance(result, list) \
+                        else result
+
+            # Nested geocoder calls share the flag, so keep
+            # the caller's and hand it back with ours added
+            outer = request_failed()
+            _request_state.failed = False
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                failed = _request_state.failed
+                _request_state.failed = outer or failed
+
+            if not failed:
+                cache.set(key, provider, address, result)
+
+            return result
+
+        return wrapper
+
+    return decorator
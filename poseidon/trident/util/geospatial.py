@@ -2,6 +2,11 @@
 import os
 import logging
 from trident.util import general
+from trident.util.geocode_cache import cached_geocoder, mark_failed
+from trident.util.geocode_cache import clear_failed, request_failed
+from trident.util.geocode_cache import cache_key, get_cache
+from trident.util import sql_extract
+from trident.util import address_norm
 
 import requests
 import csv
@@ -24,20 +29,24 @@ import geobuf
 import gzip
 import shutil
 import re
+import io
+import difflib
+from concurrent.futures import ThreadPoolExecutor
 from airflow.models import Variable
 from airflow.hooks.base_hook import BaseHook
 import datetime
 
 conf = general.config
 
-def census_address_geocoder(address_line='',
+def census_single_geocoder(address_line='',
                            locality='San Diego',
                            state='CA',
-                           zip='',
-                           **kwargs):
-    
-    """Geocoding function using Census + Google"""
-    logging.info(address_line)
+                           zip=''):
+    """Geocode one address with the Census endpoint only.
+
+    Returns lat, lon, or None when Census has no match.
+    Raises when the request fails.
+    """
     address_line = address_line.replace(' ','+')
 
     locality = locality.replace(' ','+')
@@ -61,37 +70,54 @@ def census_address_geocoder(address_line='',
                      state=state,
                      zip=zip_append)
 
+    r = requests.get(census_url, timeout=10)
+    body = json.loads(r.content)
+    candidates = body['result']
+
+    if candidates['addressMatches'] == []:
+        return None
+
+    coords = candidates['addressMatches'][0]['coordinates']
+    lat = pd.to_numeric(coords['y'],errors='coerce')
+    lon = pd.to_numeric(coords['x'],errors='coerce')
+    return lat, lon
+
+@cached_geocoder('census')
+def census_address_geocoder(address_line='',
+                           locality='San Diego',
+                           state='CA',
+                           zip='',
+                           **kwargs):
+    
+    """Geocoding function using Census + Google"""
+    logging.info(address_line)
+
     try:
-        r = requests.get(census_url, timeout=10)
-        body = json.loads(r.content)
-        candidates = body['result']
+        coords = census_single_geocoder(address_line=address_line,
+            locality=locality,
+            state=state,
+            zip=zip)
 
-        if candidates['addressMatches'] != []:
-            coords = body['result']['addressMatches'][0]['coordinates']
-            lat = pd.to_numeric(coords['y'],errors='coerce')
-            lon = pd.to_numeric(coords['x'],errors='coerce')
+        if coords is not None:
             logging.info('Geocoded using Census')
-            return lat, lon
+            return coords
 
         else:
             logging.info("Census result not found")
             logging.info("Trying Google")
-            return google_address_geocoder(address_line=address_line,
-                locality=locality,
-                state=state,
-                zip=zip,
-                **kwargs)
-
 
     except Exception as e:
         logging.error(e)
+        mark_failed()
         logging.info('Census geocoder failed, trying Google')
-        return google_address_geocoder(address_line=address_line,
-            locality=locality,
-            state=state,
-            zip=zip,
-            **kwargs)
 
+    return google_address_geocoder(address_line=address_line.replace(' ','+'),
+        locality=locality.replace(' ','+'),
+        state=state.replace(' ','+'),
+        zip=zip,
+        **kwargs)
+
+@cached_geocoder('google')
 def google_address_geocoder(address_line='',
                            locality='San Diego',
                            state='CA',
@@ -157,33 +183,10 @@ def google_address_geocoder(address_line='',
 
     except Exception as e:
         logging.error(e)
+        mark_failed()
         return np.nan, np.nan
 
-def normalize_suffixes(address_str):
-
-    street_regex = re.compile(r'\b[Ss][Tt][Rr]*[eE]*[Tt]*[Ss]*\b')
-    avenue_regex = re.compile(r'\b[Aa][Vv][Ee][Nn]*[Uu]*[Ee]*\b')
-    drive_regex = re.compile(r'\b[Dd][Rr][Ii]*[Vv]*[Ee]*\b')
-    boulevard_regex = re.compile(r'\b[Bb][Oo]*[Uu]*[Ll][Ee]*[Vv][Aa]*[Rr]*[Dd]\b')
-    way_regex = re.compile(r'\b[Ww][Yy]\b')
-    road_regex = re.compile(r'\b[Rr][Oo][Aa][Dd]\b')
-    circle_regex = re.compile(r'\b[Cc][Ii]*[Rr][Cc]*[Ll]*[Ee]*\b')
-    parkway_regex = re.compile(r'\b[Pp][Aa][Rr][Kk][Ww][Aa][Yy]\b')
-    
-    fixed_address = re.sub(street_regex,'St',address_str)
-    fixed_address = re.sub(avenue_regex,'Ave',fixed_address)
-    fixed_address = re.sub(boulevard_regex,'Blvd',fixed_address)
-    fixed_address = re.sub(drive_regex,'Dr',fixed_address)
-    fixed_address = re.sub(way_regex,'Way',fixed_address)
-    fixed_address = re.sub(road_regex,'Rd',fixed_address)
-    fixed_address = re.sub(circle_regex,'Cir',fixed_address)
-    fixed_address = re.sub(parkway_regex,'Pky',fixed_address)
-    
-    # Remove periods
-    fixed_address = fixed_address.replace('.','')
-    
-    return fixed_address
-
+@cached_geocoder('google_components')
 def geocode_address_google(address_line='',
                            locality='San Diego',
                            state='CA',
@@ -227,9 +230,11 @@ def geocode_address_google(address_line='',
                 return lat, lon
         except Exception as e:
             logging.error(e)
+            mark_failed()
             return None, None
 
 
+@cached_geocoder('google_reverse')
 def reverse_geocode_google(lat='', lon='', **kwargs):
     """Reverse geocoding function using Google geocoding API."""
     google_token = Variable.get("GOOGLE_TOKEN")
@@ -260,9 +265,11 @@ def reverse_geocode_google(lat='', lon='', **kwargs):
                     return address
         except Exception as e:
             logging.error(e)
+            mark_failed()
             return None
 
 
+@cached_geocoder('esri')
 def geocode_address_esri(address_line='', **kwargs):
     """Geocoding function using SANDAG geocoder."""
     # Type safe
@@ -292,15 +299,536 @@ def geocode_address_esri(address_line='', **kwargs):
             candidates[0]['location']['x']
 
 
+# Calls per second allowed for each provider in batch_geocode
+geocoder_rates = {
+    'census_batch': 2,
+    'census': 10,
+    'google': 40
+}
+
+
+def census_batch_geocoder(addresses):
+    """Geocode up to 10,000 addresses with one Census batch request.
+
+    'addresses' is a DataFrame with id, address, city, state
+    and zip columns.
+
+    Returns a DataFrame indexed by id with lat, lon and
+    match_quality. Unmatched addresses have null coordinates.
+    """
+    url = 'https://geocoding.geo.census.gov/geocoder/locations/addressbatch'
+
+    buf = io.StringIO()
+    addresses[['id', 'address', 'city', 'state', 'zip']].to_csv(
+        buf, index=False, header=False)
+
+    r = requests.post(url,
+        files={'addressFile': ('addresses.csv', buf.getvalue(), 'text/csv')},
+        data={'benchmark': '4'},
+        timeout=600)
+    r.raise_for_status()
+
+    records = []
+    for row in csv.reader(io.StringIO(r.text)):
+        if len(row) < 3:
+            continue
+        lat = lon = np.nan
+        quality = row[2]
+        if row[2] == 'Match' and len(row) > 5:
+            quality = row[3]
+            lon, lat = [float(x) for x in row[5].split(',')]
+        records.append((row[0], lat, lon, quality))
+
+    results = pd.DataFrame.from_records(records,
+        columns=['id', 'lat', 'lon', 'match_quality'])
+
+    return results.set_index('id')
+
+
+def batch_geocode(df,
+                  address='address',
+                  city=None,
+                  state=None,
+                  zip=None,
+                  locality='San Diego',
+                  default_state='CA',
+                  max_workers=8,
+                  batch_size=1000,
+                  fallback=True,
+                  local=True):
+    """Geocode a DataFrame of addresses concurrently.
+
+    'address', 'city', 'state' and 'zip' are column names in df.
+    If 'city' or 'state' is None, 'locality' and 'default_state'
+    are used for every row. If 'zip' is None, no zip is sent.
+
+    If 'local' is True, unique addresses in San Diego are first
+    matched against the city's address points. The others are
+    checked against the geocode cache, the rest are sent to the Census batch endpoint in chunks of
+    'batch_size'. Anything Census cannot match goes to Google
+    one by one if 'fallback' is True. Addresses no provider
+    matches are cached as misses, unless a request failed. Requests run on a pool of
+    'max_workers' threads, rate limited per provider.
+
+    Returns a DataFrame with the index of df and lat, lon,
+    provider and match_quality columns.
+    """
+    logging.info(f'Batch geocoding {df.shape[0]} rows')
+
+    def column(col, default):
+        if col is None:
+            return pd.Series(default, index=df.index)
+        return df[col].fillna('').astype(str)
+
+    query = pd.DataFrame({
+        'address': column(address, ''),
+        'city': column(city, locality),
+        'state': column(state, default_state),
+        'zip': column(zip, '')
+        }, index=df.index)
+
+    keys = [cache_key('census', *x)[1] for x in query.itertuples(index=False)]
+    query['key'] = keys
+
+    unique = query.drop_duplicates(subset='key').set_index('key', drop=False)
+    unique = unique[unique['address'].str.strip() != '']
+    logging.info(f'{unique.shape[0]} unique addresses to geocode')
+
+    results = pd.DataFrame(np.nan,
+        index=unique.index,
+        columns=['lat', 'lon'])
+    results['provider'] = None
+    results['match_quality'] = None
+
+    if local:
+        in_city = unique['city'].str.strip().str.upper() == 'SAN DIEGO'
+        points = local_geocode(unique.loc[in_city, 'address'],
+                               unique.loc[in_city, 'zip'])
+        points = points[points['lat'].notnull()]
+        results.loc[points.index, ['lat', 'lon']] = \
+            points[['lat', 'lon']].values
+        results.loc[points.index, 'match_quality'] = \
+            points['match_quality'].values
+        results.loc[points.index, 'provider'] = 'addrapn'
+
+    cache = get_cache()
+
+    for key in unique.index[results['provider'].isnull()]:
+        found, result = cache.get(key)
+        if found and result is not None:
+            results.loc[key, ['lat', 'lon']] = result[0], result[1]
+            results.loc[key, 'provider'] = 'cache'
+
+    todo = unique[results['provider'].isnull()]
+    logging.info(f'{unique.shape[0] - todo.shape[0]} addresses found '
+                 'in address points or cache')
+
+    limits = {k: general.TokenBucket(v) for k, v in geocoder_rates.items()}
+
+    def census_chunk(chunk):
+        limits['census_batch'].acquire()
+        try:
+            return census_batch_geocoder(chunk.rename(columns={'key': 'id'}))
+        except Exception as e:
+            logging.error(e)
+            logging.info('Census batch failed, geocoding chunk one by one')
+
+        # Failed requests keep a null match_quality, so they
+        # are not cached as misses
+        records = []
+        for row in chunk.itertuples(index=False):
+            limits['census'].acquire()
+            try:
+                coords = census_single_geocoder(address_line=row.address,
+                    locality=row.city,
+                    state=row.state,
+                    zip=row.zip)
+            except Exception as e:
+                logging.error(e)
+                records.append((row.key, np.nan, np.nan, None))
+                continue
+            if coords is None:
+                records.append((row.key, np.nan, np.nan, 'No_Match'))
+            else:
+                records.append((row.key, coords[0], coords[1], 'Single'))
+        return pd.DataFrame.from_records(records,
+            columns=['id', 'lat', 'lon', 'match_quality']).set_index('id')
+
+    def google_one(row):
+        limits['google'].acquire()
+        clear_failed()
+        coords = google_address_geocoder(address_line=row.address,
+            locality=row.city,
+            state=row.state,
+            zip=row.zip)
+        return coords, request_failed()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+        chunks = [todo.iloc[i:i + batch_size]
+                  for i in range(0, todo.shape[0], batch_size)]
+
+        for census in pool.map(census_chunk, chunks):
+            census = census[census.index.isin(results.index)]
+            matched = census[census['lat'].notnull()]
+            results.loc[matched.index, ['lat', 'lon']] = \
+                matched[['lat', 'lon']].values
+            results.loc[matched.index, 'provider'] = 'census'
+            results.loc[census.index, 'match_quality'] = \
+                census['match_quality'].values
+            for key, lat, lon in matched[['lat', 'lon']].itertuples():
+                cache.set(key, 'census', unique.loc[key, 'address'],
+                    (lat, lon))
+
+        missing = todo[results.loc[todo.index, 'lat'].isnull().values]
+        # Addresses Census answered for, as opposed to failed requests
+        answered = results.loc[missing.index, 'match_quality'].notnull()
+        misses = missing[answered.values]
+
+        if fallback and not missing.empty:
+            logging.info(f'Trying Google for {missing.shape[0]} addresses')
+            rows = list(missing.itertuples(index=False))
+            google = list(pool.map(google_one, rows))
+            failed = set()
+            for i, row in enumerate(rows):
+                (lat, lon), google_failed = google[i]
+                if google_failed:
+                    failed.add(row.key)
+                if not pd.isnull(lat):
+                    results.loc[row.key, ['lat', 'lon']] = lat, lon
+                    results.loc[row.key, 'provider'] = 'google'
+                    cache.set(row.key, 'census', row.address, (lat, lon))
+            misses = misses[~misses.index.isin(failed)]
+            misses = misses[results.loc[misses.index, 'lat'].isnull().values]
+
+        for row in misses.itertuples(index=False):
+            cache.set(row.key, 'census', row.address, (np.nan, np.nan))
+
+    cache.log_stats()
+
+    final = pd.merge(query[['key']],
+        results,
+        how='left',
+        left_on='key',
+        right_index=True)
+
+    logging.info(f"Geocoded {final['lat'].notnull().sum()} of {df.shape[0]} rows")
+
+    return final.drop(columns=['key'])
+
+
+def _join_parts(parts, cols):
+    return address_norm.join_parts(parts[cols], sep='|')
+
+
+class AddressIndex(object):
+    """In memory index of address points for offline geocoding.
+
+    'points' is a DataFrame with the address parts returned by
+    parse_addresses, zip, lat and lon.
+
+    Addresses are looked up by all their parts first, then
+    without directions, the suffix or both, using only keys
+    that point to a single address. Then misspelled street names
+    are corrected to the closest known name, and a house number
+    missing from the index takes the nearest number on the same
+    side of the same street, up to 'max_gap' numbers away.
+
+    When the caller has a zip for an address, a match only
+    counts if the address point has the same zip. This keeps
+    a street sharing its name with one outside the city from
+    taking city coordinates.
+    """
+    # Parts matched at each step, and the match quality reported
+    tiers = [
+        (['number', 'predir', 'name', 'suffix', 'postdir'], 'Exact'),
+        (['number', 'name', 'suffix'], 'Non_Exact'),
+        (['number', 'predir', 'name', 'postdir'], 'Non_Exact'),
+        (['number', 'name'], 'Non_Exact')
+    ]
+
+    street = ['predir', 'name', 'suffix', 'postdir']
+
+    def __init__(self, points, max_gap=20, name_cutoff=0.8):
+        points = points[(points['number'] != '') & (points['name'] != '')]
+        points = points.groupby(['number'] + self.street,
+                                as_index=False).agg(lat=('lat', 'mean'),
+                                                    lon=('lon', 'mean'),
+                                                    zip=('zip', 'first'))
+
+        self.max_gap = max_gap
+        self.name_cutoff = name_cutoff
+        self.names = set(points['name'])
+        self.tables = []
+
+        for cols, quality in self.tiers:
+            key = _join_parts(points, cols)
+            unique = key.groupby(key.values).transform('size') == 1
+            table = points.loc[unique.values, ['lat', 'lon', 'zip']]
+            table.index = key[unique]
+            self.tables.append((cols, quality, table))
+
+        streets = points.assign(number=points['number'].astype(int))
+        streets['street'] = _join_parts(streets, self.street) + '|' \
+            + (streets['number'] % 2).astype(str)
+        self.streets = streets[['street', 'number', 'lat', 'lon', 'zip']] \
+            .sort_values(by='number')
+
+        logging.info(f"Address index holds {points.shape[0]} addresses")
+
+    def closest_names(self, names):
+        """Map unknown street names to the closest known name."""
+        known = sorted(self.names)
+        fixed = {}
+        for name in names:
+            if name == '' or name in self.names:
+                continue
+            match = difflib.get_close_matches(name, known, n=1,
+                                              cutoff=self.name_cutoff)
+            if match:
+                fixed[name] = match[0]
+        return fixed
+
+    def nearest(self, parts):
+        """Match house numbers to the nearest number on the street."""
+        query = parts[parts['number'] != ''].copy()
+        query['number'] = query['number'].astype(int)
+        query['street'] = _join_parts(query, self.street) + '|' \
+            + (query['number'] % 2).astype(str)
+        query['row'] = query.index
+        query = query.sort_values(by='number')
+
+        found = pd.merge_asof(query[['row', 'street', 'number']],
+                              self.streets,
+                              on='number',
+                              by='street',
+                              direction='nearest',
+                              tolerance=self.max_gap)
+        found = found.set_index('row')[['lat', 'lon', 'zip']]
+        return found[found['lat'].notnull()]
+
+    def match(self, parts, zips=None):
+        """Return lat, lon and match_quality for parsed addresses.
+
+        'zips' is an optional Series of 5 digit zips with the
+        index of parts, blank where unknown.
+        """
+        results = pd.DataFrame(np.nan, index=parts.index,
+                               columns=['lat', 'lon'])
+        results['match_quality'] = None
+
+        def fill(found, quality):
+            found = found[results.loc[found.index, 'lat'].isnull().values]
+            if zips is not None:
+                wanted = zips.reindex(found.index).values
+                found = found[(wanted == '')
+                              | (found['zip'].values == wanted)]
+            results.loc[found.index, ['lat', 'lon']] = \
+                found[['lat', 'lon']].values
+            results.loc[found.index, 'match_quality'] = quality
+
+        def lookup(todo, exact):
+            for cols, quality, table in self.tables:
+                key = _join_parts(todo, cols)
+                found = table.reindex(key.values)
+                found.index = todo.index
+                fill(found[found['lat'].notnull()],
+                     quality if exact else 'Non_Exact')
+                todo = todo[results.loc[todo.index, 'lat'].isnull().values]
+            fill(self.nearest(todo), 'Nearby')
+
+        lookup(parts[parts['number'] != ''], True)
+
+        todo = parts[results['lat'].isnull().values
+                     & (parts['number'] != '').values]
+        fixed = self.closest_names(todo['name'].unique())
+        if fixed:
+            todo = todo[todo['name'].isin(list(fixed))].copy()
+            todo['name'] = todo['name'].map(fixed)
+            lookup(todo, False)
+
+        return results
+
+
+addrapn_layer = f"{conf['prod_data_dir']}/addrapn_datasd.shp"
+
+# Bumped when the columns of cached address points change
+address_points_version = 3
+
+_address_index = None
+_apn_addresses = None
+
+def normalize_zips(zips):
+    """Return a Series of zips as 5 digit strings, blank if invalid."""
+    zips = zips.fillna('').astype(str).str.strip()
+    zips = zips.str.replace(r'\.0+$', '', regex=True)
+    return zips.str.extract(r'^(\d{5})', expand=False).fillna('')
+
+def load_address_points(layer=addrapn_layer):
+    """Read the address point layer as parsed parts, apn, zip, lat and lon.
+
+    The parsed points are cached in the cache dir until the
+    layer or the cached format changes.
+    """
+    stamp = [address_points_version,
+             os.path.getmtime(layer),
+             os.path.getsize(layer)]
+    cache_file = f"{conf['cache_dir']}/geocoder/address_points.pkl"
+
+    if os.path.isfile(cache_file):
+        cached = pd.read_pickle(cache_file)
+        if cached['stamp'] == stamp and cached['layer'] == layer:
+            return cached['points']
+
+    logging.info(f"Reading address points from {layer}")
+    gdf = gpd.read_file(layer)
+    gdf = gdf[gdf.geometry.notnull()].to_crs(epsg=4326)
+
+    number = pd.to_numeric(gdf['addrnmbr'], errors='coerce')
+    apn = pd.to_numeric(gdf['apn'], errors='coerce').fillna(0)
+    points = pd.DataFrame({
+        'number': number.fillna(0).astype(int).astype(str),
+        'predir': gdf['addrpdir'].fillna('').str.strip().str.upper()
+            .map(address_norm.street_directions).fillna(''),
+        'name': address_norm.normalize_street_names(gdf['addrname']),
+        'suffix': gdf['addrsfx'].fillna('').str.strip().str.upper()
+            .map(address_norm.street_suffixes).fillna(''),
+        'postdir': gdf['addrpostd'].fillna('').str.strip().str.upper()
+            .map(address_norm.street_directions).fillna(''),
+        'apn': apn.astype('int64').astype(str).str.zfill(10),
+        'zip': normalize_zips(gdf['addrzip']),
+        'lat': gdf.geometry.y.values,
+        'lon': gdf.geometry.x.values
+        })
+    points.loc[number.fillna(0).values <= 0, 'number'] = ''
+    points.loc[apn.values <= 0, 'apn'] = ''
+
+    general.create_path_if_not_exists(os.path.dirname(cache_file))
+    tmp_file = f"{cache_file}.{os.getpid()}"
+    pd.to_pickle({'stamp': stamp, 'layer': layer, 'points': points},
+                 tmp_file)
+    os.replace(tmp_file, cache_file)
+
+    return points
+
+def get_address_index():
+    """Return the process-wide address index, or None without one."""
+    global _address_index
+    if _address_index is None:
+        if not os.path.isfile(addrapn_layer):
+            logging.info(f"No address points at {addrapn_layer}")
+            return None
+        _address_index = AddressIndex(load_address_points())
+    return _address_index
+
+def normalize_apns(apns):
+    """Return a Series of APNs as 10 digit strings, blank if invalid."""
+    apns = apns.fillna('').astype(str).str.strip()
+    apns = apns.str.replace(r'\.0+$', '', regex=True)
+    apns = apns.str.replace(r'\D', '', regex=True)
+    return apns.where(apns.str.len() == 10, '')
+
+def get_apn_addresses():
+    """Return situs addresses indexed by APN, or None without points.
+
+    Parcels with several address points take the lowest house
+    number. The table follows the address point layer, so it
+    is rebuilt whenever the addrapn DAG refreshes the layer.
+    """
+    global _apn_addresses
+    if _apn_addresses is None:
+        if not os.path.isfile(addrapn_layer):
+            logging.info(f"No address points at {addrapn_layer}")
+            return None
+        points = load_address_points()
+        points = points[(points['apn'] != '') & (points['number'] != '')]
+        points = points.assign(order=points['number'].astype(int)) \
+            .sort_values(by=['apn', 'order'], kind='mergesort')
+
+        situs = address_norm.canonical_key(points)
+        _apn_addresses = situs.groupby(points['apn'].values).first()
+        logging.info(f"APN index holds {_apn_addresses.shape[0]} parcels")
+    return _apn_addresses
+
+def addresses_for_apns(apns, remote=True):
+    """Return the situs address for each APN in a Series.
+
+    APNs are joined to the address point table in one pass.
+    Only APNs missing from it are sent to the SANDAG parcel
+    service, once per unique APN, when 'remote' is True.
+
+    Returns a Series with the index of apns, null where no
+    address was found.
+    """
+    table = get_apn_addresses()
+    if table is None:
+        addresses = pd.Series(np.nan, index=apns.index, dtype=object)
+    else:
+        addresses = normalize_apns(apns).map(table)
+
+    given = apns.fillna('').astype(str).str.strip() != ''
+    missing = (addresses.isnull() & given).values
+    logging.info(f"Found {(addresses.notnull() & given).sum()} of "
+                 f"{given.sum()} APNs in address points")
+
+    if remote and missing.any():
+        unique = apns[missing].unique()
+        logging.info(f"Looking up {unique.shape[0]} APNs from SANDAG")
+        found = {x: get_address_for_apn(x) for x in unique}
+        addresses[missing] = apns[missing].map(found).values
+
+    return addresses
+
+def local_geocode(addresses, zips=None):
+    """Geocode a Series of street addresses against address points.
+
+    Only addresses within the city are in the index, so callers
+    should send other places to a web geocoder. 'zips' is an
+    optional Series of zips with the index of addresses. An
+    address with a zip only matches points in that zip. Each
+    unique address and zip is matched once.
+
+    Returns a DataFrame with the index of addresses and lat,
+    lon and match_quality columns. Misses have null coordinates.
+    """
+    results = pd.DataFrame(np.nan, index=addresses.index,
+                           columns=['lat', 'lon'])
+    results['match_quality'] = None
+
+    index = get_address_index()
+    if index is None or addresses.empty:
+        return results
+
+    query = pd.DataFrame({
+        'address': addresses.fillna('').astype(str),
+        'zip': '' if zips is None else normalize_zips(zips)
+        }, index=addresses.index)
+
+    unique = query.drop_duplicates().reset_index(drop=True)
+    found = index.match(address_norm.parse_addresses(unique['address']),
+                        unique['zip'])
+    found.index = pd.MultiIndex.from_frame(unique)
+
+    results = found.reindex(pd.MultiIndex.from_frame(query))
+    results.index = addresses.index
+
+    logging.info(f"Geocoded {results['lat'].notnull().sum()} of "
+                 f"{addresses.shape[0]} addresses from address points")
+
+    return results
+
+
 def df_to_geodf_pt(df, lat='lat', lon='lon'):
     """Convert a dataframe with lat/lon (points) to a Geodataframe."""
     logging.info('Converting points df to geodf.')
-    df = df[np.isfinite(df[lat])]
-    df = df[np.isfinite(df[lon])]
-    df = df[df[lat] != 0]
-    df = df[df[lon] != 0]
-    df['geometry'] = df.apply(lambda z: Point(z[lon], z[lat]), axis=1)
-    gdf = gpd.GeoDataFrame(df)
+    lat_arr = pd.to_numeric(df[lat], errors='coerce').to_numpy(dtype=float)
+    lon_arr = pd.to_numeric(df[lon], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(lat_arr) & np.isfinite(lon_arr) \
+        & (lat_arr != 0) & (lon_arr != 0)
+    df = df.loc[valid].copy()
+    # Build every point in one pass from the coordinate arrays
+    df['geometry'] = gpd.points_from_xy(lon_arr[valid], lat_arr[valid])
+    gdf = gpd.GeoDataFrame(df, geometry='geometry')
     logging.info('Successfully created a geodf from points df.')
     return gdf
 
@@ -313,6 +841,67 @@ def geojson_to_geodf(file):
     return gdf
 
 
+# Polygon layers already read in this process, keyed by path.
+# Each entry is (modified time, geodf with a built spatial index).
+_poly_layers = {}
+
+
+def load_poly_layer(poly_file):
+    """Load a polygon geojson once per process with its spatial index.
+
+    The layer is read again only if the file changes on disk.
+    """
+    if isinstance(poly_file, gpd.GeoDataFrame):
+        poly = poly_file
+        poly.sindex
+        return poly
+
+    mtime = os.path.getmtime(poly_file)
+    cached = _poly_layers.get(poly_file)
+
+    if cached is not None and cached[0] == mtime:
+        logging.info(f'Using cached poly layer {poly_file}')
+        return cached[1]
+
+    logging.info(f'Loading poly file {poly_file} as geodf')
+    poly = geojson_to_geodf(poly_file).reset_index(drop=True)
+    logging.info('Building spatial index')
+    # sindex is built lazily, so touch it here to keep it with the layer
+    poly.sindex
+    _poly_layers[poly_file] = (mtime, poly)
+
+    return poly
+
+
+def poly_layer_matches(pt, poly):
+    """Return poly attributes for each point inside exactly one polygon.
+
+    'pt' is a Geodataframe of points.
+
+    'poly' is a polygon Geodataframe with a spatial index.
+
+    Returns the matches, indexed by the index of 'pt', and the
+    index of points dropped for falling in more than one polygon.
+    Points that fall in no polygon are left out of the matches.
+    """
+    pt_pos, poly_pos = poly.sindex.query_bulk(pt.geometry,
+                                              predicate='intersects')
+
+    # We will not keep the results for points
+    # that join to multiple polygons
+    counts = np.bincount(pt_pos, minlength=len(pt))
+    multi = pt.index[counts > 1]
+    single = counts[pt_pos] == 1
+    pt_pos = pt_pos[single]
+    poly_pos = poly_pos[single]
+
+    attrs = pd.DataFrame(poly.drop(columns=poly.geometry.name))
+    matches = attrs.iloc[poly_pos]
+    matches.index = pt.index[pt_pos]
+
+    return matches, multi
+
+
 def spatial_join_pt(pt_file, poly_file, lat='lat', lon='lon'):
     """Spatially join polygon attributes to point data.
 
@@ -342,29 +931,77 @@ def spatial_join_pt(pt_file, poly_file, lat='lat', lon='lon'):
 
     df = df.reset_index(drop=True)
     df_cols = df.columns.values.tolist()
-    
+
     logging.info('Converting point file to geodf')
     pt = df_to_geodf_pt(df, lat, lon)
-    logging.info('Loading poly file as geodf')
-    poly = geojson_to_geodf(poly_file)
+    poly = load_poly_layer(poly_file)
     pt.crs = poly.crs
     logging.info(f'Set point to {pt.crs} to match {poly.crs}')
-    
+
     logging.info('Operating spatial join.')
-    pt_join = sjoin(pt, poly, how='left')
-    pt_join = pt_join.drop(['geometry', 'index_right'], axis=1)
-    
+    matches, multi = poly_layer_matches(pt, poly)
+    if not multi.empty:
+        logging.info(f'Dropped {multi.shape[0]} points in more '
+                     'than one polygon')
     logging.info('Successfully spatially joined data.')
-    join_cols = pt_join.columns.values.tolist()
-    new_cols = [x for x in join_cols if x not in df_cols]
 
-    # We will not keep the results for points 
-    # that join to multiple polygons
-    pt_join = pt_join.reset_index().drop_duplicates(subset="index",keep=False).set_index("index")
-    
+    # Keep sjoin's naming for columns found in both layers
+    overlap = [x for x in matches.columns if x in df_cols]
+    if overlap:
+        matches = matches.rename(columns={x: f'{x}_right' for x in overlap})
+        kept = pt.index.difference(multi)
+        left = df.loc[kept, overlap].add_suffix('_left')
+        matches = pd.concat([left, matches], axis=1, sort=False)
+
     # We must join the result back to original dataframe to keep all rows
-    final = pd.merge(df,pt_join[new_cols],left_index=True,right_index=True,how="left")
-    
+    final = pd.merge(df,matches,left_index=True,right_index=True,how="left")
+
+    logging.info('Finished with {} rows'.format(final.shape[0]))
+    return final
+
+
+def spatial_join_pt_multi(pt_file, layers, lat='lat', lon='lon'):
+    """Spatially join several polygon layers to point data in one pass.
+
+    'pt_file' is a csv file or a DataFrame with point coordinates.
+
+    'layers' is a list of (poly_file, columns) pairs. 'columns' is a
+    dict mapping polygon attributes to output column names, or None
+    to keep every attribute under its own name.
+
+    Points are built once and each layer is matched with its
+    spatial index. As with spatial_join_pt, points that fall in
+    more than one polygon of a layer get no value for that layer.
+
+    This function returns a DataFrame, not a Geodataframe.
+    """
+    if isinstance(pt_file,str):
+        logging.info('Loading point file')
+        df = pd.read_csv(pt_file,low_memory=False)
+    else:
+        df = pt_file
+
+    logging.info('Starting with {} rows in point file'.format(df.shape[0]))
+
+    df = df.reset_index(drop=True)
+    pt = df_to_geodf_pt(df, lat, lon)
+    joined = []
+
+    for poly_file, columns in layers:
+        poly = load_poly_layer(poly_file)
+        pt.crs = poly.crs
+        logging.info(f'Joining {poly_file}')
+        matches, multi = poly_layer_matches(pt, poly)
+        if not multi.empty:
+            logging.info(f'Dropped {multi.shape[0]} points in more '
+                         'than one polygon')
+        if columns is not None:
+            matches = matches[list(columns)].rename(columns=columns)
+        joined.append(matches)
+
+    new_cols = pd.concat(joined, axis=1, sort=False)
+    final = pd.merge(df,new_cols,left_index=True,right_index=True,how="left")
+
     logging.info('Finished with {} rows'.format(final.shape[0]))
     return final
 
@@ -399,20 +1036,32 @@ def extract_sde_data(table, where=''):
                 + " WHERE {where}"
         query = query.format(table=table, where=where)
 
-    df = pd.read_sql(query, sde_conn)
-
-    date_cols = [col for col in df.columns if df[col].dtype == 'datetime64[ns]']
-
-    if len(date_cols) > 0:
+    # Fetch in batches, converting dates before the next batch
+    frames = []
+    for batch in sql_extract.fetch_batches(sde_conn, query):
+        date_cols = [col for col in batch.columns
+                     if batch[col].dtype == 'datetime64[ns]']
         for dc in date_cols:
-            df[dc] = df[dc].astype(str)
+            batch[dc] = batch[dc].astype(str)
+        frames.append(batch)
+
+    sde_conn.close()
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    df = sql_extract.to_numpy_dtypes(df)
 
     logging.info(df.columns)
     df.columns = [x.lower() for x in df.columns]
     df = df.drop('shape', 1)
     return df
 
-def df2shp(df, folder, layername, dtypes, gtype, epsg):
+def wkt_to_geoms(wkt):
+    """Parse a Series of WKT strings into shapely geometries."""
+    if hasattr(gpd.GeoSeries, 'from_wkt'):
+        return gpd.GeoSeries.from_wkt(wkt).values
+    return [loads(x) for x in wkt]
+
+
+def df2shp(df, folder, layername, dtypes, gtype, epsg, batch_size=10000):
     """Convert a processed df to a shapefile.
 
     'df' is a dataframe.
@@ -427,9 +1076,30 @@ def df2shp(df, folder, layername, dtypes, gtype, epsg):
 
     'epsg' is the EPSG code of the output.
 
+    Records are built column-wise and written 'batch_size' at a time.
+
     """
     schema = {'geometry': gtype, 'properties': dtypes}
 
+    df = df[df['geom'] != 'POINT EMPTY']
+    props = df[list(dtypes)].astype(object)
+
+    # Format dates once per column, matching values by exact type
+    for prop in dtypes:
+        col = props[prop]
+        types = col.map(type)
+        for dtype, fmt in ((datetime.datetime, '%Y-%m-%d %H:%M:%S'),
+                           (datetime.date, '%Y-%m-%d')):
+            is_type = (types == dtype).values
+            if is_type.any():
+                col = col.copy()
+                col[is_type] = col[is_type].map(lambda x: x.strftime(fmt))
+        props[prop] = col
+
+    keys = list(dtypes)
+    rows = props.values.tolist()
+    wkt = df['geom']
+
     with fiona.collection(
         folder + '/' + layername + '.shp',
         'w',
@@ -437,18 +1107,12 @@ def df2shp(df, folder, layername, dtypes, gtype, epsg):
         crs=crs.from_epsg(epsg),
         schema=schema
     ) as shpfile:
-        for index, row in df.iterrows():
-            if row['geom'] != 'POINT EMPTY':
-                geometry = loads(row['geom'])
-                props = {}
-                for prop in dtypes:
-                    if type(row[prop]) is datetime.datetime:
-                        props[prop] = row[prop].strftime('%Y-%m-%d %H:%M:%S')
-                    elif type(row[prop]) is datetime.date:
-                        props[prop] = row[prop].strftime('%Y-%m-%d')
-                    else:
-                        props[prop] = row[prop]
-                shpfile.write({'properties': props, 'geometry': mapping(geometry)})
+        for start in range(0, len(rows), batch_size):
+            geoms = wkt_to_geoms(wkt.iloc[start:start + batch_size])
+            shpfile.writerecords([
+                {'properties': dict(zip(keys, row)),
+                 'geometry': mapping(geom)}
+                for row, geom in zip(rows[start:start + batch_size], geoms)])
 
     return 'Extracted {layername} shapefile.'.format(layername=layername)
 
@@ -568,6 +1232,7 @@ def pt_proj_conversion(lon, lat, in_proj=2230, out_proj=4326):
 
 
 
+@cached_geocoder('sandag_apn')
 def get_address_for_apn(apn):
 
     url = "https://gissd.sandag.org/rdw/rest/services/Parcel/Parcels/MapServer/1/query"
@@ -619,4 +1284,5 @@ def get_address_for_apn(apn):
         apn_info = data['features'][0]['attributes']
         return "{} {} {}".format(apn_info['SITUS_ADDRESS'], apn_info['SITUS_STREET'], apn_info['SITUS_SUFFIX'])
     else:
+        mark_failed()
         return f"APN: {apn}"
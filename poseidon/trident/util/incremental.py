@@ -0,0 +1,228 @@
+"""Watermark based incremental extraction from databases."""
+import io
+import os
+import json
+import string
+import logging
+import pandas as pd
+from datetime import datetime, timedelta
+from trident.util import general
+from trident.util import sql_extract
+
+conf = general.config
+
+# Far enough back to select every row on a full refresh
+EPOCH = datetime(1900, 1, 1)
+
+
+class Watermark(object):
+    """High-water mark of a dataset extracted incrementally.
+
+    State is a json file in the cache dir holding the highest
+    value of 'column' seen so far, and when the last full
+    refresh ran.
+
+    'lookback' is subtracted from the watermark when templating
+    it into SQL, so rows that land late, or share the boundary
+    value, are selected again. They are merged by key, so
+    reading them twice is harmless.
+
+    'refresh' is how often to fall back to a full extract,
+    which also drops rows deleted at the source.
+    """
+    def __init__(self,
+                 name,
+                 column,
+                 lookback=timedelta(0),
+                 refresh=timedelta(days=7),
+                 base_dir=None):
+
+        if base_dir is None:
+            base_dir = f"{conf['cache_dir']}/watermarks"
+
+        self.name = name
+        self.column = column
+        self.lookback = lookback
+        self.refresh = refresh
+        self.path = f"{base_dir}/{name}.json"
+        general.create_path_if_not_exists(base_dir)
+
+    def load(self):
+        """Return the saved state, or None before the first run."""
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        return {k: datetime.strptime(v, '%Y-%m-%d %H:%M:%S')
+                for k, v in state.items()}
+
+    def save(self, watermark, last_full):
+        state = {'watermark': watermark, 'last_full': last_full}
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({k: v.strftime('%Y-%m-%d %H:%M:%S')
+                       for k, v in state.items()}, f)
+        os.replace(tmp_path, self.path)
+
+    def needs_full(self, fname):
+        """Return True when the next extract must be a full one."""
+        state = self.load()
+        if state is None or not os.path.isfile(fname):
+            return True
+        return datetime.now() - state['last_full'] >= self.refresh
+
+    def since(self, full):
+        """Return the lower bound to template into SQL."""
+        if full:
+            return EPOCH
+        return self.load()['watermark'] - self.lookback
+
+
+def render_rows(df, **kwargs):
+    """Return the strings pos_write_csv would write for df."""
+    csv_args = general.pos_csv_defaults.copy()
+    csv_args.update(kwargs)
+    csv_args.pop('encoding')
+    buf = io.StringIO()
+    df.to_csv(buf, **csv_args)
+    buf.seek(0)
+    return pd.read_csv(buf, dtype=str, keep_default_na=False)
+
+
+def match_number_format(delta, current):
+    """Write whole numbers in delta the way current writes them.
+
+    Both are rendered csv values. In a column where current
+    writes every number as 5.0, delta's 5 becomes 5.0, and
+    where it writes 5, delta's 5.0 becomes 5, so merged rows
+    read like their neighbours whatever dtypes the delta got.
+    """
+    for col in delta.columns.intersection(current.columns):
+        written = current[col][current[col] != '']
+        if written.empty:
+            continue
+        values = delta[col]
+        if written.str.match(r'-?\d+\.0$').all():
+            whole = values.str.match(r'-?\d+$')
+            delta.loc[whole, col] = values[whole] + '.0'
+        elif written.str.match(r'-?\d+$').all():
+            whole = values.str.match(r'-?\d+\.0$')
+            delta.loc[whole, col] = values[whole].str[:-2]
+    return delta
+
+
+def merge_by_key(current, delta, key):
+    """Replace rows of current whose key is in delta with delta rows.
+
+    Every current row sharing a key with the delta is dropped,
+    so keys spanning several rows are replaced as a whole.
+    New keys are appended.
+    """
+    current_keys = pd.MultiIndex.from_frame(current[key])
+    delta_keys = pd.MultiIndex.from_frame(delta[key])
+    keep = ~current_keys.isin(delta_keys)
+    logging.info(f"Replacing {(~keep).sum()} rows, "
+                 f"{delta.shape[0]} rows received")
+    return pd.concat([current[keep], delta[current.columns]],
+                     ignore_index=True)
+
+
+def extract_incremental(conn,
+                        sql,
+                        fname,
+                        watermark,
+                        key,
+                        transform=None,
+                        sort_by=None,
+                        ascending=True,
+                        full=False,
+                        batch_size=50000,
+                        arraysize=None,
+                        **kwargs):
+    """Extract rows changed since the watermark and merge into a csv.
+
+    'sql' is a string.Template with '$since', the lower bound
+    of the watermark column as 'YYYY-MM-DD HH:MM:SS'. On a full
+    extract it is far enough back to select every row.
+
+    'key' is the list of output columns identifying a record.
+    The query must select every row of a key together, for
+    example with the watermark column in the key, or a filter
+    on a per key max, or rows left out are dropped on merge.
+    The watermark column is read before 'transform', a function
+    applied to each batch, so the output may drop or rename it.
+
+    'sort_by' and 'ascending' restore the query's order after
+    merging. Keyword arguments are passed to to_csv.
+
+    Full extracts stream to a tmp file that replaces the file
+    after the last batch, so a failed extract leaves the file
+    as it was. Incremental ones only rewrite the file when rows
+    changed, and leave every other row exactly as written before.
+
+    Returns the number of rows extracted.
+    """
+    full = full or watermark.needs_full(fname)
+    since = watermark.since(full)
+    query = string.Template(sql).substitute(
+        since=since.strftime('%Y-%m-%d %H:%M:%S'))
+
+    logging.info(f"{'Full' if full else 'Incremental'} extract of "
+                 f"{watermark.name} since {since}")
+
+    state = watermark.load()
+    highest = None if full else state['watermark']
+    run_start = datetime.now()
+
+    tmp_fname = f"{fname}.tmp"
+    if full:
+        general.create_path_if_not_exists(os.path.dirname(fname))
+        sink = sql_extract.CsvSink(tmp_fname, **kwargs)
+    frames = []
+    rows = 0
+
+    try:
+        for df in sql_extract.fetch_batches(conn, query,
+                                            batch_size, arraysize):
+            batch_max = pd.to_datetime(df[watermark.column]).max()
+            if pd.notnull(batch_max):
+                batch_max = batch_max.to_pydatetime().replace(microsecond=0)
+                highest = batch_max if highest is None \
+                    else max(highest, batch_max)
+
+            if transform is not None:
+                df = transform(df)
+            rows += df.shape[0]
+
+            if full:
+                sink.write(df)
+            else:
+                frames.append(render_rows(df, **kwargs))
+    except Exception:
+        if full:
+            sink.close()
+            os.remove(tmp_fname)
+        raise
+
+    if full:
+        sink.close()
+        os.replace(tmp_fname, fname)
+    elif rows:
+        current = pd.read_csv(fname, dtype=str, keep_default_na=False)
+        delta = match_number_format(pd.concat(frames, ignore_index=True),
+                                    current)
+        merged = merge_by_key(current, delta, key)
+        if sort_by is not None:
+            merged = merged.sort_values(by=sort_by,
+                                        ascending=ascending,
+                                        kind='mergesort')
+        general.pos_write_csv(merged, tmp_fname, **kwargs)
+        os.replace(tmp_fname, fname)
+
+    last_full = run_start if full else state['last_full']
+    watermark.save(highest or EPOCH, last_full)
+
+    logging.info(f"Extracted {rows} rows of {watermark.name}, "
+                 f"watermark now {highest}")
+
+    return rows
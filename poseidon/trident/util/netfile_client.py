@@ -0,0 +1,101 @@
+"""Client for the NetFile Connect2 public export API."""
+import math
+import logging
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from trident.util import general
+
+base_url = "https://netfile.com:443/Connect2/api/public/campaign/export/cal201/"
+
+
+class NetFile(object):
+    """NetFile Client Class.
+
+    Shares one pooled session with retries across all requests
+    and fetches export pages concurrently.
+    """
+    def __init__(self,
+                 aid='CSD',
+                 page_size=1000,
+                 max_workers=6,
+                 retries=5):
+
+        self.aid = aid
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.session = general.retry_session(retries=retries,
+                                             pool_size=max_workers)
+
+    def post_page(self, endpoint, data, page, page_size):
+        """Request one page of an export and return the JSON body."""
+        params = general.merge_dicts(data, {
+            'Aid': self.aid,
+            'CurrentPageIndex': page,
+            'PageSize': page_size
+        })
+        resp = self.session.post(base_url + endpoint,
+                                 params={'format': 'json'},
+                                 data=params,
+                                 timeout=120)
+        resp.raise_for_status()
+        return resp.json()
+
+    def count(self, endpoint, data):
+        """Return the total number of records in an export."""
+        logging.info("Requesting number of transactions")
+        body = self.post_page(endpoint, data, 0, 1)
+        return body['totalMatchingCount']
+
+    def fetch_df(self, endpoint, data):
+        """Fetch every page of an export into one DataFrame.
+
+        'endpoint' is the path after the cal201 export url,
+        for example 'transaction/year'.
+
+        'data' holds the form fields of the request besides
+        the agency id and paging fields.
+
+        Columns are the raw NetFile field names.
+        """
+        total = self.count(endpoint, data)
+        pages = max(1, math.ceil(total / self.page_size))
+        logging.info(f"Requesting {total} records in {pages} pages")
+
+        def fetch(page):
+            results = self.post_page(endpoint,
+                                     data,
+                                     page,
+                                     self.page_size)['results']
+            logging.info(f"Transaction request {page} success")
+            return pd.DataFrame.from_records(results)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            frames = list(pool.map(fetch, range(pages)))
+
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        logging.info(f"Received {df.shape[0]} records")
+
+        return df
+
+
+def map_fields(raw, fields, columns, **constants):
+    """Build an output frame from raw NetFile records.
+
+    'fields' maps output columns to raw NetFile field names.
+
+    'columns' is the list of output columns, in order.
+
+    Keyword arguments set an output column to a constant.
+    Any other column is filled with a single space.
+    """
+    out = pd.DataFrame(index=raw.index)
+
+    for col in columns:
+        if col in fields:
+            out[col] = raw[fields[col]] if fields[col] in raw else None
+        elif col in constants:
+            out[col] = constants[col]
+        else:
+            out[col] = ' '
+
+    return out
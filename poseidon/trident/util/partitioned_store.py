@@ -0,0 +1,495 @@
+"""Append-only partitioned store for incremental prod files."""
+import os
+import re
+import time
+import glob
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+from trident.util import general
+
+conf = general.config
+
+# Journal entries older than this are removed on merge
+JOURNAL_MAX_AGE = 30 * 24 * 60 * 60
+
+# Partition of rows the partitioner gives no label
+NULL_LABEL = 'null'
+
+
+def write_pickle(obj, path):
+    """Pickle obj to path through a tmp file, so readers never see half."""
+    tmp_path = f"{path}.tmp"
+    pd.to_pickle(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def year_partition(col):
+    """Return a partitioner that labels rows by calendar year of col."""
+    def partition(df):
+        return pd.to_datetime(df[col], errors='coerce').dt.year
+    return partition
+
+
+def month_partition(col):
+    """Return a partitioner that labels rows by year and month of col."""
+    def partition(df):
+        return pd.to_datetime(df[col], errors='coerce').dt.strftime('%Y_%m')
+    return partition
+
+
+def range_partition(col, width):
+    """Return a partitioner that labels rows by numeric range of col."""
+    def partition(df):
+        return pd.to_numeric(df[col], errors='coerce') // width
+    return partition
+
+
+class PartitionedStore(object):
+    """Partitioned store of prod records with a primary key index.
+
+    Partitions are pickled DataFrames in the store directory,
+    next to an index of key hashes for every stored record.
+
+    Merging a delta only reads the index and the partitions that
+    receive new records. Records already in the store win over
+    incoming records with the same key, like drop_duplicates
+    after appending new data to prod.
+
+    'partition' is a function that takes a DataFrame and returns
+    the partition label of every row. Rows without a label,
+    such as a missing date, are kept in the NULL_LABEL
+    partition, which comes after all others.
+
+    'key' is the list of primary key columns. When None the
+    whole row is the key. Keys are compared by value, so 30
+    read as an int in one file and as a float in another is
+    the same key, as when drop_duplicates runs after concat.
+
+    'sort_by' is the sort order inside a partition. When None
+    new records are appended in the order they arrive.
+
+    'journal' keeps the records appended to each partition as
+    separate delta files, so consumers can read what was added
+    since they last ran. Only valid without 'sort_by'.
+
+    For data without a key, where two equal rows are two
+    records, append adds every record instead. Each load names
+    its source, and a source already loaded is skipped.
+
+    Writes are done in two steps. New partitions are written
+    next to the old ones, then a pending file lists them, then
+    they replace the old ones and the index is saved. A run
+    that stops before the pending file leaves the store as it
+    was. One that stops after it is finished on the next load.
+    """
+    def __init__(self,
+                 name,
+                 partition,
+                 key=None,
+                 sort_by=None,
+                 journal=False,
+                 base_dir=None):
+
+        if base_dir is None:
+            base_dir = f"{conf['cache_dir']}/stores"
+
+        self.name = name
+        self.partition = partition
+        self.key = key
+        self.sort_by = sort_by
+        self.journal = journal
+        self.path = f"{base_dir}/{name}"
+        general.create_path_if_not_exists(self.path)
+        self._index = None
+        self._recovered = []
+
+    def _part_path(self, label, ext='pkl'):
+        return f"{self.path}/part_{label}.{ext}"
+
+    def _delta_path(self, label, start):
+        return f"{self.path}/delta_{label}_{start:012d}.pkl"
+
+    @property
+    def index_path(self):
+        return f"{self.path}/index.pkl"
+
+    @property
+    def pending_path(self):
+        return f"{self.path}/pending.pkl"
+
+    @property
+    def sources_path(self):
+        return f"{self.path}/sources.pkl"
+
+    @property
+    def sources(self):
+        """Names of the sources already appended."""
+        if os.path.isfile(self.sources_path):
+            return pd.read_pickle(self.sources_path)
+        return []
+
+    @property
+    def columns_path(self):
+        return f"{self.path}/columns.pkl"
+
+    @property
+    def columns(self):
+        """Union of stored columns, in the order first seen."""
+        if os.path.isfile(self.columns_path):
+            return pd.read_pickle(self.columns_path)
+        return None
+
+    def _add_columns(self, columns):
+        current = self.columns or []
+        added = [x for x in columns if x not in current]
+        if added or self.columns is None:
+            write_pickle(current + added, self.columns_path)
+
+    @property
+    def index(self):
+        """Series of partition labels indexed by key hash."""
+        if self._index is None:
+            if os.path.isfile(self.index_path):
+                self._index = pd.read_pickle(self.index_path)
+            else:
+                self._index = pd.Series([], dtype=object,
+                                        index=pd.Index([], dtype='uint64'))
+            if os.path.isfile(self.pending_path):
+                self._recover()
+            for path in glob.glob(f"{self.path}/*.new"):
+                os.remove(path)
+        return self._index
+
+    def is_empty(self):
+        """Return True when the store holds no records."""
+        return self.index.empty
+
+    def partitions(self):
+        """Return the labels of all stored partitions, in order."""
+        return sorted(self.index.unique(),
+                      key=lambda x: (x == NULL_LABEL, x))
+
+    def partition_size(self, label):
+        """Return the number of records in one partition."""
+        return int((self.index == label).sum())
+
+    def key_hashes(self, df):
+        """Return one uint64 hash per row for the primary key."""
+        keys = df[df.columns if self.key is None else self.key]
+        # Numbers hash by dtype, so compare them all as floats
+        numeric = keys.select_dtypes(include=['number', 'bool']).columns
+        if len(numeric):
+            keys = keys.astype({x: 'float64' for x in numeric})
+        return pd.util.hash_pandas_object(keys, index=False).values
+
+    def read_partition(self, label):
+        """Return the stored records of one partition."""
+        path = self._part_path(label)
+        if os.path.isfile(path):
+            return pd.read_pickle(path)
+        return None
+
+    def _commit(self, parts, hashes, labels, source=None):
+        """Replace partitions and add their new keys to the index.
+
+        'parts' is a dict of partition label to the full new
+        partition, 'hashes' and 'labels' the keys it adds.
+        """
+        if not parts:
+            return
+
+        index = self.index
+
+        for label, part in parts.items():
+            pd.to_pickle(part, f"{self._part_path(label)}.new")
+
+        write_pickle({'labels': list(parts), 'source': source},
+                     self.pending_path)
+
+        for label in parts:
+            os.replace(f"{self._part_path(label)}.new",
+                       self._part_path(label))
+
+        added = pd.Series(labels, index=pd.Index(hashes, dtype='uint64'))
+        self._index = pd.concat([index, added])
+        self._finish(source)
+
+    def _finish(self, source):
+        """Save the index and sources, ending a commit."""
+        write_pickle(self._index, self.index_path)
+        if source is not None and source not in self.sources:
+            write_pickle(self.sources + [source], self.sources_path)
+        os.remove(self.pending_path)
+
+    def _recover(self):
+        """Finish a commit a previous run stopped in the middle of.
+
+        Partitions still waiting are moved in place, and their
+        keys are read again from the partitions, so the index
+        matches what is stored. Their csv renderings are dropped
+        and they are returned as changed by the next merge.
+        """
+        pending = pd.read_pickle(self.pending_path)
+        labels = pending['labels']
+        logging.info(f"{self.name}: finishing write of partitions {labels}")
+
+        frames = [self._index[~self._index.isin(labels)]]
+        for label in labels:
+            path = self._part_path(label)
+            if os.path.isfile(f"{path}.new"):
+                os.replace(f"{path}.new", path)
+            part = pd.read_pickle(path)
+            frames.append(pd.Series([label] * part.shape[0],
+                index=pd.Index(self.key_hashes(part), dtype='uint64')))
+            if os.path.isfile(self._part_path(label, 'csv')):
+                os.remove(self._part_path(label, 'csv'))
+
+        self._index = pd.concat(frames)
+        self._recovered = list(labels)
+        self._finish(pending['source'])
+
+    def _with_recovered(self, changed):
+        """Add partitions finished by _recover to changed."""
+        for label in self._recovered:
+            if label not in changed:
+                changed[label] = self.read_partition(label)
+        self._recovered = []
+        return changed
+
+    def _add(self, delta, hashes, labels, source=None):
+        """Append delta records to their partitions."""
+        parts = {}
+
+        for label, part_delta in delta.groupby(labels.values, sort=False):
+            part = self.read_partition(label)
+
+            if part is None:
+                logging.info(f"Starting partition {label}")
+                part = part_delta
+            else:
+                if self.journal:
+                    write_pickle(part_delta.reset_index(drop=True),
+                                 self._delta_path(label, part.shape[0]))
+                part = pd.concat([part, part_delta], ignore_index=True,
+                                 sort=False)
+
+            if self.sort_by is not None:
+                part = part.sort_values(by=self.sort_by, kind='mergesort')
+
+            part = part.reset_index(drop=True)
+            logging.info(f"Partition {label} has {part.shape[0]} records")
+            parts[label] = part
+
+        self._commit(parts, hashes, labels.values, source)
+
+        if self.journal:
+            self.prune_journal()
+
+        return self._with_recovered(parts)
+
+    def _labels(self, df):
+        """Return the partition label of every row of df."""
+        labels = self.partition(df)
+        unlabeled = labels.isnull()
+        if labels.dtype.kind == 'f':
+            labels = labels.fillna(0).astype('int64')
+        if unlabeled.any():
+            logging.info(f"{self.name}: {unlabeled.sum()} records without "
+                         f"a partition go to partition {NULL_LABEL}")
+            labels = labels.astype(object).mask(unlabeled, NULL_LABEL)
+        return labels
+
+    def merge(self, df):
+        """Add new records and return the partitions they changed.
+
+        Records whose key is stored, or repeats an earlier
+        record of df, are skipped.
+
+        Returns a dict of partition label to the full partition
+        DataFrame for every partition that received records.
+        """
+        self._add_columns(df.columns)
+        hashes = self.key_hashes(df)
+        labels = self._labels(df)
+
+        new = ~np.isin(hashes, self.index.index.values)
+        new &= ~pd.Index(hashes).duplicated(keep='first')
+
+        logging.info(f"{self.name}: {new.sum()} new records "
+                     f"of {df.shape[0]} received")
+
+        return self._add(df[new], hashes[new], labels[new])
+
+    def append(self, df, source):
+        """Add every record of df, and return the changed partitions.
+
+        'source' names where df comes from, such as a file name.
+        Nothing is added for a source already appended, so a
+        file loaded twice is only stored once.
+        """
+        # is_empty finishes an interrupted write first
+        if not self.is_empty() and source in self.sources:
+            logging.info(f"{self.name}: {source} already appended")
+            return self._with_recovered({})
+
+        self._add_columns(df.columns)
+        labels = self._labels(df)
+
+        logging.info(f"{self.name}: appending {df.shape[0]} records "
+                     f"from {source}")
+
+        changed = self._add(df, self.key_hashes(df), labels, source)
+        if df.empty:
+            # Still remember the source when it held no records
+            write_pickle(self.sources + [source], self.sources_path)
+        return changed
+
+    def upsert(self, df):
+        """Add new records and fill gaps in stored ones.
+
+        A record whose key is already stored only fills the
+        values the stored record is missing, as groupby(key)
+        .first() does after appending new data to prod. Only
+        partitions covering the new records are read.
+
+        Returns the partitions whose content changed, like merge.
+        Needs a primary key.
+        """
+        if self.key is None:
+            raise ValueError(f"{self.name} needs a key for upsert")
+
+        self._add_columns(df.columns)
+        labels = self._labels(df)
+
+        hashes = self.key_hashes(df)
+        new = ~np.isin(hashes, self.index.index.values)
+        new &= ~pd.Index(hashes).duplicated(keep='first')
+
+        changed = {}
+
+        for label, part_delta in df.groupby(labels.values, sort=False):
+            part = self.read_partition(label)
+            cols = list(part_delta.columns) if part is None else \
+                list(part.columns) + [x for x in part_delta.columns
+                                      if x not in part.columns]
+
+            combined = part_delta if part is None else \
+                pd.concat([part, part_delta], ignore_index=True, sort=False)
+            combined = combined.groupby(self.key, sort=False).first()
+            combined = combined.reset_index()[cols]
+
+            if self.sort_by is not None:
+                combined = combined.sort_values(by=self.sort_by,
+                                                kind='mergesort')
+            combined = combined.reset_index(drop=True)
+
+            if part is not None and combined.equals(part):
+                continue
+
+            logging.info(f"Partition {label} has {combined.shape[0]} records")
+            changed[label] = combined
+
+        logging.info(f"{self.name}: {new.sum()} new records "
+                     f"of {df.shape[0]} received, "
+                     f"{len(changed)} partitions changed")
+
+        self._commit(changed, hashes[new], labels.values[new])
+
+        return self._with_recovered(changed)
+
+    def read_delta(self, label, start):
+        """Return the records appended to a partition after row 'start'.
+
+        Returns None when the journal does not cover every record
+        since 'start', in which case the caller needs the full
+        partition instead.
+        """
+        size = self.partition_size(label)
+        pattern = re.compile(rf"delta_{re.escape(str(label))}_(\d+)\.pkl$")
+
+        entries = []
+        for path in glob.glob(f"{self.path}/delta_{label}_*.pkl"):
+            match = pattern.search(path)
+            if match and int(match.group(1)) >= start:
+                entries.append((int(match.group(1)), path))
+
+        frames = []
+        expected = start
+        for offset, path in sorted(entries):
+            if offset != expected:
+                return None
+            frame = pd.read_pickle(path)
+            frames.append(frame)
+            expected += frame.shape[0]
+
+        if expected != size:
+            return None
+
+        logging.info(f"Read {expected - start} records of partition "
+                     f"{label} from {len(frames)} journal entries")
+
+        if not frames:
+            return pd.DataFrame()
+
+        return pd.concat(frames, ignore_index=True, sort=False)
+
+    def prune_journal(self, max_age=JOURNAL_MAX_AGE):
+        """Delete journal entries older than max_age seconds."""
+        cutoff = time.time() - max_age
+        for path in glob.glob(f"{self.path}/delta_*.pkl"):
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+    def write_combined_csv(self, fname, changed, **kwargs):
+        """Write all partitions as one csv, in partition order.
+
+        Each partition keeps a rendered csv in the store, so only
+        partitions in 'changed', or rendered with other columns,
+        are formatted again. The others are copied into the
+        output as they are.
+        """
+        columns = self.columns
+        if columns is None:
+            for label in self.partitions():
+                self._add_columns(self.read_partition(label).columns)
+            columns = self.columns
+
+        csv_args = general.pos_csv_defaults.copy()
+        csv_args.update(kwargs)
+        encoding = csv_args.pop('encoding')
+        header = pd.DataFrame(columns=columns).to_csv(None, **csv_args)
+        header = header.encode(encoding)
+
+        labels = self.partitions()
+        for label in labels:
+            path = self._part_path(label, 'csv')
+            if label not in changed and os.path.isfile(path):
+                with open(path, 'rb') as part:
+                    if part.readline() == header:
+                        continue
+
+            part = changed.get(label)
+            if part is None:
+                part = self.read_partition(label)
+            general.pos_write_csv(part.reindex(columns=columns),
+                                  path,
+                                  **kwargs)
+
+        general.create_path_if_not_exists(os.path.dirname(fname))
+        with open(fname, 'wb') as out:
+            out.write(header)
+            for label in labels:
+                with open(self._part_path(label, 'csv'), 'rb') as part:
+                    part.readline()
+                    shutil.copyfileobj(part, out)
+
+        logging.info(f"Wrote {len(labels)} partitions to {fname}")
+
+    def clear(self):
+        """Delete every partition, the index and the sources."""
+        for path in glob.glob(f"{self.path}/*"):
+            os.remove(path)
+        self._index = None
+        self._recovered = []
@@ -1,7 +1,7 @@
 """Dynamically create sde tasks."""
 from airflow.operators.bash_operator import BashOperator
 from airflow.operators.python_operator import PythonOperator
-from trident.operators.s3_file_transfer_operator import S3FileTransferOperator
+from trident.operators.s3_batch_transfer_operator import S3BatchTransferOperator
 
 
 from airflow.models import DAG
@@ -90,42 +90,16 @@ def create_sde_tasks(dag,
         op_kwargs={'datasd_name': datasd_name},
         dag=dag)
 
-    #: Upload shapefile to S3
-    shp_to_S3 = S3FileTransferOperator(
-        task_id=f'{layer}_shp_to_S3',
-        source_base_path=conf['prod_data_dir'],
-        source_key=f'{datasd_name}.zip',
-        dest_s3_conn_id="{{ var.value.DEFAULT_S3_CONN_ID }}",
-        dest_s3_bucket="{{ var.value.S3_DATA_BUCKET }}",
-        dest_s3_key=f'sde/{folder}/{datasd_name}.zip',
-        replace=True,
-        dag=dag)
-
-    #: Upload geojson to S3
-    geojson_to_S3 = S3FileTransferOperator(
-        task_id=f'{layer}_geojson_to_S3',
-        source_base_path=conf['prod_data_dir'],
-        source_key=f'{datasd_name}.geojson',
-        dest_s3_conn_id="{{ var.value.DEFAULT_S3_CONN_ID }}",
-        dest_s3_bucket="{{ var.value.S3_DATA_BUCKET }}",
-        dest_s3_key=f'sde/{folder}/{datasd_name}.geojson',
-        replace=True,
-        dag=dag)
-
-    #: Upload topojson to S3
-    topojson_to_S3 = S3FileTransferOperator(
-        task_id=f'{layer}_topojson_to_S3',
-        source_base_path=conf['prod_data_dir'],
-        source_key=f'{datasd_name}.topojson',
-        dest_s3_conn_id="{{ var.value.DEFAULT_S3_CONN_ID }}",
-        dest_s3_bucket="{{ var.value.S3_DATA_BUCKET }}",
-        dest_s3_key=f'sde/{folder}/{datasd_name}.topojson',
-        replace=True,
-        dag=dag)
-
     #: Update portal modified date
     update_md = get_seaboard_update_dag(f'{md}.md', dag)
 
+    manifest = [{'source_key': f'{datasd_name}.zip',
+                 'dest_s3_key': f'sde/{folder}/{datasd_name}.zip'},
+                {'source_key': f'{datasd_name}.geojson',
+                 'dest_s3_key': f'sde/{folder}/{datasd_name}.geojson'},
+                {'source_key': f'{datasd_name}.topojson',
+                 'dest_s3_key': f'sde/{folder}/{datasd_name}.topojson'}]
+
     if layer not in no_pbf:
         #: Convert GeoJSON to Geobuf format
         to_geobuf = PythonOperator(
@@ -141,24 +115,25 @@ def create_sde_tasks(dag,
             op_kwargs={'datasd_name': datasd_name},
             dag=dag)
 
-        #: Upload geobuf to S3
-        geobuf_to_S3 = S3FileTransferOperator(
-            task_id=f'{layer}_geobuf_to_S3',
-            source_base_path=conf['prod_data_dir'],
-            source_key=f'{datasd_name}.pbf',
-            dest_s3_conn_id="{{ var.value.DEFAULT_S3_CONN_ID }}",
-            dest_s3_bucket="{{ var.value.S3_DATA_BUCKET }}",
-            dest_s3_key=f'sde/{folder}/{datasd_name}.pbf',
-            replace=True,
-            use_gzip=True,
-            dag=dag)
-
-        to_geojson >> to_geobuf >> to_gzip >> geobuf_to_S3 >> update_md
+        manifest.append({'source_key': f'{datasd_name}.pbf',
+                         'dest_s3_key': f'sde/{folder}/{datasd_name}.pbf',
+                         'use_gzip': True})
 
+    #: Upload all outputs to S3 in one task
+    upload_to_S3 = S3BatchTransferOperator(
+        task_id=f'{layer}_upload_to_S3',
+        source_base_path=conf['prod_data_dir'],
+        manifest=manifest,
+        dest_s3_conn_id="{{ var.value.DEFAULT_S3_CONN_ID }}",
+        dest_s3_bucket="{{ var.value.S3_DATA_BUCKET }}",
+        replace=True,
+        dag=dag)
 
     #: Execution rules:
 
-    to_shp >> [to_geojson,to_topojson] >> to_zip >> shp_to_S3
-    to_geojson >> geojson_to_S3
-    to_topojson >> topojson_to_S3
-    [shp_to_S3,geojson_to_S3,topojson_to_S3] >> update_md
+    to_shp >> [to_geojson,to_topojson] >> to_zip >> upload_to_S3
+
+    if layer not in no_pbf:
+        to_geojson >> to_geobuf >> to_gzip >> upload_to_S3
+
+    upload_to_S3 >> update_md
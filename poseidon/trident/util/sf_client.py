@@ -1,10 +1,14 @@
 """Utilities for SF Login."""
-import requests
+import os
+import hashlib
 import xml.dom.minidom
 import pandas as pd
 import csv
+import io
 import json
+import time
 import logging
+import collections
 from trident.util import general
 import traceback
 
@@ -29,8 +33,23 @@ def getUniqueElementValueFromXmlString(xmlString, elementName):
     return elementValue
 
 
+# Logins are reused until this many seconds before they expire
+SESSION_MARGIN = 300
+
+
+def session_cache_path(username, domain):
+    """Return the file that caches a login for this user and domain."""
+    key = hashlib.sha1(f"{username}@{domain}".encode('utf-8')).hexdigest()
+    return f"{conf['cache_dir']}/sf_session_{key}.json"
+
+
 class Salesforce(object):
-    """SF Client Class."""
+    """SF Client Class.
+
+    Requests share one pooled session with retries. The login is
+    cached on disk for other tasks on the same worker until it
+    expires, and the client logs in again on a 401.
+    """
     def __init__(self,
                  username=None,
                  password=None,
@@ -42,7 +61,29 @@ class Salesforce(object):
         self.sf_version = sf_version
         self.domain = domain
         self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.security_token = security_token
         self.session_id = None
+        self.headers = {}
+        self.session = general.retry_session()
+
+        try:
+            self.login()
+        except Exception as exception:
+            traceback.print_exc()
+
+    def login(self, force=False):
+        """Set the session id, from the cache unless 'force' is set."""
+        cache_path = session_cache_path(self.username, self.domain)
+
+        if not force and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['expires'] - SESSION_MARGIN > time.time():
+                logging.info('Using cached SF session')
+                self.set_session(cached['session_id'])
+                return self.session_id
 
         # Security Token Soap request body
         login_soap_request_body = """<?xml version="1.0" encoding="utf-8" ?>
@@ -64,14 +105,15 @@ class Salesforce(object):
                 </n1:login>
             </env:Body>
         </env:Envelope>""".format(
-            username=username,
-            password=password,
-            token=security_token,
-            client_id=client_id)
+            username=self.username,
+            password=self.password,
+            token=self.security_token,
+            client_id=self.client_id)
 
         soap_url = 'https://{domain}.salesforce.com/services/Soap/u/{sf_version}'
 
-        soap_url = soap_url.format(domain=domain, sf_version=sf_version)
+        soap_url = soap_url.format(domain=self.domain,
+                                   sf_version=self.sf_version)
 
         login_soap_request_headers = {
             'content-type': 'text/xml',
@@ -79,71 +121,141 @@ class Salesforce(object):
             'SOAPAction': 'login'
         }
 
-        try:
-            response = requests.post(
-                soap_url,
-                login_soap_request_body,
-                headers=login_soap_request_headers)
-
-            self.session_id = getUniqueElementValueFromXmlString(response.content,
-                                                                 'sessionId')
-            self.headers = {
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer ' + self.session_id,
-                'X-PrettyPrint': '1'
-            }
-        
-        except Exception as exception:
-            traceback.print_exc()
+        logging.info('Logging in to SF')
+        response = self.session.post(
+            soap_url,
+            login_soap_request_body,
+            headers=login_soap_request_headers)
+
+        session_id = getUniqueElementValueFromXmlString(response.content,
+                                                        'sessionId')
+        seconds_valid = getUniqueElementValueFromXmlString(response.content,
+                                                           'sessionSecondsValid')
+        self.set_session(session_id)
+
+        general.create_path_if_not_exists(os.path.dirname(cache_path))
+        # Only the worker user should be able to read the session id
+        fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'session_id': session_id,
+                       'expires': time.time() + int(seconds_valid or 0)}, f)
+
+        return self.session_id
+
+    def set_session(self, session_id):
+        """Use a session id for all following requests."""
+        self.session_id = session_id
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer ' + session_id,
+            'X-PrettyPrint': '1'
+        }
+        self.session.cookies.set('sid', session_id)
+
+    def request(self, method, url, **kwargs):
+        """Send a request with the session, logging in again on a 401."""
+        headers = general.merge_dicts(self.headers, kwargs.pop('headers', {}))
+        resp = self.session.request(method, url, headers=headers, **kwargs)
+
+        if resp.status_code == 401:
+            logging.info('SF session expired, logging in again')
+            resp.close()
+            self.login(force=True)
+            headers['Authorization'] = self.headers['Authorization']
+            resp = self.session.request(method, url, headers=headers, **kwargs)
+
+        return resp
+
+    def iter_report_batches(self,
+                            report_id,
+                            encoding='utf-8',
+                            batch_size=10000,
+                            footer_rows=7):
+        """Stream a SF report export as batches of csv rows.
+
+        The response body is read in chunks and parsed as it
+        arrives. The last 'footer_rows' rows are the report
+        footer and are never yielded. The first row is the header.
+        """
+        enc = 'ISO-8859-1' if encoding == 'latin-1' else 'UTF-8'
+        url = "https://{domain}.salesforce.com/{report_id}?view=d&snip&export=1&enc={enc}&xf=csv"
+        url = url.format(report_id=report_id, domain=self.domain, enc=enc)
+
+        resp = self.request('GET', url, stream=True)
+
+        # An expired session is sent to the login page, not a 401
+        if resp.headers.get('Content-Type', '').startswith('text/html'):
+            logging.info('SF report export redirected, logging in again')
+            resp.close()
+            self.login(force=True)
+            resp = self.request('GET', url, stream=True)
+
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+
+        # Line breaks are dropped before parsing, as the
+        # full download did with splitlines()
+        text = io.TextIOWrapper(resp.raw, encoding=encoding, newline='')
+        lines = (line.rstrip('\r\n') for line in text)
+        reader = csv.reader(lines, delimiter=",")
+
+        footer = collections.deque()
+        batch = []
 
+        try:
+            for row in reader:
+                footer.append(row)
+                if len(footer) > footer_rows:
+                    batch.append(footer.popleft())
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+        finally:
+            resp.close()
+
+        if batch:
+            yield batch
 
     def get_report_df(self, report_id):
-        """Get SF report and return dataframe."""
-        url = "https://{domain}.salesforce.com/{report_id}?view=d&snip&export=1&enc=UTF-8&xf=csv"
-        url = url.format(report_id=report_id, domain=self.domain)
-        try:
-            resp = requests.get(url,
-                                headers=self.headers,
-                                cookies={'sid': self.session_id})
+        """Get SF report and return dataframe.
 
-            resp_decode = resp.content.decode('utf-8')
-            reader = csv.reader(resp_decode.splitlines(), delimiter=",")
-            data = list(reader)
-            data = data[:-7]
+        A report without rows returns an empty DataFrame with
+        the header columns.
+        """
+        frames = []
+        columns = None
 
-            df = pd.DataFrame(data)
-            df.columns = df.iloc[0]
-            df = df.drop(0)
-
-            return df
-
-        except Exception as e:
-            logging.error(e)
+        for batch in self.iter_report_batches(report_id):
+            if columns is None:
+                columns, batch = batch[0], batch[1:]
+            frames.append(pd.DataFrame(batch, columns=columns))
 
+        if not frames:
+            logging.info(f"Report {report_id} has no rows")
+            frames.append(pd.DataFrame(columns=columns or []))
 
+        df = pd.concat(frames, ignore_index=True)
+        df.index = df.index + 1
+        df.columns.name = 0
 
+        return df
 
     def get_report_csv(self, report_id, filename):
         """Get SF report and return csv file."""
-        url = "https://{domain}.salesforce.com/{report_id}?view=d&snip&export=1&enc=ISO-8859-1&xf=csv"
-        url = url.format(report_id=report_id, domain=self.domain)
         # If this doesn't work, it should fail
         try:
-            
-            resp = requests.get(url,
-                                headers=self.headers,
-                                cookies={'sid': self.session_id})
-
 
-            resp_decode = resp.content.decode('latin-1')
-            reader = csv.reader(resp_decode.splitlines(), delimiter=",")
-            data = list(reader)
-            data = data[:-7]
+            rows = 0
 
             with open(filename, 'w') as f:
                 writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-                writer.writerows(data)
-        
+                for batch in self.iter_report_batches(report_id,
+                                                      encoding='latin-1'):
+                    writer.writerows(batch)
+                    rows += len(batch)
+
+            logging.info(f"Wrote {rows} rows to {filename}")
+
         except Exception as exception:
             traceback.print_exc()
 
@@ -157,9 +269,7 @@ class Salesforce(object):
                          query_string=query_string)
 
         try:
-            resp = requests.get(url,
-                                headers=self.headers,
-                                cookies={'sid': self.session_id})
+            resp = self.request('GET', url)
             return resp.json()
 
         except Exception as e:
@@ -171,28 +281,103 @@ class Salesforce(object):
         url = url.format(domain=self.domain,
                          next_page_url=next_page_url)
         try:
-            resp = requests.get(url,
-                                headers=self.headers,
-                                cookies={'sid': self.session_id})
+            resp = self.request('GET', url)
 
             return resp.json()
 
         except Exception as e:
             logging.error(e)
 
-    def get_query_all(self, query_string):
-        """Combine 'query' and 'query more' methods to 'query all'."""
+    def iter_query(self, query_string):
+        """Yield each page of a query result as it is fetched."""
         result = self.get_query_records(query_string)
-        all_records = []
 
         while True:
-            all_records.extend(result['records'])
+            yield result
 
             if not result['done']:
                 result = self.get_query_more(result['nextRecordsUrl'])
             else:
                 break
 
+    def get_query_all(self, query_string):
+        """Combine 'query' and 'query more' methods to 'query all'."""
+        all_records = []
+
+        for result in self.iter_query(query_string):
+            all_records.extend(result['records'])
+
         result['records'] = all_records
 
         return result
+
+    def bulk_query_csv(self,
+                       query_string,
+                       filename,
+                       max_records=50000,
+                       poll_interval=5):
+        """Run a query with Bulk API 2.0 and stream results to csv.
+
+        Each page of results is written as it arrives, so memory
+        use does not depend on the size of the query.
+        """
+        jobs_url = "https://{domain}.salesforce.com/services/data/v{sf_version}/jobs/query"
+        jobs_url = jobs_url.format(domain=self.domain,
+                                   sf_version=self.sf_version)
+
+        resp = self.request('POST',
+                            jobs_url,
+                            json={'operation': 'query',
+                                  'query': query_string})
+        resp.raise_for_status()
+        job_id = resp.json()['id']
+        logging.info(f"Created bulk query job {job_id}")
+
+        while True:
+            resp = self.request('GET', f"{jobs_url}/{job_id}")
+            resp.raise_for_status()
+            state = resp.json()['state']
+            if state == 'JobComplete':
+                break
+            elif state in ('Failed', 'Aborted'):
+                raise Exception(f"Bulk query job {job_id} {state}")
+            time.sleep(poll_interval)
+
+        locator = None
+        first_page = True
+        rows = 0
+
+        with open(filename, 'wb') as f:
+            while True:
+                params = {'maxRecords': max_records}
+                if locator:
+                    params['locator'] = locator
+
+                resp = self.request('GET',
+                                    f"{jobs_url}/{job_id}/results",
+                                    params=params,
+                                    stream=True)
+                resp.raise_for_status()
+
+                # Bytes go to the file as they are, so quoted values
+                # keep their line breaks. Every page repeats the
+                # header row, which is dropped after the first page.
+                in_header = not first_page
+                first_page = False
+                for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                    if in_header:
+                        end = chunk.find(b'\n')
+                        if end == -1:
+                            continue
+                        chunk = chunk[end + 1:]
+                        in_header = False
+                    f.write(chunk)
+                rows += int(resp.headers.get('Sforce-NumberOfRecords', 0))
+
+                locator = resp.headers.get('Sforce-Locator')
+                if not locator or locator == 'null':
+                    break
+
+        logging.info(f"Wrote {rows} records to {filename}")
+
+        return rows
@@ -0,0 +1,297 @@
+"""Keyed change detection between two snapshots of a feed."""
+import io
+import os
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from trident.util import general
+
+conf = general.config
+
+# Kinds of change, in the order they are reported
+CHANGES = ('insert', 'update', 'delete')
+
+# Bytes read at once when hashing raw lines
+BLOCK_SIZE = 1 << 24
+
+
+def read_chunks(fname, chunksize=100000, usecols=None, **kwargs):
+    """Read a csv in chunks, with every value as the text in the file."""
+    return pd.read_csv(fname,
+                       dtype=str,
+                       keep_default_na=False,
+                       chunksize=chunksize,
+                       usecols=usecols,
+                       **kwargs)
+
+
+def file_digest(fname, block_size=1 << 20):
+    """Return the sha1 of a file's bytes."""
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def key_hashes(df, key):
+    """Return one uint64 hash per row for the key columns."""
+    return pd.util.hash_pandas_object(df[key], index=False,
+                                      categorize=False).values
+
+
+def row_hashes(df):
+    """Return one uint64 hash per row for the whole row."""
+    return pd.util.hash_pandas_object(df, index=False).values
+
+
+def parsed_chunks(fname, key, chunksize=100000, **kwargs):
+    """Yield the key columns and row hashes of parsed chunks."""
+    for chunk in read_chunks(fname, chunksize, **kwargs):
+        yield chunk[key], row_hashes(chunk)
+
+
+def line_chunks(fname, key, block_size=BLOCK_SIZE, **kwargs):
+    """Yield the key columns and raw line hashes of blocks of lines.
+
+    Only the key columns are parsed. Each row is hashed as
+    the bytes of its line, without the line ending. Raises
+    ValueError when the lines do not hold one record each,
+    as with quoted line breaks or skipped bad lines.
+    """
+    with open(fname, 'rb') as f:
+        header = f.readline()
+        while True:
+            # Blocks end with a whole line
+            block = f.read(block_size) + f.readline()
+            if not block:
+                break
+            try:
+                keys = pd.read_csv(io.BytesIO(header + block),
+                                   dtype=str,
+                                   keep_default_na=False,
+                                   usecols=key,
+                                   **kwargs)
+            except pd.errors.ParserError as e:
+                raise ValueError(str(e))
+            lines = np.array(block.replace(b'\r\n', b'\n').split(b'\n'),
+                             dtype=object)
+            # Blank lines are not records
+            lines = lines[lines != b'']
+            if keys.shape[0] != lines.shape[0]:
+                raise ValueError(f"{lines.shape[0]} lines hold "
+                                 f"{keys.shape[0]} records")
+            yield keys, pd.util.hash_array(lines, categorize=False)
+
+
+def snapshot_hashes(fname, key, chunksize=100000, raw=False, **kwargs):
+    """Hash the content of every key in a snapshot file.
+
+    Rows sharing a key are combined by adding their hashes,
+    so a key changes when any of its rows is added, removed
+    or edited, whatever their order. Only the hashes and the
+    key values are held while reading, never whole rows.
+
+    With 'raw', rows are hashed as the bytes of their line and
+    only the key columns are parsed, which is much faster. It
+    raises ValueError when a line does not hold one record.
+    Raw and parsed hashes of a file can not be compared.
+
+    Returns a DataFrame indexed by key hash, with the content
+    hash and the key columns.
+    """
+    if raw:
+        chunks = line_chunks(fname, key, **kwargs)
+    else:
+        chunks = parsed_chunks(fname, key, chunksize, **kwargs)
+
+    hashes = []
+    rows = []
+    keys = []
+    for chunk_keys, chunk_rows in chunks:
+        chunk_hashes = key_hashes(chunk_keys, key)
+        hashes.append(chunk_hashes)
+        rows.append(chunk_rows)
+        chunk_keys = chunk_keys.set_index(pd.Index(chunk_hashes,
+                                                   dtype='uint64'))
+        keys.append(chunk_keys[~chunk_keys.index.duplicated()])
+
+    if not hashes:
+        return pd.DataFrame(columns=['content'] + list(key),
+                            index=pd.Index([], dtype='uint64'))
+
+    unique, inverse = np.unique(np.concatenate(hashes), return_inverse=True)
+    content = np.zeros(unique.shape[0], dtype='uint64')
+    # Sums wrap around, which keeps them order independent
+    np.add.at(content, inverse, np.concatenate(rows))
+
+    keys = pd.concat(keys)
+    keys = keys[~keys.index.duplicated()]
+
+    snapshot = keys.reindex(pd.Index(unique, dtype='uint64'))
+    snapshot.insert(0, 'content', content)
+    return snapshot
+
+
+class SnapshotDiff(object):
+    """Keys inserted, updated and deleted between two snapshots.
+
+    'previous' and 'current' are snapshot hashes as returned
+    by snapshot_hashes. The files are read again only to
+    return the rows of a change.
+    """
+    def __init__(self,
+                 previous,
+                 current,
+                 previous_file=None,
+                 current_file=None,
+                 key=None,
+                 **kwargs):
+
+        self.previous = previous
+        self.current = current
+        self.previous_file = previous_file
+        self.current_file = current_file
+        self.key = key
+        self.read_kwargs = kwargs
+
+        common = current.index.intersection(previous.index)
+        changed = current['content'].reindex(common).values \
+            != previous['content'].reindex(common).values
+
+        self.changes = {
+            'insert': current.index.difference(previous.index),
+            'update': common[changed],
+            'delete': previous.index.difference(current.index)
+        }
+
+    def count(self, kind):
+        return self.changes[kind].shape[0]
+
+    @property
+    def summary(self):
+        return ', '.join(f"{self.count(x)} {x}s" for x in CHANGES)
+
+    def keys(self, kinds=CHANGES):
+        """Return the key values of the given changes, one row per key."""
+        frames = []
+        for kind in kinds:
+            snapshot = self.previous if kind == 'delete' else self.current
+            frames.append(snapshot.loc[self.changes[kind], self.key]
+                          .assign(change=kind))
+        return pd.concat(frames, ignore_index=True)
+
+    def iter_rows(self, kinds=CHANGES, chunksize=100000):
+        """Yield chunks of the rows of keys with the given changes.
+
+        Inserted and updated rows come from the current file,
+        deleted rows from the previous one. Each chunk has a
+        'change' column with the kind of change.
+        """
+        for kind in kinds:
+            selected = self.changes[kind]
+            if selected.empty:
+                continue
+            source = self.previous_file if kind == 'delete' \
+                else self.current_file
+            for chunk in read_chunks(source, chunksize, **self.read_kwargs):
+                rows = chunk[np.isin(key_hashes(chunk, self.key),
+                                     selected.values)]
+                if not rows.empty:
+                    yield rows.assign(change=kind)
+
+    def rows(self, kinds=CHANGES, chunksize=100000):
+        """Return the rows of keys with the given changes."""
+        chunks = list(self.iter_rows(kinds, chunksize))
+        if not chunks:
+            return pd.DataFrame(columns=list(self.key) + ['change'])
+        return pd.concat(chunks, ignore_index=True)
+
+
+def diff_snapshots(previous_file,
+                   current_file,
+                   key,
+                   name=None,
+                   base_dir=None,
+                   chunksize=100000,
+                   raw=True,
+                   **kwargs):
+    """Compare two csv snapshots of a feed by business key.
+
+    'key' is the list of columns identifying a record. Rows
+    are compared as the bytes of their line, so any edit to a
+    row counts as an update of its key. Parsed files are read
+    in chunks of 'chunksize' rows, and keyword arguments are
+    passed to read_csv.
+
+    When a line of either file does not hold one record, or
+    with 'raw' False, every column is parsed and rows are
+    compared by their values instead.
+
+    With a 'name', the hashes of the current file are saved
+    in the cache dir. The next run reuses them instead of
+    reading the previous file, when its bytes are the same.
+
+    Returns a SnapshotDiff.
+    """
+    if raw:
+        try:
+            return _diff_snapshots(previous_file, current_file, key, name,
+                                   base_dir, chunksize, True, **kwargs)
+        except ValueError as e:
+            logging.info(f"Comparing parsed rows, lines are not "
+                         f"records: {e}")
+
+    return _diff_snapshots(previous_file, current_file, key, name,
+                           base_dir, chunksize, False, **kwargs)
+
+
+def _diff_snapshots(previous_file,
+                    current_file,
+                    key,
+                    name,
+                    base_dir,
+                    chunksize,
+                    raw,
+                    **kwargs):
+    previous = None
+
+    if name is not None:
+        if base_dir is None:
+            base_dir = f"{conf['cache_dir']}/snapshots"
+        general.create_path_if_not_exists(base_dir)
+        state_file = f"{base_dir}/{name}.pkl"
+
+        if os.path.isfile(state_file):
+            state = pd.read_pickle(state_file)
+            if state['key'] == list(key) \
+                    and state.get('raw', False) == raw \
+                    and state['digest'] == file_digest(previous_file):
+                logging.info(f"Using saved hashes of {previous_file}")
+                previous = state['hashes']
+
+    if previous is None:
+        previous = snapshot_hashes(previous_file, key, chunksize, raw,
+                                   **kwargs)
+
+    current = snapshot_hashes(current_file, key, chunksize, raw, **kwargs)
+
+    if name is not None:
+        tmp_file = f"{state_file}.{os.getpid()}"
+        pd.to_pickle({'key': list(key),
+                      'raw': raw,
+                      'digest': file_digest(current_file),
+                      'hashes': current}, tmp_file)
+        os.replace(tmp_file, state_file)
+
+    diff = SnapshotDiff(previous, current,
+                        previous_file=previous_file,
+                        current_file=current_file,
+                        key=key,
+                        **kwargs)
+
+    logging.info(f"{current_file} has {diff.summary} "
+                 f"since {previous_file}")
+
+    return diff
@@ -0,0 +1,227 @@
+"""Stream database query results to files in batches."""
+import os
+import time
+import decimal
+import logging
+import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from trident.util import general
+
+
+def described_kind(column):
+    """Return the kind of a cursor.description column, if it says.
+
+    Drivers like cx_Oracle report precision and scale for
+    numbers: scale 0 is an integer, any other a float. An
+    Oracle NUMBER without precision can hold both, and like
+    the columns of drivers that report neither, is left to
+    the values.
+    """
+    precision, scale = column[4], column[5]
+    if scale is None:
+        return None
+    if scale == -127:
+        return 'float' if precision else None
+    return 'int' if scale == 0 else 'float'
+
+
+def value_kind(value):
+    """Return the kind of a value as the driver returned it."""
+    if isinstance(value, bool):
+        return 'other'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, (float, decimal.Decimal)):
+        return 'float'
+    if isinstance(value, datetime.datetime):
+        return 'datetime'
+    return 'other'
+
+
+def conform_dtypes(df, kinds):
+    """Cast a batch to the column kinds of its query.
+
+    pd.read_sql infers dtypes from the values, so an integer
+    column is int64 in a batch without nulls and float64 in a
+    batch with one, and is written as 5 or 5.0 depending on
+    where the batches split. Casting to the kind of the column
+    keeps every batch the same: integers are nullable Int64,
+    written as 5 with or without nulls. Values of an integer
+    column that are not whole are kept as floats.
+    """
+    for col, kind in kinds.items():
+        if kind == 'int':
+            values = pd.to_numeric(df[col], errors='coerce')
+            whole = values.dropna()
+            if (whole == np.floor(whole)).all():
+                df[col] = values.astype('Int64')
+            else:
+                df[col] = values
+        elif kind == 'float':
+            df[col] = pd.to_numeric(df[col], errors='coerce') \
+                .astype('float64')
+        elif kind == 'datetime' and df[col].dtype.kind != 'M':
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+
+    return df
+
+
+def to_numpy_dtypes(df):
+    """Cast integer columns to the dtypes pd.read_sql gives them.
+
+    For callers that concat every batch of a query into one
+    DataFrame. Integer columns are int64 without nulls and
+    float64 with them, also when a batch of only nulls made
+    the concat an object column.
+    """
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object:
+            kind = pd.api.types.infer_dtype(values, skipna=True)
+            if kind != 'integer':
+                continue
+        elif str(values.dtype) != 'Int64':
+            continue
+
+        if values.isnull().any():
+            df[col] = pd.to_numeric(values.astype(object).where(
+                values.notnull(), np.nan)).astype('float64')
+        else:
+            df[col] = values.astype('int64')
+    return df
+
+
+def fetch_batches(conn, query, batch_size=50000, arraysize=None):
+    """Run a query and yield results as DataFrames of batch_size rows.
+
+    'conn' is a DB-API connection, like MsSqlHook.get_conn(),
+    pymssql or cx_Oracle connections.
+
+    'arraysize' sets how many rows the driver fetches per round
+    trip. For cx_Oracle this is what makes large extracts fast.
+
+    Values are converted like pd.read_sql, with decimals as
+    floats, and every batch is cast to the column kinds of the
+    query, taken from cursor.description or else from the type
+    of the first value the driver returns for each column.
+    The first batch is always yielded, empty when the query
+    returns nothing, so callers get the columns.
+    """
+    cursor = conn.cursor()
+    if arraysize is not None:
+        cursor.arraysize = arraysize
+
+    try:
+        cursor.execute(query)
+        columns = [x[0] for x in cursor.description]
+        kinds = {x[0]: described_kind(x) for x in cursor.description}
+        first = True
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows and not first:
+                break
+
+            for i, col in enumerate(columns):
+                if kinds[col] is None:
+                    kinds[col] = next((value_kind(x[i]) for x in rows
+                                       if x[i] is not None), None)
+
+            df = pd.DataFrame.from_records(rows,
+                                           columns=columns,
+                                           coerce_float=True)
+            df = conform_dtypes(df, kinds)
+            first = False
+
+            yield df
+
+            if len(rows) < batch_size:
+                break
+    finally:
+        cursor.close()
+
+
+class ParquetSink(object):
+    """Append DataFrames to one parquet file with a fixed schema."""
+    def __init__(self, fname):
+        self.fname = fname
+        self.writer = None
+        self.schema = None
+
+    def write(self, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            # Columns that are all null in the first batch hold strings
+            fields = [pa.field(x.name, pa.string())
+                      if x.type == pa.null() else x
+                      for x in table.schema]
+            self.schema = pa.schema(fields)
+            self.writer = pq.ParquetWriter(self.fname, self.schema)
+
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class CsvSink(object):
+    """Append DataFrames to one csv file, with pos_write_csv defaults."""
+    def __init__(self, fname, **kwargs):
+        csv_args = general.pos_csv_defaults.copy()
+        csv_args.update(kwargs)
+        encoding = csv_args.pop('encoding')
+        self.header = csv_args.pop('header', True)
+        self.csv_args = csv_args
+        self.handle = open(fname, 'w', encoding=encoding, newline='')
+        self.first = True
+
+    def write(self, df):
+        df.to_csv(self.handle,
+                  header=self.header if self.first else False,
+                  **self.csv_args)
+        self.first = False
+
+    def close(self):
+        self.handle.close()
+
+
+def extract_to_file(conn,
+                    query,
+                    fname,
+                    batch_size=50000,
+                    arraysize=None,
+                    **kwargs):
+    """Stream query results to a csv or parquet file.
+
+    Each batch is written as soon as it is fetched, so memory
+    stays bounded by 'batch_size' whatever the table size.
+    Files ending in .parquet are written as parquet, others
+    as csv. Keyword arguments are passed to to_csv.
+
+    Returns the number of rows written.
+    """
+    general.create_path_if_not_exists(os.path.dirname(fname))
+
+    if fname.endswith('.parquet'):
+        sink = ParquetSink(fname)
+    else:
+        sink = CsvSink(fname, **kwargs)
+
+    rows = 0
+    start = time.time()
+
+    try:
+        for df in fetch_batches(conn, query, batch_size, arraysize):
+            sink.write(df)
+            rows += df.shape[0]
+            elapsed = max(time.time() - start, 1e-6)
+            logging.info(f"Wrote {rows} rows to {fname}, "
+                         f"{int(rows / elapsed)} rows/s")
+    finally:
+        sink.close()
+
+    return rows